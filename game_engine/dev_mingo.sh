@@ -14,4 +14,9 @@ export WEB_CONTROLLER_URL="http://localhost:8080"
 # export WEB_CONTROLLER_URL="http://svpserver5.ddns.net:8080"
 # export WEB_CONTROLLER_URL="http://192.168.1.162:8080"
 
+# Let the web controller tell the engine about win claims and votes as they happen,
+# instead of waiting for the next poll. The web controller needs
+# MINGO_ENGINE_NOTIFY_URL="http://localhost:8090/notify" to match.
+# export MINGO_ENGINE_PORT="8090"
+
 python mingo.py
@@ -30,17 +30,29 @@ import webbrowser
 
 import csv
 import math
+import re
+import unicodedata
 import sys
 from sys import stdout
 from pathlib import Path
-import pickle
+import struct
+import sqlite3
+import logging
+from contextlib import closing, contextmanager
+from functools import wraps, partial
+from array import array
 
 import threading
+import queue
 import time
 import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import qrcode
 import json
+import gzip
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
@@ -50,11 +62,125 @@ from spotipy.oauth2 import SpotifyOAuth
 # @TODO Get rid of global values
 #-----------------------------------
 gridsize = 5
+center_cell = gridsize**2 // 2
+card_tracks = gridsize**2 - 1
 stepping = 16
 save_path = './.cards.html'
 input_file = './.mingo_input.csv'
+playlist_cache_pathname = './.mingo_playlist_cache.db'
+
+# Pages of a playlist after the first are read from Spotify by this many threads.
+playlist_fetch_workers = 4
+
+# Spotify calls are limited to spotify_calls_per_sec, with bursts of up to
+# spotify_burst_calls. A call that Spotify refuses with 429 (too many requests) is
+# tried again up to spotify_retries times, after waiting as long as Spotify's
+# Retry-After header asks, or else doubling spotify_backoff_sec each time. Calls
+# that only read are also tried again after a server error.
+spotify_calls_per_sec = 10
+spotify_burst_calls = 10
+spotify_retries = 5
+spotify_backoff_sec = 0.5
+
+# Seconds that Spotify's answers to these calls are reused. Any call that changes
+# playback throws them away.
+spotify_cache_sec = {'current_user_playing_track': 1.0, 
+                     'current_playback': 1.0, 
+                     'devices': 5.0}
+spotify_playback_calls = {'start_playback', 'pause_playback', 'next_track', 'previous_track', 
+                          'add_to_queue', 'seek_track', 'repeat', 'shuffle', 'volume', 
+                          'transfer_playback'}
 current_dir = os.getcwd()
-game_state_pathname = './.game_state.bin'
+game_state_pathname = './.game_state.json'
+game_journal_pathname = './.game_state.journal'
+qr_base_url = 'http://svpserver5.ddns.net:8080/'
+qr_cache_dir = './.qr_cache'
+
+# Diagnostic messages go through logging. MINGO_LOG_LEVEL=DEBUG shows all of them.
+log = logging.getLogger('mingo')
+log_level = os.environ.get('MINGO_LOG_LEVEL', 'INFO')
+logging.basicConfig(level=log_level, format='%(levelname)s %(message)s')
+
+
+#-------------------------------------------------------------------
+# Metrics class - Counts and times the engine's slow operations: 
+# Spotify calls, making cards and QR codes, and writing game state. 
+# Each operation keeps a count, total and maximum time, and a histogram
+# of times in fixed millisecond buckets from which percentiles are 
+# estimated. Recording is a dictionary lookup and a few additions, so 
+# it costs far less than the operations it times.
+#-------------------------------------------------------------------
+metrics_buckets_ms = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, math.inf)
+
+class Metrics():
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> [count, total seconds, max seconds, bucket counts]
+        self._timings = dict()
+
+    def record(self, name, elapsed_sec):
+        elapsed_ms = elapsed_sec * 1000
+        bucket = 0
+        while elapsed_ms > metrics_buckets_ms[bucket]:
+            bucket += 1
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = [0, 0.0, 0.0, [0] * len(metrics_buckets_ms)]
+            timing[0] += 1
+            timing[1] += elapsed_sec
+            timing[2] = max(timing[2], elapsed_sec)
+            timing[3][bucket] += 1
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def summary(self):
+        '''
+        Summarizes every timed operation.
+
+            returns:
+                A dict of operation name to a dict of count, total_ms, mean_ms, max_ms,
+                p50_ms and p99_ms. The percentiles are bucket upper bounds.
+        '''
+        with self._lock:
+            timings = {name: (count, total, maximum, list(buckets)) 
+                        for name, (count, total, maximum, buckets) in self._timings.items()}
+        summary = dict()
+        for name, (count, total, maximum, buckets) in sorted(timings.items()):
+            summary[name] = {'count': count,
+                             'total_ms': total * 1000,
+                             'mean_ms': total * 1000 / count,
+                             'max_ms': maximum * 1000,
+                             'p50_ms': min(bucket_percentile(buckets, count, 0.5), maximum * 1000),
+                             'p99_ms': min(bucket_percentile(buckets, count, 0.99), maximum * 1000)}
+        return summary
+
+def bucket_percentile(buckets, count, fraction):
+    # Upper bound of the bucket holding the given fraction of the recorded times
+    seen = 0
+    for bucket, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen >= fraction * count:
+            return metrics_buckets_ms[bucket]
+    return metrics_buckets_ms[-1]
+
+metrics = Metrics()
+
+def timed(name):
+    # Decorator that records the time of every call of a function under name
+    def decorator(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            with metrics.timed(name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorator
 
 
 
@@ -76,71 +202,441 @@ class Spotify():
                 user-read-playback-state,\
                 user-modify-playback-state'
         ccm=SpotifyOAuth(scope=ascope, open_browser=True)
-        self.sp = spotipy.Spotify(client_credentials_manager=ccm)
+        # SpotifyClient handles 429s itself. A plain session has no urllib3 Retry
+        # adapter, so spotipy raises errors with their real status and headers.
+        self.sp = SpotifyClient(spotipy.Spotify(client_credentials_manager=ccm, 
+                                                requests_session=requests.Session()))
 
         # print(dir(self.sp))
 
+
+#-------------------------------------------------------------------
+# TokenBucket class - Spaces out calls to keep under a rate. Each call
+# takes a token; tokens come back at rate_per_sec up to burst. When 
+# Spotify says to wait, hold_off makes every thread wait.
+#-------------------------------------------------------------------
+class TokenBucket():
+    def __init__(self, rate_per_sec, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = clock()
+        self._held_until = 0
+
+    def acquire(self):
+        # Waits until a call may be made
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate_per_sec)
+                self._updated = now
+                if now < self._held_until:
+                    delay = self._held_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    delay = (1 - self._tokens) / self.rate_per_sec
+            self._sleep(delay)
+
+    def hold_off(self, seconds):
+        # No calls may be made for this many seconds
+        with self._lock:
+            self._held_until = max(self._held_until, self._clock() + seconds)
+            self._tokens = 0
+
+
+#-------------------------------------------------------------------
+# SpotifyClient class - Stands in for the spotipy client. All Spotify
+# calls go through here, so that:
+#   - calls are spaced out by a TokenBucket, and 429s are tried again
+#     after Spotify's Retry-After
+#   - answers to the calls in spotify_cache_sec are reused for a short
+#     time, until a call changes playback
+#   - threads making the same call at the same time share one request
+#   - every call is timed under 'spotify.' plus the method name. Calls
+#     answered from the cache are timed under 'spotify.cached.' and
+#     calls that shared another thread's request under 'spotify.shared.'
+#-------------------------------------------------------------------
+class SpotifyClient():
+    def __init__(self, sp, clock=time.monotonic, sleep=time.sleep):
+        self._sp = sp
+        self._clock = clock
+        self._sleep = sleep
+        self._bucket = TokenBucket(spotify_calls_per_sec, spotify_burst_calls, clock, sleep)
+        self._lock = threading.Lock()
+        # call key -> (expiry time, answer)
+        self._cache = dict()
+        # call key -> SharedCall for calls that are waiting for Spotify
+        self._in_flight = dict()
+        # Goes up whenever the cache is thrown away, so that an answer to a call
+        # made before then is not cached
+        self._generation = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self._sp, name)
+        if not callable(attribute):
+            return attribute
+        if name in spotify_playback_calls:
+            def playback_call(*args, **kwargs):
+                try:
+                    return self._call(name, attribute, args, kwargs, retry_errors=False)
+                finally:
+                    self.invalidate()
+            return playback_call
+        def read_call(*args, **kwargs):
+            return self._read(name, attribute, args, kwargs)
+        return read_call
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
+
+    def fresh(self, name, *args, **kwargs):
+        # Makes a read call to Spotify even if its answer is cached, for callers that 
+        # act on exactly where playback is. The new answer replaces the cached one.
+        attribute = getattr(self._sp, name)
+        with self._lock:
+            generation = self._generation
+        answer = self._call(name, attribute, args, kwargs)
+        cache_sec = spotify_cache_sec.get(name)
+        if cache_sec:
+            with self._lock:
+                if generation == self._generation:
+                    self._cache[self._key(name, args, kwargs)] = (self._clock() + cache_sec, answer)
+        return answer
+
+    @staticmethod
+    def _key(name, args, kwargs):
+        return (name, repr(args), repr(sorted(kwargs.items())))
+
+    def _read(self, name, attribute, args, kwargs):
+        start = time.perf_counter()
+        key = self._key(name, args, kwargs)
+        cache_sec = spotify_cache_sec.get(name)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > self._clock():
+                metrics.record('spotify.cached.' + name, time.perf_counter() - start)
+                return cached[1]
+            shared_call = self._in_flight.get(key)
+            if shared_call is None:
+                shared_call = self._in_flight[key] = SharedCall()
+                generation = self._generation
+                making_call = True
+            else:
+                making_call = False
+
+        if not making_call:
+            answer = shared_call.wait()
+            metrics.record('spotify.shared.' + name, time.perf_counter() - start)
+            return answer
+
+        try:
+            shared_call.answer = self._call(name, attribute, args, kwargs)
+            return shared_call.answer
+        except Exception as e:
+            shared_call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if cache_sec and shared_call.error is None and generation == self._generation:
+                    self._cache[key] = (self._clock() + cache_sec, shared_call.answer)
+            shared_call.done.set()
+
+    def _call(self, name, attribute, args, kwargs, retry_errors=True):
+        metric_name = 'spotify.' + name
+        for attempt in range(spotify_retries):
+            self._bucket.acquire()
+            try:
+                with metrics.timed(metric_name):
+                    return attribute(*args, **kwargs)
+            except spotipy.SpotifyException as e:
+                too_many = e.http_status == 429
+                if not (too_many or (retry_errors and e.http_status >= 500)) or attempt == spotify_retries-1:
+                    raise
+                retry_after = e.headers.get('Retry-After') if e.headers else None
+                if retry_after:
+                    delay = float(retry_after)
+                else:
+                    delay = spotify_backoff_sec * 2**attempt
+                log.warning(f'Spotify asked us to slow down, calling {name} again in {delay} seconds')
+                if too_many:
+                    self._bucket.hold_off(delay)
+                else:
+                    self._sleep(delay)
+
+class SharedCall():
+    # A Spotify call that other threads are waiting on
+    def __init__(self):
+        self.done = threading.Event()
+        self.answer = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+#-------------------------------------------------------------------
+# TitleIndex class - Finds track titles that would look the same, or
+# nearly the same, on a card. Titles are first normalized: the meta-info
+# after ' - ', anything in brackets, 'feat.' credits, accents and
+# punctuation are removed. Titles that normalize to the same text are
+# duplicates. Otherwise a title is compared with earlier titles that
+# share a word with it, by the overlap (Jaccard similarity) of their
+# three-letter sequences. Words shared by more than max_block_size
+# titles are not used to find candidates, which keeps the work for each
+# title bounded instead of comparing every pair of titles.
+#-------------------------------------------------------------------
+duplicate_title_threshold = 0.8
+
+class TitleIndex():
+    max_block_size = 200
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold if threshold is not None else duplicate_title_threshold
+        self.titles = []
+        self.grams = []
+        self.numbers = []
+        self.exact = dict()
+        self.blocks = dict()
+
+        # (title, earlier title it duplicates, similarity) for each duplicate found
+        self.report = []
+
+    def add(self, title):
+        '''
+        Adds a title unless it duplicates a title added before.
+
+            parameters:
+                title: The track title
+
+            returns:
+                The earlier title that this title duplicates, or None if it was added
+        '''
+        normalized = normalize_title(title)
+        if normalized in self.exact:
+            match = self.exact[normalized]
+            self.report.append((title, self.titles[match], 1.0))
+            return self.titles[match]
+
+        grams = title_grams(normalized)
+        numbers = set(re.findall(r'\d+', normalized))
+        words = set(word for word in normalized.split() if len(word) > 2)
+
+        candidates = set()
+        for word in words:
+            block = self.blocks.get(word)
+            if block is not None and len(block) <= self.max_block_size:
+                candidates.update(block)
+
+        best_match = None
+        best_score = 0.0
+        for candidate in candidates:
+            # 'Part 1' and 'Part 2' are different songs however alike they look
+            if self.numbers[candidate] != numbers:
+                continue
+            candidate_grams = self.grams[candidate]
+            score = len(grams & candidate_grams) / len(grams | candidate_grams)
+            if score > best_score:
+                best_match, best_score = candidate, score
+        if best_match is not None and best_score >= self.threshold:
+            self.report.append((title, self.titles[best_match], best_score))
+            return self.titles[best_match]
+
+        title_nbr = len(self.titles)
+        self.titles.append(title)
+        self.grams.append(grams)
+        self.numbers.append(numbers)
+        self.exact[normalized] = title_nbr
+        for word in words:
+            self.blocks.setdefault(word, []).append(title_nbr)
+        return None
+
+def normalize_title(title):
+    normalized = title.split(' - ', 1)[0]
+    normalized = re.sub(r'[\(\[].*?[\)\]]', ' ', normalized)
+    normalized = re.sub(r'\b(feat|ft|featuring)\b.*$', ' ', normalized, flags=re.IGNORECASE)
+    normalized = unicodedata.normalize('NFKD', normalized)
+    normalized = ''.join(c for c in normalized if not unicodedata.combining(c))
+    normalized = re.sub(r'[^\w\s]', '', normalized.lower())
+    normalized = ' '.join(normalized.split())
+    if len(normalized) == 0:
+        # Nothing was left, so fall back on the whole title
+        normalized = title.lower().strip()
+    return normalized
+
+def title_grams(normalized):
+    padded = f'  {normalized} '
+    return set(padded[i:i+3] for i in range(len(padded)-2))
+
+
+#-------------------------------------------------------------------
+# PlaylistCache class - Keeps the tracks of each playlist in a local
+# SQLite database along with the playlist's Spotify snapshot id. Spotify
+# gives a playlist a new snapshot id whenever it changes, so while the
+# snapshot id is the same the cached tracks can be used without asking
+# Spotify for them again.
+#-------------------------------------------------------------------
+class PlaylistCache():
+    def __init__(self, pathname=playlist_cache_pathname):
+        self.pathname = pathname
+        with closing(sqlite3.connect(self.pathname)) as conn, conn:
+            # Caches made before track durations were kept are thrown away and filled again
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(tracks)')]
+            if len(columns) > 0 and 'duration_ms' not in columns:
+                conn.execute('DROP TABLE tracks')
+                conn.execute('DROP TABLE playlists')
+            conn.execute("""CREATE TABLE IF NOT EXISTS playlists (
+                                playlist_id TEXT PRIMARY KEY,
+                                snapshot_id TEXT NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS tracks (
+                                playlist_id TEXT NOT NULL,
+                                position INTEGER NOT NULL,
+                                name TEXT NOT NULL,
+                                track_id TEXT,
+                                artist TEXT NOT NULL,
+                                duration_ms INTEGER,
+                                PRIMARY KEY (playlist_id, position))""")
+
+    def get_tracks(self, playlist_id, snapshot_id):
+        '''
+        Looks up the cached tracks of a playlist.
+
+            parameters:
+                playlist_id: The Spotify id of the playlist
+                snapshot_id: The playlist's current Spotify snapshot id
+
+            returns:
+                A list of (name, track id, artist, duration ms) tuples in playlist order, or None if
+                the playlist is not cached or has changed since it was cached
+        '''
+        with closing(sqlite3.connect(self.pathname)) as conn:
+            row = conn.execute('SELECT snapshot_id FROM playlists WHERE playlist_id = ?',
+                                (playlist_id,)).fetchone()
+            if row is None or row[0] != snapshot_id:
+                return None
+            return conn.execute("""SELECT name, track_id, artist, duration_ms FROM tracks
+                                    WHERE playlist_id = ? ORDER BY position""",
+                                (playlist_id,)).fetchall()
+
+    def put_tracks(self, playlist_id, snapshot_id, tracks):
+        with closing(sqlite3.connect(self.pathname)) as conn, conn:
+            conn.execute('DELETE FROM tracks WHERE playlist_id = ?', (playlist_id,))
+            conn.executemany('INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?)',
+                                [(playlist_id, position, name, track_id, artist, duration_ms) 
+                                    for position, (name, track_id, artist, duration_ms) in enumerate(tracks)])
+            conn.execute('INSERT OR REPLACE INTO playlists VALUES (?, ?)', 
+                            (playlist_id, snapshot_id))
+
+
 #-------------------------------------------------------------------
 # Playlist class
 #-------------------------------------------------------------------
 class Playlist():
     def __init__(self, sp):
         self.sp = sp
-        self.track_set = set(())
+        self.title_index = TitleIndex()
+        self.playlist_cache = PlaylistCache()
 
     def get_playlists(self):
         results = self.sp.current_user_playlists(limit=50)
         lists = {}
         for i, item in enumerate(results['items']):
-            lists[str(i)] = [item['name'], item['id']]
+            lists[str(i)] = [item['name'], item['id'], item['snapshot_id']]
         return lists
 
     def duplicate_detect(self, track_name):
-        is_duplicate = False
-        if track_name in self.track_set:
-            is_duplicate = True
-        else:
-            self.track_set.add(track_name)
-        return is_duplicate
+        # Returns the title of an earlier track that track_name duplicates, or None
+        return self.title_index.add(track_name)
 
     def duplicate_detect_reset(self):
-        self.track_set.clear()
-
-    def playlist_processing(self, pl_id, m_writer=None):
-        offset = 0
-        while True:
-            response = self.sp.playlist_items(pl_id,
-                                        offset=offset,
-                                        fields='items.track.name, items.track.id, items.track.artists.name, total',
-                                        additional_types=['track'])
-
-            if len(response['items']) == 0:
-                break
+        self.title_index = TitleIndex(self.title_index.threshold)
 
-            # Clear out duplicate detect before using it, otherwise
-            # it holds previous usage data
-            self.duplicate_detect_reset()
-
-            for idx in range(0, len(response['items'])):
-                track = response['items'][idx]['track']
-                artist_name = response['items'][idx]['track']['artists'][0]['name']
-                if not self.duplicate_detect(track['name']):
-                    # track_id = track['id']
-                    # track_urn = f'spotify:track:{track_id}'
-                    # track_info = sp.track(track_urn)
-                    # artist_name = track_info['album']['artists'][0]['name']
-                    # print(track['name'], track['id'], artist_name)
-                    if m_writer:
-                        m_writer.writerow([idx+offset, idx+offset, track['name'], track['id'], artist_name])
-                else:
-                    print(f"The track named {track['name']} by {artist_name} was not used because its name is very similar to another track already used.")
-            offset = offset + len(response['items']) 
+    def show_duplicates(self):
+        report = self.title_index.report
+        if len(report) == 0:
+            print('No duplicate track names were found in the last playlist.')
+            return
+        print(f'\n{len(report)} tracks of the last playlist were not used:')
+        for track_name, duplicate_of, score in report:
+            print(f'{score:.2f}\t{track_name}\t(same as {duplicate_of})')
+        print(f'\nTracks are left out when their names are at least {self.title_index.threshold:.2f} similar.\n')
+
+    def fetch_tracks(self, pl_id):
+        # Reads every track of a playlist from Spotify, yielding (name, track id, artist,
+        # duration ms) tuples in playlist order. The first page tells how many tracks there are, and
+        # the rest of the pages are then requested at the same time.
+        response = self.fetch_page(pl_id, 0)
+        page_size = len(response['items'])
+        if page_size == 0:
+            return
+        yield from page_tracks(response)
+        log.info(f'Processed {page_size} records so far...')
+
+        offsets = range(page_size, response['total'], page_size)
+        with ThreadPoolExecutor(max_workers=playlist_fetch_workers) as executor:
+            # map returns the pages in the order of their offsets
+            for offset, response in zip(offsets, 
+                                        executor.map(lambda offset: self.fetch_page(pl_id, offset), offsets)):
+                yield from page_tracks(response)
+                log.info(f'Processed {offset + len(response["items"])} records so far...')
+
+    def fetch_page(self, pl_id, offset):
+        # SpotifyClient tries the page again if Spotify asks us to slow down
+        return self.sp.playlist_items(pl_id,
+                                offset=offset,
+                                fields='items.track.name, items.track.id, items.track.artists.name, items.track.duration_ms, total',
+                                additional_types=['track'])
+
+    def playlist_processing(self, pl_id, m_writer=None, snapshot_id=None):
+        tracks = None
+        if snapshot_id:
+            tracks = self.playlist_cache.get_tracks(pl_id, snapshot_id)
+            if tracks is not None:
+                print('The playlist has not changed since it was last read from Spotify.')
+        if tracks is None:
+            # Rows are written as the pages arrive, and collected for the cache
+            fetched_tracks = []
+            tracks = self.fetch_tracks(pl_id)
+        else:
+            fetched_tracks = None
+
+        # Clear out duplicate detect before using it, otherwise
+        # it holds previous usage data
+        self.duplicate_detect_reset()
+
+        n_tracks = 0
+        for idx, (track_name, track_id, artist_name, duration_ms) in enumerate(tracks):
+            n_tracks += 1
+            if fetched_tracks is not None:
+                fetched_tracks.append((track_name, track_id, artist_name, duration_ms))
+            duplicate_of = self.duplicate_detect(track_name)
+            if duplicate_of is None:
+                # track_urn = f'spotify:track:{track_id}'
+                # track_info = sp.track(track_urn)
+                # artist_name = track_info['album']['artists'][0]['name']
+                # print(track_name, track_id, artist_name)
+                if m_writer:
+                    m_writer.writerow([idx, idx, track_name, track_id, artist_name, duration_ms])
+            else:
+                print(f"The track named {track_name} by {artist_name} was not used because its name is very similar to {duplicate_of}, which is already used.")
+        print(f'Total number of records processed: {n_tracks}')
 
-            print(f'Processed {offset} records so far...')
-        print(f'Total number of records processed: {offset}')
+        if fetched_tracks is not None and snapshot_id:
+            self.playlist_cache.put_tracks(pl_id, snapshot_id, fetched_tracks)
 
 
     def process_playlist(self, pl_index, save_to_file):
+        # List the playlists again so that the snapshot id is current. An edited
+        # playlist is then read from Spotify, and an unchanged one from the cache.
         playlist = self.get_playlists()[f"{pl_index}"]
         print(f'{playlist[0]}')
         pl_id = f'spotify:playlist:{playlist[1]}'
@@ -149,9 +645,14 @@ class Playlist():
             with open(input_file, mode='w') as mingo_file:
                 m_writer = csv.writer(mingo_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
                 m_writer.writerow([f'{playlist[0]}', 'track name', 'track id'])
-                self.playlist_processing(pl_id, m_writer)
+                self.playlist_processing(pl_id, m_writer, playlist[2])
         else:
-            self.playlist_processing(pl_id)
+            self.playlist_processing(pl_id, snapshot_id=playlist[2])
+
+def page_tracks(response):
+    for item in response['items']:
+        track = item['track']
+        yield (track['name'], track['id'], track['artists'][0]['name'], track.get('duration_ms'))
 
 #-------------------------------------------------------------------
 # Player class
@@ -161,6 +662,13 @@ class Player():
         self.active_player = None
         self.sp = sp
 
+        # The device that repeat was last turned off on. Repeat stays off until
+        # someone changes it in Spotify, so it is only turned off once per device.
+        self.repeat_off_device = None
+
+        # The track waiting in Spotify's queue, put there by queue_track
+        self.queued_track_id = None
+
     def show_available_players(self, list_all_players=True):
         res = self.sp.devices()
         player_count = len(res['devices'])
@@ -176,14 +684,33 @@ class Player():
                 self.active_player = res['devices'][idx]['id']
                 print(f'Selected active music player: ', {res['devices'][idx]['name']})
 
+    def set_repeat_off(self):
+        # Set the repeat mode to off, otherwise the track will repeat
+        # and this is not what I think we want. Tracks should just
+        # play once for MINGO
+        if self.repeat_off_device != self.active_player:
+            self.sp.repeat(state='off', device_id=self.active_player)
+            self.repeat_off_device = self.active_player
+
     def play_track(self, track_id):
         try:
-            # Set the repeat mode to off, otherwise the track will repeat
-            # and this is not what I think we want. Tracks should just
-            # play once for MINGO
-            self.sp.repeat(state='off', device_id=self.active_player)
-            self.sp.start_playback(uris=[f'spotify:track:{track_id}'], 
-                            device_id=self.active_player)
+            self.set_repeat_off()
+            if track_id == self.queued_track_id:
+                # The track is next in Spotify's queue, so skipping to it is one quick call
+                self.sp.next_track(device_id=self.active_player)
+                self.queued_track_id = None
+            else:
+                self.sp.start_playback(uris=[f'spotify:track:{track_id}'], 
+                                device_id=self.active_player)
+        except Exception as e:
+            display_player_exception(e)
+
+    def queue_track(self, track_id):
+        # Puts the track that will be played next in Spotify's queue, so the device
+        # has it ready before it is asked for
+        try:
+            self.sp.add_to_queue(f'spotify:track:{track_id}', device_id=self.active_player)
+            self.queued_track_id = track_id
         except Exception as e:
             display_player_exception(e)
 
@@ -206,21 +733,36 @@ class Player():
 # Card class
 #-------------------------------------------------------------------
 class Card():
-    def __init__(self, sheet, playlist_name, game_monitor, card_title_idxes):
-        # sheet is a 25 element list with 24 track numbers and a url. These
+    # A Card is a view of one card in a CardDeck. It holds no tracks itself.
+    def __init__(self, deck, card_nbr):
+        self.deck = deck
+        self.card_nbr = card_nbr
+        self.playlist_name = deck.playlist_name
+        self.monitor = deck.monitor
+
+    @property
+    def card_title_idxes(self):
+        # The 24 track indexes of this card, in the order they are laid out
+        start = self.card_nbr * card_tracks
+        return self.deck.card_track_idxes[start:start + card_tracks]
+
+    @property
+    def track_idxes(self):
+        # The track index of each of the 25 cells, laid out the same way as the
+        # sheet. The free center cell has no track, so its entry is None.
+        track_idxes = self.card_title_idxes.tolist()
+        track_idxes.insert(center_cell, None)
+        return track_idxes
+
+    @property
+    def sheet(self):
+        # sheet is a 25 element list with 24 track titles and a QR code image. These
         # represent 5 x 5 element rows of the Mingo board. The center element
-        # is the url, which represents a free square.
-        self.sheet = sheet
-        self.playlist_name = playlist_name
-        self.monitor = game_monitor
-
-        # @todo When a Card is made, take all the track_ids that are listed on its sheet and
-        # add them to the set unplayed_tracks. This way only the track_ids that are on cards
-        # are played during the game. Originally I played all tracks, not just the ones on cards.
-        # That causes the game to be too long in many cases.
-        # !!! unplayed_tracks will be property of Game, but for now just test it here
-        self.unplayed_tracks = set()
-        print(card_title_idxes)
+        # is the image, which represents a free square.
+        titles = self.deck.titles
+        sheet = [titles[idx] for idx in self.card_title_idxes]
+        sheet.insert(center_cell, '<img src="'+self.deck.qr_files[self.card_nbr]+'"'+'/>')
+        return sheet
 
     def as_json(self, card_nbr):
         return songs_to_json(self.sheet, card_nbr)
@@ -236,12 +778,16 @@ class Card():
         for th in bingo:
             f.write(th)
         f.write("</tr>"+newline)
+        # Both are built on each access, so read them once for the whole card
+        track_idxes = self.track_idxes
+        sheet = self.sheet
         for r in range(gridsize):
             f.write("<tr>"+newline)
             for c in range(gridsize):
                 cell = r * gridsize + c
-                cell = self.sheet[cell]
-                been_played = self.monitor.has_been_played(cell)
+                track_idx = track_idxes[cell]
+                cell = sheet[cell]
+                been_played = track_idx is not None and self.monitor.has_been_played(track_idx)
                 # Check length of cell string. apply a smaller fontsize if it's
                 # too long, this tries to keep a card short enough to fit on a page
                 # without running to the top of the next page.
@@ -282,11 +828,9 @@ def songs_to_json(song_titles, card_nbr):
         raise ValueError("The list must contain exactly 25 song titles.")
     
     # Create a dictionary to structure the data
-    print("===================================")
-    print("processing card number: ", card_nbr)
+    log.debug(f'processing card number: {card_nbr}')
     data = {"card_nbr": card_nbr, "songs": [{"id": i + 1, "title": title} for i, title in enumerate(song_titles)]}
     ret_json = json.dumps(data)
-    print("===================================")
     
     # Convert the dictionary to a JSON string
     return ret_json # , indent=4)
@@ -294,21 +838,293 @@ def songs_to_json(song_titles, card_nbr):
 
 
 
+#-------------------------------------------------------------------
+# Win patterns. Cells of a card are numbered 0 through 24, row by row,
+# and a line is kept as a bitmask with one bit per cell. A card wins when
+# every cell of one of its lines has been played. The center cell is the
+# free square and always counts as played.
+#-------------------------------------------------------------------
+def cells_to_mask(cells):
+    mask = 0
+    for cell in cells:
+        mask |= 1 << cell
+    return mask
+
+def register_win_pattern(pattern_name, lines):
+    '''
+    Adds a named win pattern that games can check claims against.
+
+        parameters:
+            pattern_name: The name used to select the pattern, e.g. 'corners'
+            lines: A dict of line name to the list of cell numbers in that line
+
+        returns:
+            None
+    '''
+    win_patterns[pattern_name] = [(line_name, cells_to_mask(cells)) 
+                                    for line_name, cells in lines.items()]
+
+win_patterns = dict()
+register_win_pattern('rows', 
+    {f'row {r+1}': [r*gridsize + c for c in range(gridsize)] for r in range(gridsize)})
+register_win_pattern('columns', 
+    {f'column {c+1}': [r*gridsize + c for r in range(gridsize)] for c in range(gridsize)})
+register_win_pattern('diagonals', 
+    {'diagonal': [i*gridsize + i for i in range(gridsize)],
+     'anti-diagonal': [i*gridsize + (gridsize-1-i) for i in range(gridsize)]})
+register_win_pattern('corners', 
+    {'four corners': [0, gridsize-1, gridsize*(gridsize-1), gridsize**2-1]})
+register_win_pattern('blackout', 
+    {'full card': list(range(gridsize**2))})
+
+default_win_patterns = ['rows', 'columns', 'diagonals']
+
+# The 12 lines (rows, columns and diagonals) that the leaderboard counts, and for
+# each cell the positions in leader_lines of the lines passing through it.
+leader_lines = [mask for pattern_name in default_win_patterns 
+                    for _, mask in win_patterns[pattern_name]]
+cell_lines = [[line for line, mask in enumerate(leader_lines) if mask & (1 << cell)] 
+                for cell in range(gridsize**2)]
+
+# The same 12 lines given as positions in a card's list of 24 track indexes, which
+# leaves out the free center cell
+card_cells = [cell for cell in range(gridsize**2) if cell != center_cell]
+line_positions = [[position for position, cell in enumerate(card_cells) if mask & (1 << cell)]
+                    for mask in leader_lines]
+
+# How many times to try making a card whose lines are not on any other card before
+# giving up on the playlist
+max_line_retries = 1000
+
+
+def sample_card_tracks(title_idxes, n_cards, rng, unique_lines=False):
+    '''
+    Picks the tracks of every card.
+
+        parameters:
+            title_idxes: The track indexes to pick from
+            n_cards: The number of cards
+            rng: The random.Random to pick with
+            unique_lines: If True, no two cards share the same tracks in any row,
+                  column or diagonal
+
+        returns:
+            An array of 24 track indexes per card, and the number of cards that were
+            thrown away because one of their lines was already on another card
+    '''
+    # Each card needs 24 different tracks. They are picked by shuffling just the
+    # first 24 places of a list of all track indexes (a partial Fisher-Yates shuffle)
+    # and copying those places out. The list is reused from card to card.
+    #
+    # With unique_lines, each line of a card is kept as the sorted tuple of its
+    # track indexes in a set of all lines used so far. A card with any line that
+    # is already in the set is thrown away and picked again.
+    n_titles = len(title_idxes)
+    if n_titles < card_tracks:
+        raise Exception(f'The playlist has {n_titles} usable tracks, but each card needs {card_tracks}.')
+
+    pool = list(title_idxes)
+    rand = rng.random
+    card_track_idxes = array('i')
+    used_lines = set()
+    line_retries = 0
+    for card_nbr in range(n_cards):
+        retries = 0
+        while True:
+            for i in range(card_tracks):
+                j = i + int(rand() * (n_titles - i))
+                pool[i], pool[j] = pool[j], pool[i]
+            if not unique_lines:
+                break
+
+            lines = [tuple(sorted([pool[position] for position in positions])) 
+                        for positions in line_positions]
+            if used_lines.isdisjoint(lines):
+                used_lines.update(lines)
+                break
+
+            retries += 1
+            if retries == max_line_retries:
+                raise Exception(f'Could not make card {card_nbr} without repeating a line of another card. \
+Use fewer cards or a longer playlist.')
+        line_retries += retries
+        card_track_idxes.extend(pool[:card_tracks])
+    return card_track_idxes, line_retries
+
+
+#-------------------------------------------------------------------
+# CardIndex class - Tracks which cells of every card have been played
+# so that a win claim can be checked without looking at the card.
+# Each card is kept as a 25 bit mask of played cells, and an inverted
+# index maps each track index to the (card number, cell) pairs where
+# that track appears. Marking a track only touches the cards that
+# contain it.
+#
+# The index also keeps the leaderboard: for every card, the number of
+# played cells in each of its 12 lines and how many more cells its
+# closest line needs. cards_needing[k] is the set of cards whose best
+# line needs k more cells, so the closest cards are found without
+# looking at every card.
+#-------------------------------------------------------------------
+class CardIndex():
+    def __init__(self):
+        self.played_masks = []
+        self.track_cells = dict()
+
+        self.line_counts = []
+        self.needs = []
+        self.cards_needing = [set() for _ in range(gridsize+1)]
+
+    def add_card(self, card_nbr, track_idxes):
+        while len(self.played_masks) <= card_nbr:
+            self.played_masks.append(1 << center_cell)
+            self.line_counts.extend(1 if mask & (1 << center_cell) else 0 
+                                    for mask in leader_lines)
+            self.needs.append(gridsize-1)
+            self.cards_needing[gridsize-1].add(len(self.needs)-1)
+        for cell, track_idx in enumerate(track_idxes):
+            if track_idx is not None:
+                self.track_cells.setdefault(track_idx, []).append((card_nbr, cell))
+
+    def add_deck(self, deck):
+        # Same as add_card for every card of a deck, reading the deck's array directly
+        for card_nbr in range(deck.n_cards):
+            self.add_card(card_nbr, ())
+        track_cells = self.track_cells
+        for position, track_idx in enumerate(deck.card_track_idxes):
+            card_nbr, card_position = divmod(position, card_tracks)
+            cell_list = track_cells.get(track_idx)
+            if cell_list is None:
+                cell_list = track_cells[track_idx] = []
+            cell_list.append((card_nbr, card_cells[card_position]))
+
+    def mark_track(self, track_idx):
+        played_masks = self.played_masks
+        line_counts = self.line_counts
+        needs = self.needs
+        n_lines = len(leader_lines)
+        for card_nbr, cell in self.track_cells.get(track_idx, ()):
+            played_masks[card_nbr] |= 1 << cell
+
+            base = card_nbr * n_lines
+            need = needs[card_nbr]
+            for line in cell_lines[cell]:
+                line_counts[base + line] += 1
+                if gridsize - line_counts[base + line] < need:
+                    need = gridsize - line_counts[base + line]
+            if need != needs[card_nbr]:
+                self.cards_needing[needs[card_nbr]].discard(card_nbr)
+                self.cards_needing[need].add(card_nbr)
+                needs[card_nbr] = need
+
+    def leaders(self, n_leaders):
+        '''
+        Finds the cards that are closest to completing a line.
+
+            parameters:
+                n_leaders: The maximum number of cards to return
+
+            returns:
+                A list of (card number, cells still needed) tuples, closest cards first
+        '''
+        leaders = []
+        for need, card_nbrs in enumerate(self.cards_needing):
+            for card_nbr in card_nbrs:
+                if len(leaders) == n_leaders:
+                    return leaders
+                leaders.append((card_nbr, need))
+        return leaders
+
+    def need_counts(self):
+        return [len(card_nbrs) for card_nbrs in self.cards_needing]
+
+    def winning_lines(self, card_nbr, pattern_names=default_win_patterns):
+        played_mask = self.played_masks[card_nbr]
+        lines = []
+        for pattern_name in pattern_names:
+            for line_name, line_mask in win_patterns[pattern_name]:
+                if played_mask & line_mask == line_mask:
+                    lines.append(line_name)
+        return lines
+
+#-------------------------------------------------------------------
+# CardDeck class - All the cards of a game, kept as one flat array of
+# track indexes with 24 entries per card (the free center cell has no
+# track), along with the titles and QR code images the cards show.
+#-------------------------------------------------------------------
+class CardDeck():
+    def __init__(self, card_track_idxes, titles, qr_files, playlist_name, game_monitor):
+        self.card_track_idxes = card_track_idxes
+        self.titles = titles
+        self.qr_files = qr_files
+        self.playlist_name = playlist_name
+        self.monitor = game_monitor
+        self.n_cards = len(card_track_idxes) // card_tracks
+
+    def cards(self):
+        return {card_nbr: Card(self, card_nbr) for card_nbr in range(self.n_cards)}
+
+
+#-------------------------------------------------------------------
+# QRCodeGenerator class - Makes the QR code image in the center of each
+# card. Images are cached in qr_cache_dir under a name made from a hash
+# of the URL they encode, so making a game again with the same URL reuses
+# the images already there. Missing images are made by a pool of
+# processes so that every core of the machine is used.
+#-------------------------------------------------------------------
 class QRCodeGenerator():
-    def __init__(self, base_url) -> None:
-        self._save_path = '.'
+    # Below this many missing images, starting worker processes costs more than it saves
+    parallel_threshold = 16
+
+    def __init__(self, base_url, cache_dir=qr_cache_dir) -> None:
+        self._save_path = cache_dir
         self._base_url = base_url
 
     def make_code(self, code_number):
-        # Create a QR code object with the URL
-        qr = qrcode.make(self._base_url+'/'+str(code_number))
+        return self.make_codes([code_number])[0]
 
-        # Save the QR code image with a filename based on the URL
-        # Removing special characters from the URL to create a clean filename
-        filename = self._base_url.replace("https://", "").replace("http://", "").replace("/", "_").replace(":", "") +str(code_number)+ ".png"
-        qr.save(filename, scale=2)
+    @timed('qr_codes')
+    def make_codes(self, code_numbers):
+        '''
+        Makes sure there is a QR code image for each code number.
 
-        return(filename)          
+            parameters:
+                code_numbers: The numbers to make codes for, usually card numbers
+
+            returns:
+                The filenames of the images, in the same order as code_numbers
+        '''
+        filenames = [self.code_filename(code_number) for code_number in code_numbers]
+        missing = [(self.code_url(code_number), filename) 
+                    for code_number, filename in zip(code_numbers, filenames) 
+                    if not os.path.exists(filename)]
+
+        if len(missing) > 0:
+            os.makedirs(self._save_path, exist_ok=True)
+            if len(missing) < self.parallel_threshold:
+                for url, filename in missing:
+                    save_qr_code(url, filename)
+            else:
+                with ProcessPoolExecutor() as executor:
+                    list(executor.map(save_qr_code, *zip(*missing), chunksize=32))
+        return filenames
+
+    def code_url(self, code_number):
+        return self._base_url+'/'+str(code_number)
+
+    def code_filename(self, code_number):
+        # The filename is a hash of the base url and the code number
+        key = hashlib.sha256(f'{self._base_url}\n{code_number}'.encode('utf-8')).hexdigest()[:24]
+        return os.path.join(self._save_path, key+'.png')
+
+def save_qr_code(url, filename):
+    # Runs in the worker processes of QRCodeGenerator. The image is written to a
+    # temporary file first so that a half written image never appears in the cache.
+    qr = qrcode.make(url)
+    temp_filename = filename+'.'+str(os.getpid())+'.tmp'
+    with open(temp_filename, 'wb') as fp:
+        qr.save(fp)
+    os.replace(temp_filename, filename)
 
 
 #-------------------------------------------------------------------
@@ -317,21 +1133,28 @@ class QRCodeGenerator():
 class CardFactory():
     def __init__(self, input_file, game_monitor) -> None:
         self.center_figure = '<img src="center-img-small.png"/>'
-        self.qr_generator = QRCodeGenerator('http://svpserver5.ddns.net:8080/')
+        self.qr_generator = QRCodeGenerator(qr_base_url)
         self.input_titles = []
         self.input_ids = []
         self.input_track_ids = []
         self.input_artists = []
+        self.input_durations = []
         self.game_monitor = game_monitor
 
         self.active_indexes = set();
 
+        # Number of cards thrown away by the last make_cards call because one of their
+        # lines was already on another card
+        self.line_retries = 0
+
         with open(input_file, 'r') as f:
             r = csv.reader(f, delimiter=',', quotechar='"')
             playlist_name_row = next(r)
             self.playlist_name = playlist_name_row[0]
             for row in r:
                 self.input_artists.append(row[4])
+                # Files written before durations were kept have no duration column
+                self.input_durations.append(int(row[5]) if len(row) > 5 and row[5] else 0)
                 self.input_track_ids.append(row[3])
                 # Shorten title by removing stuff after a hyphen that is preceded by
                 # a space. Spotify titles often include meta-info like when a song
@@ -363,30 +1186,33 @@ class CardFactory():
 
 
 
-    def make_card(self, card_nbr):
-        # print('Creating mingo card from: ' + str(len(self.titles)) + ' song titles')
+    @timed('make_cards')
+    def make_cards(self, n_cards, seed=None, unique_lines=False):
+        '''
+        Makes all the cards of a game in one go.
 
-        ## The random sample below needs to contain unique selections, never any duplicates.
-        ## random.sample is supposed to provide unique selections, so use it...
-        
-        ## !!!
-        card_title_idxes = random.sample(self.title_idx, gridsize**2 - 1)
+            parameters:
+                n_cards: The number of cards to make
+                seed: Seeds the random choice of tracks so that the same cards can be
+                      made again. If None, the cards are different every time.
+                unique_lines: If True, no two cards share the same tracks in any row,
+                      column or diagonal, so two cards cannot win with the same line.
+
+            returns:
+                A CardDeck holding the cards
+        '''
+        card_track_idxes = self.sample_cards(n_cards, random.Random(seed), unique_lines)
 
         ## Add each card's indexes to the set of indexes used when we play
-        self.active_indexes.update(card_title_idxes)
-        
-        sheet = []
-        for idx in card_title_idxes:
-            ## print(str(idx), self.titles[idx])
-            sheet.append(self.titles[idx])
-        ## !!!
+        self.active_indexes.update(card_track_idxes)
+
+        qr_files = self.qr_generator.make_codes(range(n_cards))
+        return CardDeck(card_track_idxes, self.titles, qr_files, 
+                        self.playlist_name, self.game_monitor)
 
-        ## sheet = random.sample(self.titles, gridsize**2 - 1)
-        qr_file_name = self.qr_generator.make_code(card_nbr)
-        center_figure = '<img src="'+qr_file_name+'"'+'/>'
-        # print(center_figure)
-        sheet.insert(math.ceil(len(sheet)/2), center_figure) 
-        return Card(sheet, self.playlist_name, self.game_monitor, card_title_idxes)
+    def sample_cards(self, n_cards, rng, unique_lines=False):
+        card_track_idxes, self.line_retries = sample_card_tracks(self.title_idx, n_cards, rng, unique_lines)
+        return card_track_idxes
 
     def get_track_ids(self):
         return self.track_ids
@@ -395,11 +1221,170 @@ class CardFactory():
         return self.active_indexes
 
                
+#-------------------------------------------------------------------
+# Game simulation - Plays many complete games without Spotify to show
+# how long games last for a playlist size, number of cards and set of
+# win patterns. A DeckSimulator plays all cards of a deck at once: for
+# each of the 24 card positions it keeps one integer used as a bitset
+# with a bit per card, set once the track in that position of that card
+# has been played. The cards that have completed a line are the AND of
+# the bitsets of the line's positions, so each track drawn costs a few
+# integer operations however many cards there are. Each deck is played
+# with simulation_games_per_deck different draw orders, and batches of
+# games run in a pool of processes so that every core is used.
+#-------------------------------------------------------------------
+simulation_games_per_deck = 20
+
+# Minutes an average track plays for, used to turn tracks into game length
+simulation_track_minutes = 3.5
+
+def pattern_positions(pattern_names):
+    # The lines of the win patterns as tuples of positions in a card's list of 24
+    # track indexes. The free center cell is always played, so it is left out.
+    lines = set()
+    for pattern_name in pattern_names:
+        for _, mask in win_patterns[pattern_name]:
+            lines.add(tuple(position for position, cell in enumerate(card_cells) if mask & (1 << cell)))
+    return sorted(lines)
+
+class DeckSimulator():
+    def __init__(self, card_track_idxes, pattern_names=default_win_patterns):
+        lines = pattern_positions(pattern_names)
+        position_lines = [[line for line in lines if position in line] for position in range(card_tracks)]
+
+        # For each track on the cards, the (position, bitset of the cards with the track
+        # in that position) pairs, and the lines passing through those positions
+        track_cells = dict()
+        for index, track_idx in enumerate(card_track_idxes):
+            card_nbr, position = divmod(index, card_tracks)
+            cells = track_cells.setdefault(track_idx, dict())
+            cells[position] = cells.get(position, 0) | (1 << card_nbr)
+        # Only tracks that are on a card are drawn, the same as TrackPool
+        self.track_idxes = sorted(track_cells)
+        self.track_cells = {track_idx: tuple(cells.items()) for track_idx, cells in track_cells.items()}
+        self.track_lines = {track_idx: tuple({line for position in cells for line in position_lines[position]})
+                                for track_idx, cells in track_cells.items()}
+
+    def play(self, rng, prizes=1):
+        '''
+        Plays one game, drawing tracks in random order until prizes cards have won.
+
+            parameters:
+                rng: The random.Random to draw with
+                prizes: The number of winning cards that ends the game
+
+            returns:
+                A tuple of the number of tracks drawn until the first win, the number of
+                cards that won with that track, and the number of tracks drawn until prizes
+                cards have won (None if the tracks ran out first)
+        '''
+        marked = [0] * card_tracks
+        won = 0
+        n_won = 0
+        first_win = None
+        simultaneous = 0
+        pool = list(self.track_idxes)
+        n_tracks = len(pool)
+        rand = rng.random
+        for draw in range(n_tracks):
+            j = draw + int(rand() * (n_tracks - draw))
+            pool[draw], pool[j] = pool[j], pool[draw]
+            track_idx = pool[draw]
+
+            for position, cards in self.track_cells[track_idx]:
+                marked[position] |= cards
+            new_wins = 0
+            for line in self.track_lines[track_idx]:
+                line_cards = marked[line[0]]
+                for position in line[1:]:
+                    line_cards &= marked[position]
+                new_wins |= line_cards
+            new_wins &= ~won
+
+            if new_wins:
+                count = bin(new_wins).count('1')
+                if first_win is None:
+                    first_win = draw + 1
+                    simultaneous = count
+                won |= new_wins
+                n_won += count
+                if n_won >= prizes:
+                    return first_win, simultaneous, draw + 1
+        return first_win, simultaneous, None
+
+def simulate_games(n_tracks, n_cards, n_games, pattern_names, unique_lines, prizes, seed):
+    # Runs in the worker processes of simulate_game_lengths
+    rng = random.Random(seed)
+    results = []
+    while len(results) < n_games:
+        card_track_idxes, _ = sample_card_tracks(range(n_tracks), n_cards, rng, unique_lines)
+        deck = DeckSimulator(card_track_idxes, pattern_names)
+        for _ in range(min(simulation_games_per_deck, n_games - len(results))):
+            results.append(deck.play(rng, prizes))
+    return results
+
+@timed('simulate')
+def simulate_game_lengths(n_tracks, n_cards, n_games, pattern_names=default_win_patterns, 
+                          unique_lines=False, prizes=1, seed=None):
+    '''
+    Plays many games with new random cards and draw orders.
+
+        parameters:
+            n_tracks: The number of usable tracks in the playlist
+            n_cards: The number of cards in each game
+            n_games: The number of games to play
+            pattern_names: The win patterns a card can win with
+            unique_lines: If True, the cards are made with no line on two cards
+            prizes: The number of winning cards that ends a game
+            seed: Seeds the random choices so that a simulation can be repeated
+
+        returns:
+            A list with the result of DeckSimulator.play for each game
+    '''
+    if n_tracks < card_tracks:
+        raise Exception(f'The playlist has {n_tracks} usable tracks, but each card needs {card_tracks}.')
+
+    # A few batches per core keeps every core busy until the end
+    n_cores = os.cpu_count() or 1
+    n_batches = 1 if n_cores == 1 else min(math.ceil(n_games / simulation_games_per_deck), 4 * n_cores)
+    batch_sizes = [n_games // n_batches + (1 if batch < n_games % n_batches else 0) 
+                    for batch in range(n_batches)]
+    first_seed = random.Random(seed).getrandbits(64)
+    batch_arguments = ([n_tracks] * n_batches, [n_cards] * n_batches, batch_sizes,
+                       [pattern_names] * n_batches, [unique_lines] * n_batches, 
+                       [prizes] * n_batches, [first_seed + batch for batch in range(n_batches)])
+    if n_batches == 1:
+        batches = list(map(simulate_games, *batch_arguments))
+    else:
+        with ProcessPoolExecutor() as executor:
+            batches = list(executor.map(simulate_games, *batch_arguments))
+    return [result for batch in batches for result in batch]
+
+
+#-------------------------------------------------------------------
+# Game state is saved as a snapshot plus a journal. The snapshot is a
+# JSON document with a schema version, the playlist's track table, each
+# card as a list of track indexes and the played tracks in draw order.
+# Between snapshots, events that change the game are appended to the
+# journal as fixed size binary records (an event code and a value), so
+# playing a track writes a few bytes instead of the whole game. After
+# snapshot_interval journal records a new snapshot is written and the
+# journal starts over.
+#-------------------------------------------------------------------
+snapshot_schema_version = 1
+snapshot_interval = 25
+journal_record = struct.Struct('<Bi')
+journal_draw = 1
+journal_current = 2
+journal_pause = 3
+journal_resume = 4
+journal_next = 5
+
 #-------------------------------------------------------------------
 # Game class
 #-------------------------------------------------------------------
 class Game():
-    def __init__(self, n_cards, sp, musicplayer):
+    def __init__(self, n_cards, sp, musicplayer, seed=None, unique_lines=False):
         self.n_cards = n_cards
         self.sp = sp
         self.game_monitor = GameMonitor()
@@ -408,9 +1393,10 @@ class Game():
 
         card_factory = CardFactory(input_file, self.game_monitor)
         self.playlist_name = card_factory.playlist_name
-        self.cards = dict()
-        for card_nbr in range(n_cards):
-            self.cards[card_nbr] = card_factory.make_card(card_nbr)
+        self.deck = card_factory.make_cards(n_cards, seed, unique_lines)
+        self.cards = self.deck.cards()
+        if unique_lines:
+            print(f'Every line is on only one card. {card_factory.line_retries} cards were made again to get there.')
 
         self.active_indexes = card_factory.get_active_indexes(); ## !!!
         # print("Active indexes: " , self.active_indexes)
@@ -418,40 +1404,136 @@ class Game():
         self.track_ids = card_factory.get_track_ids()
         self.track_info = card_factory.track_info
         self.track_artists = card_factory.input_artists
+        self.track_durations = card_factory.input_durations
         self.player = musicplayer
 
+        self.start_tracking()
+
+        print(f'Created a Mingo game with {n_cards} cards')
+
+    @classmethod
+    def from_snapshot(cls, snapshot, sp, musicplayer):
+        """
+        Rebuilds a game from a snapshot made by the snapshot method.
+        """
+        if snapshot.get('schema') != snapshot_schema_version:
+            raise Exception(f'The saved game uses snapshot schema {snapshot.get("schema")}, \
+but this program reads schema {snapshot_schema_version}.')
+
+        game = cls.__new__(cls)
+        game.sp = sp
+        game.player = musicplayer
+        game.game_monitor = GameMonitor()
+        game.testval = '555'
+
+        game.playlist_name = snapshot['playlist_name']
+        game.track_ids = snapshot['tracks']['ids']
+        game.track_info = dict(enumerate(snapshot['tracks']['titles']))
+        game.track_artists = snapshot['tracks']['artists']
+        game.track_durations = snapshot['tracks'].get('durations', [0] * len(game.track_ids))
+
+        qr_generator = QRCodeGenerator(snapshot['qr_base_url'])
+        card_track_idxes = array('i')
+        for card_title_idxes in snapshot['cards']:
+            card_track_idxes.extend(card_title_idxes)
+        qr_files = [qr_generator.code_filename(card_nbr) for card_nbr in range(len(snapshot['cards']))]
+        game.deck = CardDeck(card_track_idxes, snapshot['tracks']['titles'], qr_files,
+                                game.playlist_name, game.game_monitor)
+        game.cards = game.deck.cards()
+        game.active_indexes = set(card_track_idxes)
+        game.n_cards = game.deck.n_cards
+
+        game.start_tracking()
+        game.win_pattern_names = snapshot['win_patterns']
+        for track_idx in snapshot['played']:
+            game.track_pool.take(track_idx)
+            game.record_played_track(track_idx)
+        game.current_track_idx = snapshot['current_track_idx']
+        game.paused_at_ms = snapshot['paused_at_ms']
+        game.next_track_idx = snapshot.get('next_track_idx')
+        game.pending_events.clear()
+        return game
+
+    def start_tracking(self):
+        # Sets up the played state of a game whose cards and tracks are in place
+        self.card_index = CardIndex()
+        self.card_index.add_deck(self.deck)
+        self.win_pattern_names = list(default_win_patterns)
+
         self.played_tracks = []
 
-        # unplayed_tracks needs to be a list so random.select will work. The active_indexes
-        # is a set of all songs on all cards. Make the list now...
-        self.unplayed_tracks = list(self.active_indexes)
+        # Only the tracks that are on cards are played. The active_indexes is a set
+        # of all songs on all cards. The track pool keeps track of which of them have
+        # been played and is shared with the game monitor.
+        self.track_pool = TrackPool(len(self.track_ids), self.active_indexes)
+        self.game_monitor.set_track_pool(self.track_pool)
         self.state = []
         
         self.paused_at_ms = None
         self.current_track_idx = None
 
-        # @todo only add the tracks that are on cards to unplayed_tracks
-        ## for idx in range(len(self.track_ids)):
-        ##    self.unplayed_tracks.append(idx)
+        # The track that will be played next. It is chosen, and queued on the player,
+        # while the current track plays so that moving on to it is quick.
+        self.next_track_idx = None
 
         # self.game_monitor.set_total_tracks(len(self.track_ids))
-        self.game_monitor.set_total_tracks(len(self.unplayed_tracks))
+        self.game_monitor.set_total_tracks(self.track_pool.unplayed_count())
 
-        print(f'Created a Mingo game with {n_cards} cards')
+        # Journal events not yet written, and the number written since the last snapshot
+        self.pending_events = []
+        self.journal_length = 0
 
     def get_testval(self):
         return self.testval
 
-    def write_game_state(self):
-        path = Path(game_state_pathname)
-        with open(path, 'wb') as fp:
-            pickle.dump(self, fp)
+    def snapshot(self):
+        return {'schema': snapshot_schema_version,
+                'playlist_name': self.playlist_name,
+                'qr_base_url': qr_base_url,
+                'tracks': {'ids': self.track_ids,
+                           'titles': [self.track_info[idx] for idx in range(len(self.track_ids))],
+                           'artists': self.track_artists,
+                           'durations': self.track_durations},
+                'cards': [self.cards[card_nbr].card_title_idxes.tolist() 
+                            for card_nbr in range(self.n_cards)],
+                'played': self.played_tracks,
+                'current_track_idx': self.current_track_idx,
+                'paused_at_ms': self.paused_at_ms,
+                'next_track_idx': self.next_track_idx,
+                'win_patterns': self.win_pattern_names}
+
+    def apply_event(self, event, value):
+        # Replays one journal record
+        if event == journal_draw:
+            if not self.track_pool.has_been_played(value):
+                self.track_pool.take(value)
+                self.record_played_track(value)
+        elif event == journal_current:
+            self.current_track_idx = value
+        elif event == journal_pause:
+            self.paused_at_ms = value
+        elif event == journal_resume:
+            self.paused_at_ms = None
+        elif event == journal_next:
+            self.next_track_idx = value
+
+    @timed('write_game_state')
+    def write_game_state(self, full_snapshot=False):
+        if full_snapshot or self.journal_length + len(self.pending_events) > snapshot_interval:
+            write_snapshot(self.snapshot(), game_state_pathname)
+            with open(Path(game_journal_pathname), 'wb'):
+                pass
+            self.journal_length = 0
+        elif len(self.pending_events) > 0:
+            with open(Path(game_journal_pathname), 'ab') as fp:
+                for event, value in self.pending_events:
+                    fp.write(journal_record.pack(event, value))
+            self.journal_length += len(self.pending_events)
+        self.pending_events.clear()
 
     def save_game_state(self, save_number):
-        save_state_pathname = './.saved_game_'+save_number+'.bin'
-        path = Path(save_state_pathname)
-        with open(path, 'wb') as fp:
-            pickle.dump(self, fp)
+        save_state_pathname = './.saved_game_'+save_number+'.json'
+        write_snapshot(self.snapshot(), save_state_pathname)
         print(f'Saved game to path {save_state_pathname}')
 
     def get_card(self, card_num):
@@ -461,6 +1543,19 @@ numbered 0 through {self.n_cards - 1}. Try again.')
         else:
             return self.cards[card_num] 
 
+    def verify_claim(self, card_num):
+        '''
+        Checks a win claim against the tracks played so far.
+
+            parameters:
+                card_num: The number of the card claiming a win
+
+            returns:
+                A list naming the winning lines of the card, empty if the card has not won
+        '''
+        self.get_card(card_num)
+        return self.card_index.winning_lines(card_num, self.win_pattern_names)
+
     def play_previous_track(self, back_index):
         """
         if back_index:
@@ -472,10 +1567,11 @@ numbered 0 through {self.n_cards - 1}. Try again.')
         # print ('+++ number of played tracks: ', len(self.played_tracks))
         if play_index < len(self.played_tracks):
             track_idx = self.played_tracks[play_index]
-            print("Playing track idx: ",track_idx)
+            log.debug(f'Playing track idx: {track_idx}')
             now_playing = self.track_info[track_idx]
             artist = self.track_artists[track_idx]
             self.current_track_idx = track_idx
+            self.pending_events.append((journal_current, track_idx))
             print(f'\nNow playing: "{now_playing}" by "{artist}"\n')
             track_to_play = self.track_ids[track_idx]
             self.player.play_track(track_to_play)
@@ -485,34 +1581,81 @@ numbered 0 through {self.n_cards - 1}. Try again.')
 
 
     def play_next_track(self, testmode=False):
-        if len(self.unplayed_tracks) == 0:
+        # If Spotify has already moved on to the queued track by itself, that track is
+        # the one being skipped, so record it first. Otherwise skipping to the queued
+        # track would skip the track that just started.
+        if not testmode:
+            self.catch_up()
+
+        if self.track_pool.unplayed_count() == 0:
             print('The game is over. All tracks have been played.')
             return
 
-        track_idx = random.choice(self.unplayed_tracks)
-        self.unplayed_tracks.remove(track_idx)
-        self.played_tracks.append(track_idx)
-        print("Playing track idx: ",track_idx)
+        if self.next_track_idx is None or self.track_pool.has_been_played(self.next_track_idx):
+            self.next_track_idx = self.track_pool.choose()
+        track_idx = self.track_pool.take(self.next_track_idx)
+        self.record_played_track(track_idx)
+        log.debug(f'Playing track idx: {track_idx}')
         
         now_playing = self.track_info[track_idx]
         artist = self.track_artists[track_idx]
-        self.current_track_idx = track_idx
-        self.game_monitor.add_to_played_tracks(now_playing)
 
         print(f'\nNow playing: "{now_playing}" by "{artist}"\n')
         track_to_play = self.track_ids[track_idx]
         if not testmode:
             self.player.play_track(track_to_play)
+        self.choose_next_track(testmode)
+
+    def choose_next_track(self, testmode=False):
+        # Draws the next track ahead of time and queues it on the player. It is only
+        # taken from the track pool, and recorded as played, when it starts playing.
+        self.next_track_idx = self.track_pool.choose()
+        if self.next_track_idx is not None:
+            self.pending_events.append((journal_next, self.next_track_idx))
+            if not testmode:
+                self.player.queue_track(self.track_ids[self.next_track_idx])
+
+    def catch_up(self):
+        '''
+        Spotify starts the queued track by itself when the current track ends. This
+        records the queued track as played if that has happened.
+
+            returns:
+                True if the queued track had started
+        '''
+        queued_track_id = self.player.queued_track_id
+        if self.next_track_idx is None or queued_track_id != self.track_ids[self.next_track_idx]:
+            return False
+        track = self.sp.fresh('current_user_playing_track')
+        if not track or not track.get('item') or track['item']['id'] != queued_track_id:
+            return False
+
+        self.player.queued_track_id = None
+        track_idx = self.track_pool.take(self.next_track_idx)
+        self.record_played_track(track_idx)
+        print(f'\nNow playing: "{self.track_info[track_idx]}" by "{self.track_artists[track_idx]}"\n')
+        self.choose_next_track()
+        return True
+
+    def record_played_track(self, track_idx):
+        # Updates the game for a track that has been taken from the track pool
+        self.played_tracks.append(track_idx)
+        self.card_index.mark_track(track_idx)
+        self.current_track_idx = track_idx
+        self.game_monitor.add_to_played_tracks(self.track_info[track_idx])
+        self.pending_events.append((journal_draw, track_idx))
 
     def pause(self):
         self.player.pause_playback()
         self.paused_at_ms = self.currently_playing()[0]
+        self.pending_events.append((journal_pause, self.paused_at_ms))
 
     def resume(self):
         if self.paused_at_ms:
             track_to_resume = self.track_ids[self.current_track_idx]
             self.player.resume_track(track_to_resume, self.paused_at_ms)
             self.paused_at_ms = None
+            self.pending_events.append((journal_resume, 0))
         else:
             print('Nothing was paused, so cannot resume!')
 
@@ -639,13 +1782,54 @@ numbered 0 through {self.n_cards - 1}. Try again.')
 class ExitCmdException(Exception):
     pass 
 
+#-------------------------------------------------------------------
+# TrackPool class - Which of a game's tracks have been played. The
+# played state is one byte per track index, so checking a track is a
+# single lookup. The unplayed tracks are kept in a list along with the
+# position of each track in that list. A track is taken out by moving
+# the last entry into its place, so a random draw never searches.
+#-------------------------------------------------------------------
+class TrackPool():
+    def __init__(self, n_tracks, track_idxes):
+        self.played = bytearray(n_tracks)
+        self.unplayed = list(track_idxes)
+        self.positions = [-1] * n_tracks
+        for position, track_idx in enumerate(self.unplayed):
+            self.positions[track_idx] = position
+
+    def unplayed_count(self):
+        return len(self.unplayed)
+
+    def has_been_played(self, track_idx):
+        return self.played[track_idx] == 1
+
+    def choose(self):
+        # Choose a random unplayed track without taking it, or None if all have been played
+        if len(self.unplayed) == 0:
+            return None
+        return self.unplayed[random.randrange(len(self.unplayed))]
+
+    def take(self, track_idx):
+        position = self.positions[track_idx]
+        last_idx = self.unplayed.pop()
+        if last_idx != track_idx:
+            self.unplayed[position] = last_idx
+            self.positions[last_idx] = position
+        self.positions[track_idx] = -1
+        self.played[track_idx] = 1
+        return track_idx
+
+
 #-------------------------------------------------------------------
 # GameMonitor class - What's been played so far
 #-------------------------------------------------------------------
 class GameMonitor():
     def __init__(self):
+        # Track names are only kept to show the history of the game.
+        # Whether a track has been played is answered by the track pool.
         self.played_track_names = list()
         self.num_total_tracks = 0
+        self.track_pool = None
 
     def add_to_played_tracks(self, track_name):
         self.played_track_names.append(track_name)
@@ -653,11 +1837,11 @@ class GameMonitor():
     def set_total_tracks(self, num_total_tracks):
         self.num_total_tracks = num_total_tracks
 
-    def has_been_played(self, track_name):
-        if track_name in self.played_track_names:
-            return True
-        else:
-            return False
+    def set_track_pool(self, track_pool):
+        self.track_pool = track_pool
+
+    def has_been_played(self, track_idx):
+        return self.track_pool.has_been_played(track_idx)
 
     def show_played_tracks(self, active_game, replay_track, cmd_processor):
         num_played = len(self.played_track_names)
@@ -672,13 +1856,14 @@ class GameMonitor():
 {num_remaining} tracks are left to play.\n')
 
             if replay_track:
-                print('+++ request to replay a track: ',replay_track)
+                log.debug(f'request to replay a track: {replay_track}')
                 replay_index = int(replay_track)
                 if replay_index < num_played + 1 and replay_index >= 0:
                     if active_game:
                         replay_index = replay_index
-                        print (f'Replay index: {replay_index}')
+                        log.debug(f'Replay index: {replay_index}')
                         active_game.play_previous_track(replay_index) # was -1
+                        cmd_processor.track_changed()
 
                         # Since we are playing another track, clear out the
                         # votes that may have been cast to skip
@@ -693,35 +1878,84 @@ class GameMonitor():
             print('\nNo tracks have been played yet.\n')
 
 web_controller_url = os.environ['WEB_CONTROLLER_URL']
-print('Web controller url: ', web_controller_url)
+log.info(f'Web controller url: {web_controller_url}')
 # web_controller_url = 'http://svpserver5.ddns.net:8080'
 # web_controller_url = 'http://localhost:8080'
+
+# All calls to the web controller share one session so that the connection is kept
+# alive between calls instead of being made again for every request.
+web_session = requests.Session()
+
+# Seconds to wait for the web controller to connect and to respond. A slow web
+# controller should never hold up the command loop or the web monitor for long.
+web_timeout_sec = (3, 5)
+
+# Seconds between the web monitor's checks for votes and win claims
+web_poll_interval_sec = float(os.environ.get('MINGO_POLL_INTERVAL', '1'))
+
+# If MINGO_ENGINE_PORT is set, the engine listens on it for the web controller
+# to say that a win claim or enough votes are waiting (see MINGO_ENGINE_NOTIFY_URL
+# in mingo_web.py), and checks at once. Polling then only needs to catch notices
+# that were lost, so it slows to web_fallback_poll_interval_sec.
+engine_listen_port = os.environ.get('MINGO_ENGINE_PORT')
+engine_listen_host = os.environ.get('MINGO_ENGINE_HOST', '127.0.0.1')
+web_fallback_poll_interval_sec = float(os.environ.get('MINGO_FALLBACK_POLL_INTERVAL', '5'))
+
+# Seconds between the web monitor's checks for a queued track that Spotify started
+# by itself when the track before it ended. While autoadvance has a timer armed, the
+# timer checks near the end of the track instead.
+playback_check_interval_sec = 5
+
+#-------------------------------------------------------------------
+# WebMonitor class - Watches the web controller for votes to skip the
+# current track and for win claims. Each check is a single call to
+# /engine_poll, which returns the vote count and hands over all waiting
+# claims in one go. The monitor has its own session because it runs on
+# its own thread. With an EngineListener, the web controller wakes the
+# monitor as soon as there is something to check.
+#-------------------------------------------------------------------
 class WebMonitor():
-    def __init__(self, cmdprocessor, trigger_vote_count):
+    def __init__(self, cmdprocessor, trigger_vote_count, poll_interval_sec=None):
         self._running = False
         self._thread = None
         self._cmdprocessor = cmdprocessor
         self._trigger_vote_count = int(trigger_vote_count)
         self._voting_allowed = True
+        self._poll_interval_sec = poll_interval_sec or web_poll_interval_sec
+        self._listener = None
+        self._session = requests.Session()
+        self._wake = threading.Event()
+        self._error_shown = False
+        self._next_playback_check = 0
 
     def start(self):
         if not self._running:
-            # clear all stop requests before running the monitor
-            # otherwise 'old' stop requests can cause a track to start
-            # and stop immediately
-            requests.get(web_controller_url+'/clear')
-            print('trying to start WebMonitor')
+            log.debug('starting the WebMonitor')
             self._running = True
             self._voting_allowed = True
-            self._thread = threading.Thread(target=self._run)
+            self._wake.clear()
+            if engine_listen_port and self._listener is None:
+                try:
+                    self._listener = EngineListener(self.check_now, engine_listen_host, int(engine_listen_port))
+                except (OSError, ValueError) as e:
+                    log.warning(f'Cannot listen for the web controller on port {engine_listen_port}, '
+                                f'so only polling will be used: {e}')
+            self._thread = threading.Thread(target=self._run, daemon=True)
             self._thread.start()
-            print('should be started')
 
     
     def stop(self):
         self._running = False
+        self._wake.set()
         if self._thread is not None:
             self._thread.join()
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def check_now(self):
+        # Polls the web controller without waiting for the next regular poll
+        self._wake.set()
 
     def no_voting(self):
         self._voting_allowed = False
@@ -730,31 +1964,316 @@ class WebMonitor():
         self._voting_allowed = True
 
     def _run(self):
+        # clear all stop requests before running the monitor
+        # otherwise 'old' stop requests can cause a track to start
+        # and stop immediately
+        self._call(lambda: self._session.get(web_controller_url+'/clear', timeout=web_timeout_sec))
+
         while self._running:
-            # print('inside running')
-            if self._voting_allowed:
-                stop_count = int(requests.get(web_controller_url+'/get_stop_count').content)
+            with metrics.timed('web.engine_poll'):
+                response = self._call(lambda: self._session.get(web_controller_url+'/engine_poll', 
+                                                                timeout=web_timeout_sec))
+            poll_data = self._poll_data(response) if response is not None else None
+            if poll_data is not None:
+                win_claims, stop_count = poll_data
+                for card_to_check in win_claims:
+                    # self._cmdprocessor.do_pause(self._cmdprocessor)
+                    self._cmdprocessor.commands.submit(partial(self._cmdprocessor.do_verify, card_to_check))
+
+                stop_count = stop_count if self._voting_allowed else 0
+                if (self._voting_allowed and stop_count>=self._trigger_vote_count):
+                    self._call(lambda: self._session.get(web_controller_url+'/clear', 
+                                                        timeout=web_timeout_sec))
+                    self._cmdprocessor.skip_track()
+
+            if time.monotonic() >= self._next_playback_check:
+                self._next_playback_check = time.monotonic() + playback_check_interval_sec
+                if not self._cmdprocessor.auto_advance_armed():
+                    self._cmdprocessor.check_playback()
+
+            if self._listener is not None:
+                self._wake.wait(web_fallback_poll_interval_sec)
             else:
-                stop_count = 0
-            win_claims_json = requests.get(web_controller_url+'/win_claims')
-            win_claims = win_claims_json.json()["win_claims"]
-            # print(f"Claims : {win_claims}, length is {str(len(win_claims))}")
-            claim_idx = 0
-            while len(win_claims) > 0:
-                card_to_check = win_claims[claim_idx]
-                # print(f"Processing claim for card {win_claims[claim_idx]}")
-                win_claims.remove(win_claims[claim_idx])
-                # print(f"There are {len(win_claims)} items in claim list")
-                # self._cmdprocessor.do_pause(self._cmdprocessor)
-                self._cmdprocessor.do_view(card_to_check)
-            
-            # print(stop_count)
-            if (self._voting_allowed and stop_count>=self._trigger_vote_count):
-                requests.get(web_controller_url+'/clear')
-                self._cmdprocessor.do_nexttrack(self._cmdprocessor)
-            time.sleep(1)
+                self._wake.wait(self._poll_interval_sec)
+            self._wake.clear()
+
+    def _poll_data(self, response):
+        # The win claims and stop count from an /engine_poll response, or None if the
+        # response is not what the web controller sends, such as a proxy's error page
+        try:
+            poll_data = response.json()
+            return poll_data["win_claims"], poll_data["stop_count"]
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning(f'The web controller sent an /engine_poll response that could not be read: {e!r}')
+            return None
+
+    def _call(self, web_request):
+        # Makes a request to the web controller. If it fails, say so once and
+        # carry on with the next check rather than ending the monitor.
+        try:
+            response = web_request()
+            response.raise_for_status()
+            if self._error_shown:
+                log.warning('The web monitor can reach the web controller again.')
+                self._error_shown = False
+            return response
+        except requests.RequestException as e:
+            if not self._error_shown:
+                log.warning(f'The web monitor cannot reach the web controller: {e}')
+                self._error_shown = True
+            return None
+
+
+
+#-------------------------------------------------------------------
+# EngineListener class - A small HTTP server on its own threads. A POST
+# to /notify from the web controller calls on_notify, which wakes the 
+# web monitor. The notice carries nothing: the monitor fetches the
+# claims and votes with its usual poll, so a lost or repeated notice 
+# does no harm.
+#-------------------------------------------------------------------
+class EngineListener():
+    def __init__(self, on_notify, host, port):
+        class NotifyHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.path != '/notify':
+                    self.send_error(404)
+                    return
+                on_notify()
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                log.debug(f'Engine listener: {format % args}')
+
+        self._server = ThreadingHTTPServer((host, port), NotifyHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        log.info(f'Listening for the web controller on {host}:{port}')
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+#-------------------------------------------------------------------
+# AutoAdvance class - Plays the next track when the current one ends,
+# or after a set number of seconds, without anyone typing nexttrack.
+# When a track starts, its start time and duration are recorded and a
+# timer is armed. Spotify is not polled while the track plays: it is
+# asked once, auto_advance_check_sec before the deadline, how far the
+# track has really got, and the final timer is set from its answer.
+# The clock and the timer are parameters so that the scheduler can be
+# driven by a fake clock.
+#-------------------------------------------------------------------
+auto_advance_check_sec = 10
+
+# Advance this long before a track ends, so that the next track is started by
+# the game rather than by Spotify moving on to the queued track by itself
+auto_advance_lead_sec = 0.5
+
+class AutoAdvance():
+    def __init__(self, advance, playback, on_track_changed, limit_sec=None, 
+                 clock=time.monotonic, timer=threading.Timer):
+        '''
+            parameters:
+                advance: Called with no arguments to play the next track
+                playback: Called with no arguments to get what Spotify is playing, as a
+                          (track id, progress ms, is playing) tuple, or None
+                on_track_changed: Called when Spotify is found playing another track
+                limit_sec: Advance after this many seconds even if the track has not ended
+                clock: Returns the time in seconds
+                timer: Makes a timer as threading.Timer(delay, function) does
+        '''
+        self._advance = advance
+        self._playback = playback
+        self._on_track_changed = on_track_changed
+        self.limit_sec = limit_sec
+        self._clock = clock
+        self._make_timer = timer
+        self._lock = threading.Lock()
+        self._timer = None
+        self._track_id = None
+        self._duration_sec = None
+        self._started_at = None
+
+    def track_started(self, track_id, duration_ms, position_ms=0):
+        # Arms the timer for a track that has just started playing at position_ms
+        with self._lock:
+            self._track_id = track_id
+            self._duration_sec = duration_ms / 1000 if duration_ms else None
+            self._started_at = self._clock() - position_ms / 1000
+            self._arm()
+
+    def cancel(self):
+        with self._lock:
+            self._track_id = None
+            self._cancel_timer()
+
+    def armed(self):
+        # True while a timer will advance the current track
+        with self._lock:
+            return self.deadline() is not None
+
+    def deadline(self):
+        # The clock time the current track will be advanced at, or None
+        if self._track_id is None:
+            return None
+        play_sec = self._duration_sec - auto_advance_lead_sec if self._duration_sec else None
+        if self.limit_sec is not None and (play_sec is None or self.limit_sec < play_sec):
+            play_sec = self.limit_sec
+        return None if play_sec is None else self._started_at + play_sec
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _arm(self):
+        self._cancel_timer()
+        deadline = self.deadline()
+        if deadline is None:
+            return
+        delay = deadline - self._clock()
+        if delay > auto_advance_check_sec:
+            self._start_timer(delay - auto_advance_check_sec, self._check, self._track_id)
+        else:
+            self._start_timer(max(delay, 0), self._fire, self._track_id)
+
+    def _start_timer(self, delay, function, track_id):
+        self._timer = self._make_timer(delay, lambda: function(track_id))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _check(self, track_id):
+        # Near the deadline: correct the start time from Spotify's progress
+        playback = self._playback()
+        with self._lock:
+            if track_id != self._track_id:
+                return
+            if playback is None or playback[0] != track_id:
+                self._track_id = None
+                changed = True
+            else:
+                changed = False
+                _, progress_ms, is_playing = playback
+                self._started_at = self._clock() - progress_ms / 1000
+                if is_playing:
+                    deadline = self.deadline()
+                    self._start_timer(max(deadline - self._clock(), 0), self._fire, track_id)
+                else:
+                    # Paused in Spotify, so look again later
+                    self._start_timer(auto_advance_check_sec, self._check, track_id)
+        if changed:
+            self._on_track_changed()
+
+    def _fire(self, track_id):
+        with self._lock:
+            if track_id != self._track_id:
+                return
+            self._track_id = None
+            self._timer = None
+        self._advance()
+
+
+#-------------------------------------------------------------------
+# CommandQueue class - Runs every command that changes the game, one at
+# a time, on the queue's own thread. Typed commands, the web monitor and
+# the auto advance timer all hand their work to the queue instead of 
+# using the game from their own threads. At most engine_queue_size 
+# commands wait at once; after that, callers wait for room. A command
+# given a key that matches one still waiting or running is not queued 
+# again, so a skip voted on the web and a skip typed at the same time
+# draw one track, not two.
+#-------------------------------------------------------------------
+engine_queue_size = 32
+
+# Seconds that a background thread waits for room in the queue before giving
+# up on its command
+engine_submit_timeout_sec = 5
+
+# Typed commands that are not run again if the same command is already waiting
+queued_once_commands = {'nexttrack'}
+
+class CommandQueue():
+    def __init__(self, max_waiting=engine_queue_size):
+        self._queue = queue.Queue(max_waiting)
+        self._lock = threading.Lock()
+        # key -> SharedCall for keyed commands that are waiting or running
+        self._pending = dict()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def call(self, function, key=None):
+        '''
+        Runs a command on the queue's thread and waits for it.
+
+            parameters:
+                function: Called with no arguments to do the command
+                key: Commands with the same key that are already waiting or running 
+                     are not repeated. The answer of the earlier command is returned.
+
+            returns:
+                What function returns. An exception it raises is raised here.
+        '''
+        if threading.current_thread() is self._thread:
+            return function()
+        return self._put(function, key, None, False).wait()
+
+    def submit(self, function, key=None, timeout=engine_submit_timeout_sec):
+        # Queues a command without waiting for it. Returns False if the queue stayed full.
+        try:
+            self._put(function, key, timeout, True)
+            return True
+        except queue.Full:
+            log.warning(f'The game is too busy, so {command_name(function)} was dropped')
+            return False
 
+    def waiting(self):
+        return self._queue.qsize()
+
+    def _put(self, function, key, timeout, log_errors):
+        with self._lock:
+            shared_call = self._pending.get(key) if key is not None else None
+            if shared_call is not None:
+                metrics.record('engine.coalesced.' + key, 0)
+                return shared_call
+            shared_call = SharedCall()
+            if key is not None:
+                self._pending[key] = shared_call
+        try:
+            self._queue.put((function, key, shared_call, time.perf_counter(), log_errors), timeout=timeout)
+        except queue.Full:
+            if key is not None:
+                with self._lock:
+                    del self._pending[key]
+            raise
+        return shared_call
 
+    def _run(self):
+        while True:
+            function, key, shared_call, queued_at, log_errors = self._queue.get()
+            metrics.record('engine.queue_wait', time.perf_counter() - queued_at)
+            try:
+                shared_call.answer = function()
+            except BaseException as e:
+                shared_call.error = e
+                # Nobody waits for a submitted command, so its errors are shown here
+                if log_errors:
+                    log.warning(f'{command_name(function)} failed: {e}')
+            finally:
+                # The key is only released after the command has run, because a 
+                # duplicate that arrives while it runs was meant for the same track
+                if key is not None:
+                    with self._lock:
+                        del self._pending[key]
+                shared_call.done.set()
+
+def command_name(function):
+    # The name of a queued command's function, looking inside a partial
+    return getattr(getattr(function, 'func', function), '__name__', 'a command')
 
 
 #-------------------------------------------------------------------
@@ -775,28 +2294,39 @@ class CommandProcessor(cmd.Cmd):
         self.pl = Playlist(spotify.sp)
         self.player = Player(spotify.sp)
 
+        # Every command runs on the command queue's thread
+        self.commands = CommandQueue()
+
         # Start by displaying the available playlists
         self.do_playlists()
 
         self.web_monitor = None 
+        self.auto_advance = None
+
+    def onecmd(self, line):
+        # Typed commands wait their turn behind commands from the web monitor and timers
+        command = self.parseline(line)[0]
+        key = command if command in queued_once_commands else None
+        return self.commands.call(partial(cmd.Cmd.onecmd, self, line), key)
+
+    def skip_track(self):
+        # Asks for the next track from a background thread
+        self.commands.submit(partial(self.do_nexttrack, None), key='nexttrack')
+
+    def check_playback(self):
+        # Asks for sync_playback from a background thread
+        self.commands.submit(self.sync_playback, key='sync_playback')
 
     def do_countplayers(self, _):
-        player_count = int(requests.get(web_controller_url+'/get_player_count').content)
+        player_count = int(web_session.get(web_controller_url+'/get_player_count', timeout=web_timeout_sec).content)
         print(f'There are {player_count} active players.')
 
     def do_webload(self, _):
         if self.active_game:
             print(f'Loading {self.active_game.n_cards} cards made from {self.active_game.playlist_name} to web controller')
-            for card_nbr in range(self.active_game.n_cards):
-                requests.post(web_controller_url+'/card_load',
-                                json=self.active_game.cards[card_nbr].as_json(card_nbr))
-
-            misc_data = {"playlist_name": self.active_game.playlist_name, 
-                        "number_of_players": str(self.active_game.n_cards),
-                        "refresh_flag": True}
-
-            requests.post(web_controller_url+'/game_misc_data',
-                                json=json.dumps(misc_data))
+            cards = [{"card_nbr": card_nbr, "titles": self.active_game.cards[card_nbr].sheet}
+                        for card_nbr in range(self.active_game.n_cards)]
+            post_web_cards(cards, self.active_game.playlist_name)
         else:
             print('There is not an active game. Create one using "makegame" and try again.')  
 
@@ -805,17 +2335,9 @@ class CommandProcessor(cmd.Cmd):
             print(f'Unloading {self.active_game.n_cards} cards made from web controller')
 
             # Make an empty card for each player
-            for card_nbr in range(self.active_game.n_cards):
-                empty_card = empty_card_json(card_nbr)
-                requests.post(web_controller_url+'/card_load',
-                                json=empty_card)
-
-            misc_data = {"playlist_name": self.active_game.playlist_name, 
-                        "number_of_players": str(self.active_game.n_cards),
-                                "refresh_flag": True}
-
-            requests.post(web_controller_url+'/game_misc_data',
-                                json=json.dumps(misc_data))
+            cards = [{"card_nbr": card_nbr, "titles": ["-" for _ in range(gridsize**2)]}
+                        for card_nbr in range(self.active_game.n_cards)]
+            post_web_cards(cards, self.active_game.playlist_name)
         else:
             print('There is not an active game. Create one using "makegame" and try again.')  
 
@@ -854,20 +2376,22 @@ class CommandProcessor(cmd.Cmd):
                 # Send next_trigger_votes to web controller so it will update
                 # this on each user screen
                 votes_required = {"votes_required": next_trigger_votes}
-                requests.post(web_controller_url+'/set_votes_required',
-                                    json=json.dumps(votes_required))
+                web_session.post(web_controller_url+'/set_votes_required',
+                                    json=json.dumps(votes_required),
+                                    timeout=web_timeout_sec)
 
             elif next_trigger_votes and int(next_trigger_votes) <= 0:
                 if next_trigger_votes == 0:
-                    print('Zero trigger votes')
+                    log.debug('Zero trigger votes')
                 else:
-                    print(f'{next_trigger_votes} requested')
+                    log.debug(f'{next_trigger_votes} requested')
 
                 # Send the zero to the web controller to block further voting
                 # and to update the info on each user screen
                 votes_required = {"votes_required": next_trigger_votes}
-                requests.post(web_controller_url+'/set_votes_required',
-                                    json=json.dumps(votes_required))
+                web_session.post(web_controller_url+'/set_votes_required',
+                                    json=json.dumps(votes_required),
+                                    timeout=web_timeout_sec)
 
                 # Even when not voting we want the 'Winner' button to work, so
                 # start the monitor if not running already to keep track of Winner claims.
@@ -884,7 +2408,9 @@ class CommandProcessor(cmd.Cmd):
 
     """Process commands related to Spotify playlist management for the game of MINGO """
     def do_playlists(self, sub_command=None):
-        """Display all Spotify playlists for the authorized Spotify user."""
+        """Display all Spotify playlists for the authorized Spotify user. makegame and \
+showlist look the playlist up in Spotify again each time, so changes made in Spotify \
+are picked up without running this first."""
         playlists = self.pl.get_playlists()
         print('\nThese are your playlists:')
         for k in playlists.keys():
@@ -899,33 +2425,62 @@ or issue the ''continuegame'' command to restart an old game.')
         else:
             print('You must enter the number of a playlist to show its tracks')
     
+    def do_duplicates(self, threshold):
+        """Show the tracks of the last playlist that were left out because their names are \
+the same as, or very similar to, another track. Enter a number between 0 and 1 to change \
+how similar names must be (1 means only names that are the same once cleaned up)."""
+        if threshold:
+            if not 0 < float(threshold) <= 1:
+                print('The similarity must be more than 0 and at most 1.')
+                return
+            self.pl.title_index.threshold = float(threshold)
+            print(f'Track names at least {float(threshold):.2f} similar will be left out \
+the next time a playlist is read.')
+        else:
+            self.pl.show_duplicates()
+
     def do_userinfo(self, line):
         """Show the name of the signed-on Spotify user whose playlists are to be used to generate Mingo games."""
         print(self.pl.sp.me()['display_name'])
 
     def do_makegame(self, options):
-        """Use the currently active playlist to generate a specified number of Mingo cards."""
+        """Use the currently active playlist to generate a specified number of Mingo cards. \
+Enter the playlist number, then the number of cards. Add seed=<number> to make \
+the same cards again from the same playlist. Add unique so that no two cards share \
+a winning row, column or diagonal."""
         num_cards = 10
         playlist_num = -1
         if not options:
             print('You did not enter a playlist number to use for this game. Try again.')
             return
         else:
-            arg_list = options.split(' ')
+            arg_list = options.split()
+            seed = None
+            unique_lines = False
+            for option in arg_list[2:]:
+                if option.startswith('seed='):
+                    seed = int(option[len('seed='):])
+                elif option == 'unique':
+                    unique_lines = True
+                else:
+                    print(f'Unknown makegame option {option}')
+                    return
+
             if len(arg_list) == 1:
                 playlist_num = int(arg_list[0])
-            elif len(arg_list) == 2:
+            elif len(arg_list) >= 2:
                 playlist_num = int(arg_list[0])
                 num_cards = int(arg_list[1])
             
             self.pl.process_playlist(playlist_num, True)
 
         try:
-            self.active_game = Game(num_cards, self.sp, self.player)
+            self.active_game = Game(num_cards, self.sp, self.player, seed, unique_lines)
+            self.cancel_auto_advance()
 
             # Save the game state before any songs are played. Then if the
             # user quits immediately, the unplayed game can be continued.
-            self.active_game.write_game_state()
+            self.active_game.write_game_state(full_snapshot=True)
             self.prompt = f'\033[97m({self.active_game.playlist_name}'+self.auto_cmd+self.end_highlight
             print(f'A new game has been made with {num_cards} cards.')
             print('\nYou can use the "view" command to display and print the Mingo cards for this game.')
@@ -939,7 +2494,8 @@ saved. Use this command to resume playing a stopped game from when you stopped i
         """
 
         try:
-            self.active_game = restore_game_state()
+            self.active_game = restore_game_state(self.sp, self.player)
+            self.cancel_auto_advance()
             self.prompt = f'\033[97m({self.active_game.playlist_name}'+self.auto_cmd+self.end_highlight
             print('The previous game state has been restored. You can continue playing it now.')
 
@@ -949,12 +2505,162 @@ saved. Use this command to resume playing a stopped game from when you stopped i
     def do_view(self, card_num=None):
         """Specify a card number to view a single Mingo card from the active Mingo game. \
 If no number is specified, all cards are displayed."""
-        print("viewing card: ", card_num)
+        log.debug(f'viewing card: {card_num}')
         if self.active_game:
             self.active_game.view_in_browser(card_num)
         else:
             print('There is not an active game. Create one using "makegame" and try again.')  
 
+    def do_verify(self, card_num):
+        """Check whether a card is a winner using the tracks played so far. The result is \
+sent to the player holding the card. Use view to see the card itself."""
+        # Card 0 is a real card, so only a missing number is refused
+        if card_num is None or str(card_num).strip() == '':
+            print('You must enter the number of the card to verify.')
+        elif self.active_game:
+            try:
+                winning_lines = self.active_game.verify_claim(int(card_num))
+            except Exception as error:
+                print(error)
+                return
+
+            if len(winning_lines) > 0:
+                print(f'Card {card_num} is a WINNER with {", ".join(winning_lines)}')
+            else:
+                print(f'Card {card_num} is not a winner yet.')
+
+            claim_result = {"card_nbr": str(card_num), 
+                            "verified": len(winning_lines) > 0,
+                            "lines": winning_lines}
+            web_session.post(web_controller_url+'/claim_result',
+                                json=json.dumps(claim_result),
+                                timeout=web_timeout_sec)
+        else:
+            print('There is not an active game. Create one using "makegame" and try again.')  
+
+    def do_winpatterns(self, pattern_names):
+        """Show the win patterns that claims are checked against. To change them, enter \
+pattern names separated by spaces, for example: winpatterns rows columns diagonals"""
+        if not self.active_game:
+            print('There is not an active game. Create one using "makegame" and try again.')  
+            return
+
+        if pattern_names:
+            requested = pattern_names.split()
+            unknown = [name for name in requested if name not in win_patterns]
+            if len(unknown) > 0:
+                print(f'Unknown win patterns: {", ".join(unknown)}')
+                return
+            self.active_game.win_pattern_names = requested
+            self.active_game.write_game_state(full_snapshot=True)
+
+        print(f'Available win patterns: {", ".join(win_patterns.keys())}')
+        print(f'Claims are checked against: {", ".join(self.active_game.win_pattern_names)}')
+
+    def do_leaders(self, n_leaders):
+        """Show the cards that are closest to winning. Enter a number to change how many \
+cards are listed (10 by default)."""
+        if self.active_game:
+            n_leaders = int(n_leaders) if n_leaders else 10
+            card_index = self.active_game.card_index
+            print(f'\n{len(self.active_game.played_tracks)} tracks have been played.')
+            for need, count in enumerate(card_index.need_counts()):
+                if count > 0:
+                    print(f'{count} cards need {need} more')
+            print(f'\nThe {n_leaders} cards closest to winning:')
+            for card_nbr, need in card_index.leaders(n_leaders):
+                print(f'Card {card_nbr} needs {need} more')
+            print()
+        else:
+            print('There is not an active game. Create one using "makegame" and try again.')
+
+    def do_simulate(self, options):
+        """Play many games without Spotify to see how long games last. Options are \
+tracks=<number of usable tracks>, cards=<number of cards>, games=<number of games to play>, \
+patterns=<win patterns separated by commas>, prizes=<winning cards that end a game>, \
+minutes=<average minutes per track>, seed=<number> and unique. Tracks, cards and patterns \
+default to those of the active game."""
+        settings = {'tracks': None, 'cards': None, 'games': 10000, 'patterns': None,
+                    'prizes': 1, 'minutes': simulation_track_minutes, 'seed': None}
+        unique_lines = False
+        for option in (options or '').split():
+            name, _, value = option.partition('=')
+            if option == 'unique':
+                unique_lines = True
+            elif name in settings and value:
+                settings[name] = value
+            else:
+                print(f'Unknown simulate option {option}')
+                return
+
+        if self.active_game:
+            settings['tracks'] = settings['tracks'] or len(self.active_game.track_ids)
+            settings['cards'] = settings['cards'] or self.active_game.n_cards
+            settings['patterns'] = settings['patterns'] or ','.join(self.active_game.win_pattern_names)
+        if settings['tracks'] is None or settings['cards'] is None:
+            print('There is not an active game, so enter the number of tracks and cards, e.g. "simulate tracks=300 cards=50".')
+            return
+        pattern_names = (settings['patterns'] or ','.join(default_win_patterns)).split(',')
+        unknown = [pattern_name for pattern_name in pattern_names if pattern_name not in win_patterns]
+        if len(unknown) > 0:
+            print(f'Unknown win patterns: {", ".join(unknown)}')
+            return
+
+        try:
+            n_tracks = int(settings['tracks'])
+            n_cards = int(settings['cards'])
+            n_games = int(settings['games'])
+            prizes = int(settings['prizes'])
+            track_minutes = float(settings['minutes'])
+            seed = int(settings['seed']) if settings['seed'] is not None else None
+            start = time.perf_counter()
+            results = simulate_game_lengths(n_tracks, n_cards, n_games, pattern_names,
+                                            unique_lines, prizes, seed)
+            elapsed = time.perf_counter() - start
+        except Exception as error:
+            print(error)
+            return
+
+        print(f'\nPlayed {n_games} games of {n_cards} cards from {n_tracks} tracks, winning with '
+              f'{", ".join(pattern_names)}, in {elapsed:.1f} sec ({n_games / elapsed:.0f} games per sec).')
+        first_wins = sorted(first_win for first_win, _, _ in results if first_win is not None)
+        if len(first_wins) == 0:
+            print('No card won in any game.\n')
+            return
+        print('\nTracks played until the first winner:')
+        print_distribution(first_wins, track_minutes)
+
+        print('\nCards winning on the same track as the first winner:')
+        simultaneous_counts = dict()
+        for first_win, simultaneous, _ in results:
+            if first_win is not None:
+                simultaneous_counts[min(simultaneous, 4)] = simultaneous_counts.get(min(simultaneous, 4), 0) + 1
+        for simultaneous, count in sorted(simultaneous_counts.items()):
+            label = f'{simultaneous} or more' if simultaneous == 4 else str(simultaneous)
+            print(f'{label:>10}: {100 * count / len(first_wins):5.1f}% of games')
+
+        if prizes > 1:
+            game_lengths = sorted(game_length for _, _, game_length in results if game_length is not None)
+            print(f'\nTracks played until {prizes} cards have won:')
+            if len(game_lengths) > 0:
+                print_distribution(game_lengths, track_minutes)
+            if len(game_lengths) < len(results):
+                print(f'{len(results) - len(game_lengths)} games ran out of tracks before {prizes} cards won.')
+        print()
+
+    def do_stats(self, _):
+        """Show how many times the slow operations (Spotify calls, making cards and QR codes, \
+writing game state, calls to the web controller) have run and how long they took."""
+        summary = metrics.summary()
+        if len(summary) == 0:
+            print('Nothing has been timed yet.')
+            return
+        print(f'\n{"operation":<32}{"count":>8}{"total ms":>12}{"mean ms":>10}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+        for name, timing in summary.items():
+            print(f'{name:<32}{timing["count"]:>8}{timing["total_ms"]:>12.1f}{timing["mean_ms"]:>10.1f}'
+                  f'{timing["p50_ms"]:>10.1f}{timing["p99_ms"]:>10.1f}{timing["max_ms"]:>10.1f}')
+        print()
+
     def do_getinfo(self, _):
         """Display info about the currently active game."""
         if self.active_game:
@@ -962,12 +2668,26 @@ If no number is specified, all cards are displayed."""
         else:
            print('There is not an active game. Create one using "'"makegame"'" and try again.')  
 
+    def sync_playback(self):
+        # Records the queued track as played if Spotify has moved on to it by itself
+        if self.active_game and self.active_game.catch_up():
+            self.active_game.write_game_state()
+            self.track_changed()
+            clear_web_votes(self)
+            post_web_leaders(self)
+
     def do_nexttrack(self, _):
         """Play a randomly selected track from the active Mingo game."""
         if self.active_game:
+            n_played = len(self.active_game.played_tracks)
             self.active_game.play_next_track()
             self.active_game.write_game_state()
+            if len(self.active_game.played_tracks) > n_played:
+                self.track_changed()
+            else:
+                self.cancel_auto_advance()
             clear_web_votes(self)
+            post_web_leaders(self)
 
         else:
            print('There is not an active game. Create one using "'"makegame"'" and try again.')  
@@ -988,6 +2708,7 @@ If no number is specified, all cards are displayed."""
             # Never pause when already paused! A player exception results!
             if self.active_game.currently_playing()[1]:
                 self.active_game.pause()
+            self.cancel_auto_advance()
             # print ("after pause currently playing: ", self.active_game.currently_playing())
             resume_at = self.active_game.currently_playing()[0]
             self.active_game.write_game_state()
@@ -998,10 +2719,72 @@ If no number is specified, all cards are displayed."""
     def do_resume(self,_):
         """If a song has been paused, this command resumes playing the song."""
         if self.active_game:
+            resume_at = self.active_game.paused_at_ms
             self.active_game.resume()
+            if resume_at:
+                self.track_changed(resume_at)
         else:
                print('There is not an active game. Create one using "'"makegame"'" and try again.')  
 
+    def do_autoadvance(self, option):
+        """Play the next track automatically. Use "autoadvance on" to move on when each track
+        ends, "autoadvance 45" to move on after 45 seconds (or sooner if the track ends first),
+        or "autoadvance off" to go back to using nexttrack."""
+        option = option.strip().lower()
+        if option == 'off':
+            self.cancel_auto_advance()
+            self.auto_advance = None
+            print('Tracks will only change when you use nexttrack.')
+            return
+
+        if option == 'on':
+            limit_sec = None
+        else:
+            try:
+                limit_sec = float(option)
+            except ValueError:
+                print('Use "autoadvance on", "autoadvance off", or the number of seconds to play each track.')
+                return
+            if limit_sec <= 0:
+                print('The number of seconds to play each track must be more than zero.')
+                return
+
+        if self.auto_advance:
+            self.auto_advance.limit_sec = limit_sec
+        else:
+            self.auto_advance = AutoAdvance(self.skip_track, self.spotify_playback, 
+                                            self.check_playback, limit_sec)
+        if limit_sec is None:
+            print('The next track will play when each track ends.')
+        else:
+            print(f'The next track will play after {limit_sec:g} seconds, or when the track ends if that is sooner.')
+        if self.active_game and self.active_game.current_track_idx is not None:
+            progress, is_playing = self.active_game.currently_playing()
+            if is_playing:
+                self.track_changed(progress)
+
+    def spotify_playback(self):
+        # What Spotify is playing, as (track id, progress ms, is playing), or None.
+        # The cache is skipped because the progress is used to time the next track.
+        track = self.sp.fresh('current_user_playing_track')
+        if not track or not track.get('item'):
+            return None
+        return track['item']['id'], track['progress_ms'], track['is_playing']
+
+    def track_changed(self, position_ms=0):
+        # Arms the auto advance timer for the game's current track
+        if self.auto_advance and self.active_game:
+            track_idx = self.active_game.current_track_idx
+            self.auto_advance.track_started(self.active_game.track_ids[track_idx], 
+                                            self.active_game.track_durations[track_idx], position_ms)
+
+    def cancel_auto_advance(self):
+        if self.auto_advance:
+            self.auto_advance.cancel()
+
+    def auto_advance_armed(self):
+        return self.auto_advance is not None and self.auto_advance.armed()
+
     def do_musicplayers(self, _):
         """List the music players that Spotify can use to play tracks. The first such player
         that is marked 'Active' in Spotify is selected to play your songs."""
@@ -1033,6 +2816,7 @@ If no number is specified, all cards are displayed."""
             for idx in range(0,int(autoplay_count)):
                 self.active_game.play_next_track(True)
             self.active_game.write_game_state()
+            post_web_leaders(self)
         else:
            print('There is not an active game. Create one using "'"makegame"'" and try again.')  
 
@@ -1067,7 +2851,8 @@ If no number is specified, all cards are displayed."""
             print('Error: You must supply an argument with the load number for the game to load')
         else:
             try:
-                self.active_game = load_game_state(load_number)
+                self.active_game = load_game_state(load_number, self.sp, self.player)
+                self.cancel_auto_advance()
                 self.prompt = f'\033[97m({self.active_game.playlist_name}'+self.auto_cmd+self.end_highlight
                 print('A saved game state has been restored. You can continue playing it now.')
 
@@ -1078,20 +2863,22 @@ If no number is specified, all cards are displayed."""
 #-----------------------------------------
 # Global function definitions follow below
 #-----------------------------------------
-def empty_card_json(card_nbr):
-    song_titles = []
-    for _ in range(25):
-        song_titles.append("-")
-    
-    # Create a dictionary to structure the data
-    print("===================================")
-    print("unloading card number: ", card_nbr)
-    data = {"card_nbr": card_nbr, "songs": [{"id": i + 1, "title": title} for i, title in enumerate(song_titles)]}
-    ret_json = json.dumps(data)
-    print("===================================")
-    
-    # Convert the dictionary to a JSON string
-    return ret_json # , indent=4)
+@timed('web.cards_bulk')
+def post_web_cards(cards, playlist_name):
+    # Send every card to the web controller in a single gzip compressed request,
+    # along with the data that tells player browsers to refresh.
+    bulk_data = {"cards": cards,
+                 "playlist_name": playlist_name, 
+                 "number_of_players": str(len(cards)),
+                 "refresh_flag": True}
+    body = gzip.compress(json.dumps(bulk_data).encode('utf-8'))
+    response = web_session.post(web_controller_url+'/cards_bulk',
+                                data=body,
+                                headers={'Content-Type': 'application/json',
+                                         'Content-Encoding': 'gzip'},
+                                timeout=web_timeout_sec)
+    response.raise_for_status()
+    print(f'The web controller loaded {len(cards)} cards')
 
 
 def display_player_exception(e):
@@ -1109,24 +2896,46 @@ def display_general_exception(e):
         print(f'\n{exception_name}:\nAn unexpected error occurred.')
 
 def cleanup_before_exiting(command_processor):
+    command_processor.cancel_auto_advance()
     if command_processor.active_game and command_processor.active_game.currently_playing()[1]:
         command_processor.active_game.pause()
     if command_processor.web_monitor:
         command_processor.web_monitor.stop()
 
-def restore_game_state():
-    print(f'\nRestoring from file {game_state_pathname}')
-    path = Path(game_state_pathname)
-    with open (path, 'rb') as fp:
-        restored_game = pickle.load(fp)
+@timed('write_snapshot')
+def write_snapshot(snapshot, pathname):
+    # Write to a temporary file first so that a crash never leaves half a snapshot
+    path = Path(pathname)
+    temp_path = Path(pathname+'.tmp')
+    with open(temp_path, 'w') as fp:
+        json.dump(snapshot, fp, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+def read_game_state(snapshot_pathname, journal_pathname, sp, musicplayer):
+    with open(Path(snapshot_pathname), 'r') as fp:
+        restored_game = Game.from_snapshot(json.load(fp), sp, musicplayer)
+
+    if journal_pathname and Path(journal_pathname).exists():
+        with open(Path(journal_pathname), 'rb') as fp:
+            journal = fp.read()
+        # Ignore a partly written record at the end of the journal
+        journal = journal[:len(journal) - len(journal) % journal_record.size]
+        for event, value in journal_record.iter_unpack(journal):
+            restored_game.apply_event(event, value)
+        restored_game.journal_length = len(journal) // journal_record.size
     return restored_game
 
-def load_game_state(load_number):
-    saved_game_pathname = './.saved_game_'+load_number+'.bin'
+def restore_game_state(sp, musicplayer):
+    print(f'\nRestoring from file {game_state_pathname}')
+    return read_game_state(game_state_pathname, game_journal_pathname, sp, musicplayer)
+
+def load_game_state(load_number, sp, musicplayer):
+    saved_game_pathname = './.saved_game_'+load_number+'.json'
     print(f'\nRestoring from file {saved_game_pathname}')
-    path = Path(saved_game_pathname)
-    with open (path, 'rb') as fp:
-        restored_game = pickle.load(fp)
+    restored_game = read_game_state(saved_game_pathname, None, sp, musicplayer)
+
+    # The loaded game becomes the current game, so start its journal over
+    restored_game.write_game_state(full_snapshot=True)
     return restored_game
 
 def clear_web_votes(cmd_processor):
@@ -1134,9 +2943,28 @@ def clear_web_votes(cmd_processor):
         # We are monitoring user votes to skip but we have told the game to
         # start a new track.
         # Reset the number of votes to skip to zero because a new song is playing.
-        requests.get(web_controller_url+'/clear')
+        web_session.get(web_controller_url+'/clear', timeout=web_timeout_sec)
+
 
 
+def print_distribution(track_counts, track_minutes):
+    # Prints the mean and percentiles of a sorted list of track counts, in tracks and minutes
+    mean = sum(track_counts) / len(track_counts)
+    print(f'{"mean":>10}: {mean:6.1f} tracks, {mean * track_minutes:6.0f} minutes')
+    for label, fraction in (('10%', 0.1), ('median', 0.5), ('90%', 0.9), ('99%', 0.99)):
+        tracks = track_counts[min(len(track_counts) - 1, int(fraction * len(track_counts)))]
+        print(f'{label:>10}: {tracks:6d} tracks, {tracks * track_minutes:6.0f} minutes')
+
+def post_web_leaders(cmd_processor, n_leaders=20):
+    if cmd_processor.web_monitor and cmd_processor.web_monitor._running:
+        # Keep the web controller's leaderboard in step with the game
+        card_index = cmd_processor.active_game.card_index
+        leaders = {"leaders": [{"card_nbr": card_nbr, "need": need} 
+                                    for card_nbr, need in card_index.leaders(n_leaders)],
+                   "need_counts": card_index.need_counts()}
+        web_session.post(web_controller_url+'/leaders',
+                            json=json.dumps(leaders),
+                            timeout=web_timeout_sec)
 
 
 #-----------------------------------------
@@ -1153,14 +2981,17 @@ if __name__ == '__main__':
         try:
             if cp is None:
                 cp = CommandProcessor()
-                cp.do_auto('-1')
+                cp.commands.call(partial(cp.do_auto, '-1'))
             cp.cmdloop()
         except KeyboardInterrupt:
             print('Interrupted by ctrl-C, attempting to clean up first')
             try:
-                cleanup_before_exiting(cp)
+                # Cleaning up waits its turn on the command queue, so a command
+                # that is already running or waiting finishes first. A second
+                # ctrl-C while waiting exits at once.
+                cp.commands.call(partial(cleanup_before_exiting, cp))
                 sys.exit(0)
-            except SystemExit:
+            except (SystemExit, KeyboardInterrupt):
                 os._exit(0)
         except Exception as e:
             exception_name = e.__class__.__name__
@@ -0,0 +1,842 @@
+"""
+Checks and timings of the game engine that run without Spotify.
+
+Spotify is replaced by a stub client that counts the calls made to it, and
+each check runs in a temporary directory so that the engine's cache and game
+files are left alone. Checks that need the web controller start their own
+copy of ../web_control/mingo_web.py on a free local port, and are skipped if
+it can't be started, for example because Flask is not installed. Timings are
+printed under the check's name. Run all checks, or name the ones to run:
+    python mingo_checks.py
+    python mingo_checks.py playlist_cache command_queue
+
+The script exits with status 1 if any check fails.
+"""
+
+import argparse
+import asyncio
+import cmd
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.request
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# mingo reads the web controller's url when it is imported. The checks never call it.
+os.environ.setdefault('WEB_CONTROLLER_URL', 'http://localhost:8080')
+os.environ.setdefault('MINGO_LOG_LEVEL', 'WARNING')
+import mingo
+
+
+class CheckFailed(Exception):
+    pass
+
+class CheckSkipped(Exception):
+    pass
+
+def check(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+web_control_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web_control')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@contextmanager
+def local_web_controller():
+    # Runs the web controller in its own process on a free port, with the in-memory
+    # store, and stops it afterwards. Yields its url.
+    port = free_port()
+    env = dict(os.environ, MINGO_LOG_LEVEL='WARNING', MINGO_STATE_BACKEND='memory')
+    env.pop('MINGO_ENGINE_NOTIFY_URL', None)
+    with open('web_controller.log', 'w') as log_file:
+        process = subprocess.Popen([sys.executable, '-c', 
+                                    f"import mingo_web; mingo_web.app.run(host='127.0.0.1', port={port}, threaded=True)"],
+                                    cwd=web_control_dir, env=env, stdout=log_file, stderr=log_file)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(100):
+            if process.poll() is not None:
+                with open('web_controller.log') as log_file:
+                    last_lines = log_file.read().strip().splitlines()[-1:]
+                raise CheckSkipped(f'the web controller did not start: {" ".join(last_lines)}')
+            try:
+                mingo.requests.get(url+'/get_player_count', timeout=1)
+                break
+            except mingo.requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            raise CheckSkipped('the web controller did not answer within 10 s')
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+#-------------------------------------------------------------------
+# CountingSpotify class - Stands in for the spotipy client. It has one
+# playlist whose tracks and snapshot id a check can change, and counts
+# every call by method name.
+#-------------------------------------------------------------------
+class CountingSpotify():
+    def __init__(self, n_tracks, page_size=100):
+        self.calls = Counter()
+        self.page_size = page_size
+        self.set_tracks(n_tracks, 'snapshot-1')
+
+    def set_tracks(self, n_tracks, snapshot_id, prefix='track'):
+        # Edits the playlist, as the operator might in Spotify
+        self.tracks = [{'track': {'name': f'{prefix} {idx}', 'id': f'{prefix}{idx}',
+                                  'artists': [{'name': 'artist'}], 'duration_ms': 180000}}
+                        for idx in range(n_tracks)]
+        self.snapshot_id = snapshot_id
+
+    def current_user_playlists(self, limit=50):
+        self.calls['current_user_playlists'] += 1
+        return {'items': [{'name': 'Check list', 'id': 'list0', 'snapshot_id': self.snapshot_id}]}
+
+    def playlist_items(self, pl_id, offset=0, fields=None, additional_types=None):
+        self.calls['playlist_items'] += 1
+        return {'items': self.tracks[offset:offset + self.page_size], 'total': len(self.tracks)}
+
+
+class SlowSpotify(CountingSpotify):
+    # Takes latency_sec to answer each page, and refuses the pages in refuse_offsets
+    # once each with a 429, as Spotify does when asked for too much at once
+    def __init__(self, n_tracks, latency_sec, refuse_offsets=()):
+        super().__init__(n_tracks)
+        self.latency_sec = latency_sec
+        self.refuse_offsets = set(refuse_offsets)
+        self.lock = threading.Lock()
+
+    def playlist_items(self, pl_id, offset=0, fields=None, additional_types=None):
+        time.sleep(self.latency_sec)
+        with self.lock:
+            self.calls['playlist_items'] += 1
+            if offset in self.refuse_offsets:
+                self.refuse_offsets.discard(offset)
+                raise mingo.spotipy.SpotifyException(429, -1, 'Too many requests', headers={'Retry-After': '0.2'})
+        return {'items': self.tracks[offset:offset + self.page_size], 'total': len(self.tracks)}
+
+
+def read_input_track_ids():
+    with open(mingo.input_file) as f:
+        rows = [line.rstrip('\n').split(',') for line in f][1:]
+    return [row[3] for row in rows]
+
+def check_playlist_cache():
+    # An unchanged playlist is read from the cache, and an edited one from Spotify
+    sp = CountingSpotify(250)
+    playlist = mingo.Playlist(sp)
+
+    playlist.process_playlist(0, True)
+    check(sp.calls['playlist_items'] == 3, f'the first read took {sp.calls["playlist_items"]} pages, not 3')
+    check(len(read_input_track_ids()) == 250, 'the first read did not write 250 tracks')
+
+    sp.calls.clear()
+    playlist.process_playlist(0, True)
+    check(sp.calls['playlist_items'] == 0, 'an unchanged playlist was read from Spotify again')
+    check(sp.calls['current_user_playlists'] == 1, 'the snapshot id was not read again')
+    check(len(read_input_track_ids()) == 250, 'the cached read did not write 250 tracks')
+
+    # A new Playlist, as after restarting the engine, still finds the cache
+    sp.calls.clear()
+    mingo.Playlist(sp).process_playlist(0, True)
+    check(sp.calls['playlist_items'] == 0, 'the cache was not kept across Playlist objects')
+
+    # The operator edits the playlist after the engine has started
+    sp.set_tracks(120, 'snapshot-2', prefix='edited')
+    sp.calls.clear()
+    playlist.process_playlist(0, True)
+    check(sp.calls['playlist_items'] == 2, 'an edited playlist was not read from Spotify again')
+    track_ids = read_input_track_ids()
+    check(len(track_ids) == 120 and all(track_id.startswith('edited') for track_id in track_ids),
+          'the edited playlist\'s tracks were not written')
+
+
+#-------------------------------------------------------------------
+# DrawingGame class - Stands in for a Game in the command queue check.
+# It draws from a real TrackPool, and fails if two threads are ever 
+# inside it at once.
+#-------------------------------------------------------------------
+class DrawingGame():
+    def __init__(self, n_tracks):
+        self.track_pool = mingo.TrackPool(n_tracks, list(range(n_tracks)))
+        self.track_ids = [f'track{idx}' for idx in range(n_tracks)]
+        self.track_durations = [0] * n_tracks
+        self.played_tracks = []
+        self.current_track_idx = None
+        # The played tracks as each state write saw them
+        self.writes = []
+        self.inside = None
+        self.overlaps = 0
+
+    def enter(self):
+        if self.inside is not None:
+            self.overlaps += 1
+        self.inside = threading.current_thread()
+
+    def play_next_track(self, testmode=False):
+        self.enter()
+        if self.track_pool.unplayed_count() > 0:
+            track_idx = self.track_pool.take(self.track_pool.choose())
+            # Give another thread the chance to get in while the draw is half done
+            time.sleep(0.0002)
+            self.played_tracks.append(track_idx)
+            self.current_track_idx = track_idx
+        self.inside = None
+
+    def write_game_state(self):
+        self.enter()
+        self.writes.append(list(self.played_tracks))
+        self.inside = None
+
+def check_command_queue():
+    # Skips from the web monitor, typed nexttrack commands and reads all at once
+    game = DrawingGame(2000)
+    processor = mingo.CommandProcessor.__new__(mingo.CommandProcessor)
+    cmd.Cmd.__init__(processor)
+    processor.active_game = game
+    processor.web_monitor = None
+    processor.auto_advance = None
+    processor.commands = mingo.CommandQueue(8)
+
+    def vote_skips():
+        for _ in range(300):
+            processor.skip_track()
+            time.sleep(random.random() / 1000)
+
+    def typed_skips():
+        for _ in range(150):
+            processor.onecmd('nexttrack')
+
+    def reads():
+        for _ in range(200):
+            processor.commands.call(lambda: len(game.played_tracks))
+
+    threads = [threading.Thread(target=target) for target in [vote_skips] * 4 + [typed_skips] * 2 + [reads] * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Wait for the last submitted skips to be done
+    processor.commands.call(lambda: None)
+
+    played = game.played_tracks
+    check(game.overlaps == 0, f'{game.overlaps} commands ran while another was inside the game')
+    check(len(set(played)) == len(played), 'a track was drawn twice')
+    check(game.track_pool.unplayed_count() == 2000 - len(played), 'the track pool does not match the draws')
+    check(len(played) >= 300, f'only {len(played)} tracks were drawn for 300 typed skips')
+    check(all(write == played[:len(write)] for write in game.writes), 
+          'a state write saw the tracks in another order')
+    check([len(write) for write in game.writes] == sorted(len(write) for write in game.writes),
+          'the state writes went backwards')
+
+
+def make_deck(n_cards, n_tracks, seed=1, unique_lines=False):
+    # A deck of cards from a playlist of n_tracks made up titles
+    titles = [f'title {track_idx}' for track_idx in range(n_tracks)]
+    card_track_idxes, _ = mingo.sample_card_tracks(range(n_tracks), n_cards, random.Random(seed), unique_lines)
+    return mingo.CardDeck(card_track_idxes, titles, ['qr.png'] * n_cards, 'Check list', mingo.GameMonitor())
+
+def slow_winning_lines(deck, card_nbr, played):
+    # Works out a card's winning lines from its tracks, the way the operator would
+    start = card_nbr * mingo.card_tracks
+    cells = list(deck.card_track_idxes[start:start + mingo.card_tracks])
+    cells.insert(mingo.center_cell, None)
+    lines = []
+    for pattern_name in mingo.default_win_patterns:
+        for line_name, line_mask in mingo.win_patterns[pattern_name]:
+            if all(cells[cell] is None or cells[cell] in played 
+                    for cell in range(mingo.gridsize**2) if line_mask & (1 << cell)):
+                lines.append(line_name)
+    return lines
+
+def check_claim_verification():
+    # Plays a whole game on 10,000 cards, verifying claims as it goes
+    n_cards = 10000
+    n_tracks = 300
+    deck = make_deck(n_cards, n_tracks)
+    start = time.perf_counter()
+    card_index = mingo.CardIndex()
+    card_index.add_deck(deck)
+    index_sec = time.perf_counter() - start
+
+    rng = random.Random(2)
+    draws = list(range(n_tracks))
+    rng.shuffle(draws)
+    played = set()
+    mark_sec = 0
+    verify_sec = 0
+    n_verified = 0
+    for draw, track_idx in enumerate(draws):
+        start = time.perf_counter()
+        card_index.mark_track(track_idx)
+        mark_sec += time.perf_counter() - start
+        played.add(track_idx)
+
+        # A dozen claims arrive after every track
+        claims = [rng.randrange(n_cards) for _ in range(12)]
+        start = time.perf_counter()
+        results = [card_index.winning_lines(card_nbr) for card_nbr in claims]
+        verify_sec += time.perf_counter() - start
+        n_verified += len(claims)
+        for card_nbr, lines in zip(claims, results):
+            check(lines == slow_winning_lines(deck, card_nbr, played), 
+                  f'card {card_nbr} was verified wrongly after {draw + 1} tracks')
+
+        if draw + 1 in (30, 60, 120):
+            start = time.perf_counter()
+            results = [card_index.winning_lines(card_nbr) for card_nbr in range(n_cards)]
+            all_sec = time.perf_counter() - start
+            winners = sum(1 for lines in results if lines)
+            check(all(lines == slow_winning_lines(deck, card_nbr, played) for card_nbr, lines in enumerate(results)),
+                  f'a card was verified wrongly after {draw + 1} tracks')
+            print(f'    after {draw + 1} tracks: {winners} winners, all {n_cards} cards verified in {1000 * all_sec:.0f} ms')
+
+    print(f'    {n_cards} cards from {n_tracks} tracks: index built in {1000 * index_sec:.0f} ms, '
+          f'full game marked in {1000 * mark_sec:.0f} ms ({1000000 * mark_sec / n_tracks:.0f} us per track), '
+          f'{1000000 * verify_sec / n_verified:.1f} us per claim')
+
+
+#-------------------------------------------------------------------
+# TitleListMonitor class - Answers has_been_played the way GameMonitor did
+# before the track pool, by looking for the title in the list of played
+# titles. Used to time rendering against the old way.
+#-------------------------------------------------------------------
+class TitleListMonitor():
+    def __init__(self, titles, played_track_idxes):
+        self.titles = titles
+        self.played_track_names = [titles[track_idx] for track_idx in played_track_idxes]
+
+    def has_been_played(self, track_idx):
+        return self.titles[track_idx] in self.played_track_names
+
+def render_deck(deck):
+    # Renders every card the way view_in_browser does. Returns the html and the seconds taken.
+    f = io.StringIO()
+    start = time.perf_counter()
+    for card in deck.cards().values():
+        card.as_html(f)
+    return f.getvalue(), time.perf_counter() - start
+
+def check_card_render():
+    # Renders 1,000 cards late in a game, and plays a whole game, the old and new ways
+    n_cards = 1000
+    n_tracks = 300
+    deck = make_deck(n_cards, n_tracks)
+    played = random.Random(3).sample(range(n_tracks), 250)
+    track_pool = mingo.TrackPool(n_tracks, range(n_tracks))
+    for track_idx in played:
+        track_pool.take(track_idx)
+    deck.monitor.set_track_pool(track_pool)
+    html, pool_sec = render_deck(deck)
+
+    deck.monitor = TitleListMonitor(deck.titles, played)
+    list_html, list_sec = render_deck(deck)
+    check(html == list_html, 'the cards rendered differently with the track pool')
+    print(f'    {n_cards} cards with {len(played)} of {n_tracks} tracks played: '
+          f'{1000 * list_sec:.0f} ms with a list of played titles, {1000 * pool_sec:.0f} ms with the track pool')
+
+    # Draws every track of a long playlist
+    n_tracks = 5000
+    unplayed_tracks = list(range(n_tracks))
+    rng = random.Random(4)
+    start = time.perf_counter()
+    while len(unplayed_tracks) > 0:
+        unplayed_tracks.remove(rng.choice(unplayed_tracks))
+    list_sec = time.perf_counter() - start
+
+    track_pool = mingo.TrackPool(n_tracks, range(n_tracks))
+    start = time.perf_counter()
+    while track_pool.unplayed_count() > 0:
+        track_pool.take(track_pool.choose())
+    pool_sec = time.perf_counter() - start
+    check(sum(track_pool.played) == n_tracks, 'the track pool did not play every track')
+    print(f'    drawing all {n_tracks} tracks: {1000 * list_sec:.0f} ms removing from a list, '
+          f'{1000 * pool_sec:.0f} ms with the track pool')
+
+
+def check_card_upload():
+    # Loads cards into a local web controller one request per card, as webload used
+    # to, and in one bulk request, as it does now
+    saved_url = mingo.web_controller_url
+    try:
+        with local_web_controller() as url:
+            mingo.web_controller_url = url
+            for n_cards in (10, 100, 1000):
+                cards = make_deck(n_cards, 300).cards()
+                start = time.perf_counter()
+                for card_nbr in range(n_cards):
+                    response = mingo.requests.post(url+'/card_load', json=cards[card_nbr].as_json(card_nbr), timeout=10)
+                    check(response.status_code == 200, f'/card_load answered {response.status_code}')
+                mingo.requests.post(url+'/game_misc_data', timeout=10,
+                                    json=json.dumps({"playlist_name": 'Check list', 
+                                                     "number_of_players": str(n_cards), "refresh_flag": True}))
+                per_card_sec = time.perf_counter() - start
+
+                start = time.perf_counter()
+                mingo.post_web_cards([{"card_nbr": card_nbr, "titles": cards[card_nbr].sheet}
+                                        for card_nbr in range(n_cards)], 'Check list')
+                bulk_sec = time.perf_counter() - start
+                print(f'    {n_cards} cards: {1000 * per_card_sec:.0f} ms in {n_cards + 1} requests, '
+                      f'{1000 * bulk_sec:.0f} ms in one bulk request')
+    finally:
+        mingo.web_controller_url = saved_url
+
+
+def fill_qr_cache(n_codes):
+    # Puts an image in the QR code cache for every card, so that makegame only
+    # makes cards. Making the images is timed by the qr_cache check.
+    qr_generator = mingo.QRCodeGenerator(mingo.qr_base_url)
+    os.makedirs(mingo.qr_cache_dir, exist_ok=True)
+    mingo.save_qr_code(qr_generator.code_url(0), 'qr.png')
+    with open('qr.png', 'rb') as f:
+        image = f.read()
+    for code_number in range(n_codes):
+        with open(qr_generator.code_filename(code_number), 'wb') as f:
+            f.write(image)
+
+def check_makegame():
+    # Times making a game of 100, 1,000 and 10,000 cards from a 300 track playlist
+    mingo.Playlist(CountingSpotify(300)).process_playlist(0, True)
+    fill_qr_cache(10000)
+    for n_cards in (100, 1000, 10000):
+        # The tracks of the cards picked as they used to be, with a random.sample and
+        # a list of titles for each card
+        card_factory = mingo.CardFactory(mingo.input_file, mingo.GameMonitor())
+        title_idx = card_factory.title_idx
+        titles = card_factory.titles
+        active_indexes = set()
+        start = time.perf_counter()
+        for card_nbr in range(n_cards):
+            card_title_idxes = random.sample(title_idx, mingo.card_tracks)
+            active_indexes.update(card_title_idxes)
+            sheet = [titles[idx] for idx in card_title_idxes]
+            sheet.insert(mingo.center_cell, '<img src="qr.png"/>')
+        per_card_sec = time.perf_counter() - start
+
+        start = time.perf_counter()
+        card_track_idxes = card_factory.sample_cards(n_cards, random.Random(n_cards))
+        active_indexes = set(card_track_idxes)
+        batch_sec = time.perf_counter() - start
+
+        start = time.perf_counter()
+        game = mingo.Game(n_cards, None, None, seed=n_cards)
+        game_sec = time.perf_counter() - start
+        check(game.n_cards == n_cards and len(game.cards) == n_cards, f'the game has {len(game.cards)} cards')
+        check(all(len(set(game.cards[card_nbr].card_title_idxes)) == mingo.card_tracks 
+                  for card_nbr in range(0, n_cards, 97)), 'a card has the same track twice')
+        print(f'    {n_cards} cards: makegame took {1000 * game_sec:.0f} ms. Picking the tracks took '
+              f'{1000 * batch_sec:.0f} ms in one batch, {1000 * per_card_sec:.0f} ms one card at a time.')
+
+
+def check_unique_lines():
+    # Makes 5,000 cards from a 75 track playlist with no line on two cards
+    n_cards = 5000
+    n_tracks = 75
+    start = time.perf_counter()
+    card_track_idxes, line_retries = mingo.sample_card_tracks(range(n_tracks), n_cards, random.Random(5), True)
+    unique_sec = time.perf_counter() - start
+
+    lines = Counter()
+    for card_nbr in range(n_cards):
+        card = card_track_idxes[card_nbr * mingo.card_tracks:(card_nbr + 1) * mingo.card_tracks]
+        lines.update(frozenset(card[position] for position in positions) for positions in mingo.line_positions)
+    shared = sum(1 for count in lines.values() if count > 1)
+    check(shared == 0, f'{shared} lines are on more than one card')
+    check(unique_sec < 5, f'making the cards took {unique_sec:.1f} s')
+
+    start = time.perf_counter()
+    mingo.sample_card_tracks(range(n_tracks), n_cards, random.Random(5))
+    plain_sec = time.perf_counter() - start
+    print(f'    {n_cards} cards from {n_tracks} tracks: {1000 * unique_sec:.0f} ms with unique lines and '
+          f'{line_retries} cards made again, {1000 * plain_sec:.0f} ms without')
+
+
+def check_qr_cache():
+    # Makes 1,000 QR codes with an empty cache, then again with the cache full
+    n_codes = 1000
+    qr_generator = mingo.QRCodeGenerator(mingo.qr_base_url)
+    start = time.perf_counter()
+    filenames = qr_generator.make_codes(range(n_codes))
+    cold_sec = time.perf_counter() - start
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            check(f.read(8) == b'\x89PNG\r\n\x1a\n', f'{filename} is not a PNG image')
+    modified = [os.path.getmtime(filename) for filename in filenames]
+
+    start = time.perf_counter()
+    check(qr_generator.make_codes(range(n_codes)) == filenames, 'the cached images have other names')
+    warm_sec = time.perf_counter() - start
+    check([os.path.getmtime(filename) for filename in filenames] == modified, 'a cached image was made again')
+
+    # Another base url gets its own images
+    other_filenames = mingo.QRCodeGenerator('http://localhost:8080/').make_codes(range(3))
+    check(set(other_filenames).isdisjoint(filenames), 'two base urls share an image')
+    print(f'    {n_codes} QR codes, up to {os.cpu_count()} worker processes: {1000 * cold_sec:.0f} ms cold, {1000 * warm_sec:.0f} ms warm')
+
+
+def check_playlist_fetch():
+    # Reads playlists of several sizes page by page, as playlist_processing used to,
+    # and with the pages after the first fetched at once. Each page takes 100 ms.
+    for n_tracks in (100, 500, 1000, 2000):
+        sp = mingo.SpotifyClient(SlowSpotify(n_tracks, 0.1))
+        playlist = mingo.Playlist(sp)
+        start = time.perf_counter()
+        tracks = list(mingo.page_tracks(playlist.fetch_page('list0', 0)))
+        for offset in range(100, n_tracks, 100):
+            tracks.extend(mingo.page_tracks(playlist.fetch_page('list0', offset)))
+        one_by_one_sec = time.perf_counter() - start
+
+        # Then again with the third page refused once, so it must be fetched again
+        concurrent_sec = []
+        for refuse_offsets in ((), (200,)):
+            playlist = mingo.Playlist(mingo.SpotifyClient(SlowSpotify(n_tracks, 0.1, refuse_offsets)))
+            start = time.perf_counter()
+            fetched_tracks = list(playlist.fetch_tracks('list0'))
+            concurrent_sec.append(time.perf_counter() - start)
+            check(fetched_tracks == tracks, f'the {n_tracks} track playlist was read wrongly')
+        print(f'    {n_tracks} tracks: {1000 * one_by_one_sec:.0f} ms page by page, '
+              f'{1000 * concurrent_sec[0]:.0f} ms concurrently, '
+              f'{1000 * concurrent_sec[1]:.0f} ms concurrently with a page refused for 0.2 s')
+
+
+def synthetic_titles(n_titles, rng):
+    # Made up titles, with about one in ten a different version of an earlier title
+    # and one in twenty a numbered part of an earlier title. Returns the titles and,
+    # for each title, the index of the title it is a version of or None.
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(5000)]
+    versions = [' - Remastered 2011', ' (Live)', ' [Radio Edit]', ' feat. Someone Else', '!']
+    titles = []
+    version_of = []
+    # Made up titles are only used once, so that only the versions are real duplicates
+    used = set()
+    while len(titles) < n_titles:
+        kind = rng.random()
+        if len(titles) > 0 and kind < 0.1:
+            original = rng.randrange(len(titles))
+            if version_of[original] is None and 'Part' not in titles[original]:
+                titles.append(titles[original] + rng.choice(versions))
+                version_of.append(original)
+        elif kind < 0.15:
+            title = f'{" ".join(rng.sample(words, 3)).title()} Part'
+            if title not in used:
+                used.add(title)
+                titles.extend([title + ' 1', title + ' 2'])
+                version_of.extend([None, None])
+        else:
+            title = ' '.join(rng.sample(words, rng.randint(1, 4))).title()
+            if title not in used:
+                used.add(title)
+                titles.append(title)
+                version_of.append(None)
+    return titles[:n_titles], version_of[:n_titles]
+
+def check_duplicate_titles():
+    # Indexes synthetic playlists of up to 20,000 tracks
+    for n_titles in (5000, 10000, 20000):
+        titles, version_of = synthetic_titles(n_titles, random.Random(n_titles))
+        title_index = mingo.TitleIndex()
+        start = time.perf_counter()
+        matches = [title_index.add(title) for title in titles]
+        index_sec = time.perf_counter() - start
+
+        missed = [title for title, original, match in zip(titles, version_of, matches) 
+                    if original is not None and match is None]
+        wrong = [title for title, original, match in zip(titles, version_of, matches) 
+                    if original is None and match is not None]
+        check(len(missed) == 0, f'{len(missed)} versions of earlier titles were not found, e.g. {missed[:3]}')
+        check(not any('Part' in title for title in wrong), 'a numbered part was taken for another part')
+        print(f'    {n_titles} titles: indexed in {1000 * index_sec:.0f} ms, '
+              f'{sum(1 for original in version_of if original is not None)} versions found, '
+              f'{len(wrong)} other titles flagged')
+
+
+#-------------------------------------------------------------------
+# StandInController class - Answers the web monitor's /engine_poll and
+# /clear calls the way the web controller does, with votes that a check
+# adds. If notify_url is set, it tells the engine when enough votes are
+# in, as the web controller's EngineNotifier does.
+#-------------------------------------------------------------------
+class StandInController():
+    def __init__(self, notify_url=None):
+        self.stop_count = 0
+        self.notify_url = notify_url
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stand_in.lock:
+                    if self.path == '/clear':
+                        stand_in.stop_count = 0
+                    body = json.dumps({'win_claims': [], 'stop_count': stand_in.stop_count}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def vote(self, n_votes):
+        with self.lock:
+            self.stop_count = n_votes
+        if self.notify_url:
+            urllib.request.urlopen(urllib.request.Request(self.notify_url, data=b'', method='POST'), timeout=2)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class SkipRecorder():
+    # Stands in for the CommandProcessor, noting when the monitor asks for a skip
+    def __init__(self):
+        self.commands = mingo.CommandQueue()
+        self.skipped = threading.Event()
+
+    def skip_track(self):
+        self.skipped.set()
+
+    def auto_advance_armed(self):
+        return True
+
+def vote_to_skip_latencies(n_votes, poll_interval_sec, notify):
+    saved = (mingo.web_controller_url, mingo.engine_listen_port)
+    engine_port = free_port()
+    stand_in = StandInController(f'http://127.0.0.1:{engine_port}/notify' if notify else None)
+    mingo.web_controller_url = stand_in.url
+    mingo.engine_listen_port = str(engine_port) if notify else None
+    recorder = SkipRecorder()
+    monitor = mingo.WebMonitor(recorder, 3, poll_interval_sec)
+    latencies = []
+    rng = random.Random(6)
+    try:
+        monitor.start()
+        for _ in range(n_votes):
+            time.sleep(0.2 + rng.random() * poll_interval_sec)
+            recorder.skipped.clear()
+            start = time.perf_counter()
+            stand_in.vote(3)
+            check(recorder.skipped.wait(poll_interval_sec + 5), 'the monitor did not skip the track')
+            latencies.append(time.perf_counter() - start)
+            # Wait for the monitor's /clear before the next vote
+            while stand_in.stop_count != 0:
+                time.sleep(0.01)
+    finally:
+        monitor.stop()
+        stand_in.stop()
+        mingo.web_controller_url, mingo.engine_listen_port = saved
+    return latencies
+
+def check_vote_latency():
+    # Times from enough votes arriving at a stand-in web controller to the monitor asking for a skip
+    n_votes = 20
+    for poll_interval_sec, notify in ((1, False), (0.25, False), (5, True)):
+        latencies = vote_to_skip_latencies(n_votes, poll_interval_sec, notify)
+        how = f'polling every {poll_interval_sec} s' + (' and notified' if notify else '')
+        print(f'    {how}: p50 {1000 * percentile(latencies, 0.5):.0f} ms, '
+              f'p99 {1000 * percentile(latencies, 0.99):.0f} ms, max {1000 * max(latencies):.0f} ms '
+              f'over {n_votes} votes')
+        if notify:
+            check(max(latencies) < 1, f'a notified vote took {max(latencies):.1f} s to skip')
+
+
+# Seconds between each phone's /stopdata polls, the MINGO_UPDATE_INTERVAL of the Pi
+phone_poll_interval_sec = 0.5
+
+# Seconds that each load test runs for, and between changes of the game state
+phone_test_sec = 6
+state_change_interval_sec = 0.5
+
+class PhoneStats():
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.request_latencies = []
+        # When each value of votes_required was set, and how long each phone took to see it
+        self.changed_at = dict()
+        self.change_delays = []
+        self.last_seen = Counter()
+
+    def saw(self, votes_required, phone_nbr):
+        changed_at = self.changed_at.get(votes_required)
+        if changed_at is not None and votes_required > self.last_seen[phone_nbr]:
+            self.last_seen[phone_nbr] = votes_required
+            self.change_delays.append(time.perf_counter() - changed_at)
+
+async def http_request(host, port, method, path, body=b'', version='1.1'):
+    # One request on a new connection, read to the end. Returns the response body.
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f'{method} {path} HTTP/{version}\r\nHost: {host}\r\nConnection: close\r\n'
+                     f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    return response.split(b'\r\n\r\n', 1)[1]
+
+async def polling_phone(host, port, phone_nbr, stats, end_at):
+    # Polls /stopdata the way script.js did before the event stream
+    while time.perf_counter() < end_at:
+        start = time.perf_counter()
+        try:
+            state = json.loads(await http_request(host, port, 'POST', '/stopdata'))
+            stats.requests += 1
+            stats.request_latencies.append(time.perf_counter() - start)
+            stats.saw(state['votes_required'] or 0, phone_nbr)
+        except (OSError, ValueError, IndexError):
+            stats.errors += 1
+        await asyncio.sleep(phone_poll_interval_sec)
+
+async def streaming_phone(host, port, phone_nbr, stats, end_at):
+    # Keeps one /stream open, the way script.js does now
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        stats.errors += 1
+        return
+    stats.requests += 1
+    try:
+        writer.write(f'GET /stream HTTP/1.0\r\nHost: {host}\r\n\r\n'.encode())
+        await writer.drain()
+        while True:
+            line = await asyncio.wait_for(reader.readline(), end_at - time.perf_counter())
+            if line == b'':
+                break
+            if line.startswith(b'data:'):
+                delta = json.loads(line[5:])
+                if 'votes_required' in delta:
+                    stats.saw(delta['votes_required'] or 0, phone_nbr)
+    except (OSError, ValueError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+async def change_game_state(host, port, stats, start_at, end_at):
+    # Sets a new votes_required every state_change_interval_sec, as the engine does
+    await asyncio.sleep(start_at - time.perf_counter())
+    votes_required = 1000
+    while time.perf_counter() < end_at - 1:
+        votes_required += 1
+        stats.changed_at[votes_required] = time.perf_counter()
+        body = json.dumps(json.dumps({'votes_required': votes_required})).encode()
+        await http_request(host, port, 'POST', '/set_votes_required', body)
+        stats.requests += 1
+        await asyncio.sleep(state_change_interval_sec)
+    return votes_required
+
+async def run_phones(url, phone, n_phones):
+    host, port = url.split('//')[1].split(':')
+    stats = PhoneStats()
+    start = time.perf_counter()
+    # The phones connect over the first second, and the state changes once they all have
+    end_at = start + phone_test_sec
+    tasks = []
+    for phone_nbr in range(n_phones):
+        tasks.append(asyncio.create_task(phone(host, int(port), phone_nbr, stats, end_at)))
+        await asyncio.sleep(1 / n_phones)
+    last_votes_required = await change_game_state(host, int(port), stats, start + 1.5, end_at)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    missed = sum(1 for phone_nbr in range(n_phones) if stats.last_seen[phone_nbr] != last_votes_required)
+    return stats, elapsed, missed
+
+def check_phone_load():
+    # Compares the request rate and latency of polling phones with phones on the event stream
+    for n_phones in (50, 200, 1000):
+        results = dict()
+        for mode, phone in (('polling', polling_phone), ('stream', streaming_phone)):
+            with local_web_controller() as url:
+                stats, elapsed, missed = asyncio.run(run_phones(url, phone, n_phones))
+            results[mode] = stats
+            # A stream counts as one request, however long it stays open
+            request_p99 = (f'p99 request {1000 * percentile(stats.request_latencies, 0.99):.0f} ms, '
+                            if mode == 'polling' else '')
+            print(f'    {n_phones} phones {mode}: {stats.requests / elapsed:.0f} requests/s, {request_p99}'
+                  f'p99 change seen after {1000 * percentile(stats.change_delays, 0.99):.0f} ms, '
+                  f'{stats.errors} errors, {missed} phones missed the last change')
+            if mode == 'stream':
+                check(missed == 0, f'{missed} of {n_phones} streaming phones missed the last change')
+        check(results['stream'].requests < results['polling'].requests,
+              f'{n_phones} streaming phones made more requests than polling ones')
+
+
+checks = {'playlist_cache': check_playlist_cache,
+          'command_queue': check_command_queue,
+          'claim_verification': check_claim_verification,
+          'card_render': check_card_render,
+          'makegame': check_makegame,
+          'unique_lines': check_unique_lines,
+          'qr_cache': check_qr_cache,
+          'playlist_fetch': check_playlist_fetch,
+          'duplicate_titles': check_duplicate_titles,
+          'vote_latency': check_vote_latency,
+          'card_upload': check_card_upload,
+          'phone_load': check_phone_load}
+
+def run_checks(names):
+    failures = 0
+    start_dir = os.getcwd()
+    for name in names:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            try:
+                checks[name]()
+                print(f'{name}: passed')
+            except CheckFailed as e:
+                failures += 1
+                print(f'{name}: FAILED, {e}')
+            except CheckSkipped as e:
+                print(f'{name}: skipped, {e}')
+            except Exception:
+                failures += 1
+                print(f'{name}: FAILED with an exception')
+                traceback.print_exc()
+            finally:
+                os.chdir(start_dir)
+    return failures
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Checks the Mingo game engine without Spotify or the web controller.')
+    parser.add_argument('names', nargs='*', help=f'The checks to run, from {", ".join(checks)}. All of them if none are named.')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in checks:
+            parser.error(f'there is no check named {name}')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    failures = run_checks(args.names or list(checks))
+    sys.exit(1 if failures else 0)
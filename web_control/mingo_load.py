@@ -0,0 +1,344 @@
+"""
+Load generator for the Mingo web controller.
+
+Simulates many players, each with their own session, going through a game:
+join, load their card, poll the game state, vote to skip tracks, claim a win
+now and then, reload their card, and finally release their player id. An
+engine stand-in loads the cards and polls for votes and win claims the way
+the game engine does.
+
+Everything runs on one asyncio event loop with a small HTTP/1.1 client built
+on asyncio streams, so nothing outside the standard library is needed. At the
+end a JSON report is written with the throughput, p50/p99 latency and error
+rate of each route, so runs against different versions can be compared.
+
+Example, against a web controller started with dev_script.sh:
+    python mingo_load.py --url http://localhost:8080 --players 200 --duration 60 --report load.json
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import random
+import re
+import time
+from urllib.parse import urlsplit
+
+
+#-------------------------------------------------------------------
+# HttpClient class - One HTTP/1.1 connection with its own cookies, like
+# one player's browser. The connection is kept open between requests
+# when the server allows it, and opened again when it doesn't.
+#-------------------------------------------------------------------
+class HttpClient():
+    def __init__(self, host, port, timeout_sec):
+        self.host = host
+        self.port = port
+        self.timeout_sec = timeout_sec
+        self.cookies = {}
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method, path, body=None, headers=None):
+        '''
+        Makes a request and reads the whole response.
+
+            returns:
+                (status code, response headers with lower case names, body bytes)
+        '''
+        try:
+            return await asyncio.wait_for(self._request(method, path, body, headers or {}),
+                                          self.timeout_sec)
+        except BaseException:
+            await self.close()
+            raise
+
+    async def _request(self, method, path, body, headers):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}', 'Accept-Encoding: gzip']
+        if len(self.cookies) > 0:
+            lines.append('Cookie: ' + '; '.join(f'{name}={value}' for name, value in self.cookies.items()))
+        for name, value in headers.items():
+            lines.append(f'{name}: {value}')
+        if body is not None:
+            lines.append(f'Content-Length: {len(body)}')
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError('The server closed the connection')
+        version, status = status_line.decode('latin-1').split()[:2]
+        response_headers = {}
+        while True:
+            line = (await self._reader.readline()).decode('latin-1').rstrip('\r\n')
+            if line == '':
+                break
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            value = value.strip()
+            if name == 'set-cookie':
+                cookie_name, cookie_value = value.split(';', 1)[0].split('=', 1)
+                self.cookies[cookie_name] = cookie_value
+            response_headers[name] = value
+
+        status = int(status)
+        if status == 304 or status < 200 or method == 'HEAD':
+            response_body = b''
+        elif 'content-length' in response_headers:
+            response_body = await self._reader.readexactly(int(response_headers['content-length']))
+        elif response_headers.get('transfer-encoding') == 'chunked':
+            response_body = await self._read_chunked()
+        else:
+            response_body = await self._reader.read()
+            response_headers['connection'] = 'close'
+
+        if response_headers.get('content-encoding') == 'gzip':
+            response_body = gzip.decompress(response_body)
+        if version == 'HTTP/1.0' or response_headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, response_headers, response_body
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self._reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await self._reader.readline()
+                return b''.join(chunks)
+            chunks.append(await self._reader.readexactly(size))
+            await self._reader.readline()
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self._reader = None
+            self._writer = None
+
+
+#-------------------------------------------------------------------
+# LoadReport class - Latencies and errors of every request, by route.
+# A request is an error if it fails to complete or the server answers
+# with a 4xx or 5xx status.
+#-------------------------------------------------------------------
+class LoadReport():
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self.start = time.perf_counter()
+        self.end = None
+
+    def record(self, route, elapsed_sec, status=None):
+        self.latencies.setdefault(route, []).append(elapsed_sec)
+        status_class = f'{status // 100}xx' if status else 'failed'
+        route_statuses = self.statuses.setdefault(route, {})
+        route_statuses[status_class] = route_statuses.get(status_class, 0) + 1
+        if status is None or status >= 400:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, config):
+        duration = (self.end or time.perf_counter()) - self.start
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            count = len(latencies)
+            routes[route] = {'count': count,
+                             'throughput_per_sec': count / duration,
+                             'p50_ms': percentile(latencies, 0.5) * 1000,
+                             'p99_ms': percentile(latencies, 0.99) * 1000,
+                             'max_ms': latencies[-1] * 1000,
+                             'errors': self.errors.get(route, 0),
+                             'error_rate': self.errors.get(route, 0) / count,
+                             'statuses': self.statuses[route]}
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {'config': config,
+                'duration_sec': duration,
+                'requests': total,
+                'throughput_per_sec': total / duration,
+                'errors': sum(self.errors.values()),
+                'routes': routes}
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+#-------------------------------------------------------------------
+# LoadGenerator class - Runs the engine stand-in and the players
+#-------------------------------------------------------------------
+class LoadGenerator():
+    def __init__(self, args):
+        url = urlsplit(args.url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.report = LoadReport()
+        self.deadline = None
+
+    async def timed_request(self, client, route, method, path, body=None, headers=None):
+        start = time.perf_counter()
+        try:
+            status, response_headers, response_body = await client.request(method, path, body, headers)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            self.report.record(route, time.perf_counter() - start)
+            return None, {}, b''
+        self.report.record(route, time.perf_counter() - start, status)
+        return status, response_headers, response_body
+
+    def post_json(self, client, route, path, data):
+        return self.timed_request(client, route, 'POST', path,
+                                  json.dumps(data).encode('utf-8'),
+                                  {'Content-Type': 'application/json'})
+
+    #--- The engine stand-in ---
+
+    def make_cards(self):
+        titles = [f'Track {track_nbr}' for track_nbr in range(self.args.tracks)]
+        return [{'card_nbr': card_nbr, 'titles': self.random.sample(titles, 25)}
+                    for card_nbr in range(self.args.cards)]
+
+    async def load_cards(self, client):
+        # The web controller's card routes take their JSON as a JSON encoded string,
+        # the same as the engine sends it
+        cards = self.make_cards()
+        if self.args.card_load:
+            for card in cards:
+                songs = [{'id': i + 1, 'title': title} for i, title in enumerate(card['titles'])]
+                await self.post_json(client, '/card_load', '/card_load',
+                                     json.dumps({'card_nbr': card['card_nbr'], 'songs': songs}))
+            await self.post_json(client, '/game_misc_data', '/game_misc_data',
+                                 json.dumps({'playlist_name': 'Load test',
+                                             'number_of_players': str(len(cards)),
+                                             'refresh_flag': True}))
+        else:
+            body = gzip.compress(json.dumps({'cards': cards,
+                                             'playlist_name': 'Load test',
+                                             'number_of_players': str(len(cards)),
+                                             'refresh_flag': True}).encode('utf-8'))
+            await self.timed_request(client, '/cards_bulk', 'POST', '/cards_bulk', body,
+                                     {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+        await self.post_json(client, '/set_votes_required', '/set_votes_required',
+                             json.dumps({'votes_required': self.args.votes_required}))
+
+    async def engine(self):
+        client = HttpClient(self.host, self.port, self.args.timeout)
+        poll_route = '/win_claims' if self.args.card_load else '/engine_poll'
+        while time.perf_counter() < self.deadline:
+            status, _, body = await self.timed_request(client, poll_route, 'GET', poll_route)
+            if status == 200:
+                poll_data = json.loads(body)
+                for card_nbr in poll_data['win_claims']:
+                    await self.post_json(client, '/claim_result', '/claim_result',
+                                         json.dumps({'card_nbr': card_nbr, 'verified': False, 'lines': []}))
+                if poll_data.get('stop_count', 0) >= self.args.votes_required:
+                    # Play the next track
+                    await self.timed_request(client, '/clear', 'GET', '/clear')
+            await asyncio.sleep(self.args.engine_interval)
+        await client.close()
+
+    #--- The players ---
+
+    async def player(self, player_nbr):
+        # Stagger the joins over the ramp up time, like players arriving
+        await asyncio.sleep(self.random.uniform(0, self.args.ramp_up))
+        client = HttpClient(self.host, self.port, self.args.timeout)
+
+        status, headers, _ = await self.timed_request(client, '/join', 'GET', '/join')
+        if status not in (200, 302):
+            await client.close()
+            return
+
+        card_number = None
+        card_etag = None
+        status, headers, body = await self.timed_request(client, '/card', 'GET', '/card')
+        if status == 200:
+            card_etag = headers.get('etag')
+            match = re.search(rb'let cardNumber = "(\d+)"', body)
+            if match:
+                card_number = int(match.group(1))
+
+        while time.perf_counter() < self.deadline:
+            await asyncio.sleep(self.args.poll_interval * self.random.uniform(0.8, 1.2))
+            await self.post_json(client, '/stopdata', '/stopdata', {'text': ''})
+
+            chance = self.random.random()
+            if chance < self.args.vote_chance:
+                await self.post_json(client, '/requeststop', '/requeststop', {'text': ''})
+            elif chance < self.args.vote_chance + self.args.claim_chance and card_number is not None:
+                await self.post_json(client, '/claimWinner', '/claimWinner',
+                                     {'card_claiming_win': card_number})
+            elif chance < self.args.vote_chance + self.args.claim_chance + self.args.reload_chance:
+                # A twitchy player refreshing the page
+                headers = {'If-None-Match': card_etag} if card_etag else None
+                status, headers, _ = await self.timed_request(client, '/card', 'GET', '/card', headers=headers)
+                if status == 200:
+                    card_etag = headers.get('etag')
+
+        await self.timed_request(client, '/rel', 'GET', '/rel')
+        await client.close()
+
+    async def run(self):
+        client = HttpClient(self.host, self.port, self.args.timeout)
+        await self.load_cards(client)
+        await client.close()
+
+        self.report.start = time.perf_counter()
+        self.deadline = self.report.start + self.args.duration
+        await asyncio.gather(self.engine(),
+                             *[self.player(player_nbr) for player_nbr in range(self.args.players)])
+        self.report.end = time.perf_counter()
+        return self.report.summary(vars(self.args))
+
+
+def print_summary(summary):
+    print(f'{summary["requests"]} requests in {summary["duration_sec"]:.1f} sec, '
+          f'{summary["throughput_per_sec"]:.1f} per sec, {summary["errors"]} errors')
+    print(f'\n{"route":<22}{"count":>8}{"per sec":>10}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}{"errors":>8}')
+    for route, stats in summary['routes'].items():
+        print(f'{route:<22}{stats["count"]:>8}{stats["throughput_per_sec"]:>10.1f}{stats["p50_ms"]:>10.1f}'
+              f'{stats["p99_ms"]:>10.1f}{stats["max_ms"]:>10.1f}{stats["errors"]:>8}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Simulates players and the game engine against the Mingo web controller.')
+    parser.add_argument('--url', default='http://localhost:8080', help='The web controller to test')
+    parser.add_argument('--players', type=int, default=100, help='Number of simulated players')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to keep the players playing')
+    parser.add_argument('--ramp-up', type=float, default=5, help='Seconds over which the players join')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='Seconds between each player\'s /stopdata polls')
+    parser.add_argument('--engine-interval', type=float, default=1, help='Seconds between the engine\'s polls')
+    parser.add_argument('--cards', type=int, default=None, help='Number of cards to load (default: one per player)')
+    parser.add_argument('--tracks', type=int, default=200, help='Number of tracks the cards are made from')
+    parser.add_argument('--votes-required', type=int, default=5, help='Votes that skip a track')
+    parser.add_argument('--vote-chance', type=float, default=0.02, help='Chance of a vote to skip after each poll')
+    parser.add_argument('--claim-chance', type=float, default=0.005, help='Chance of a win claim after each poll')
+    parser.add_argument('--reload-chance', type=float, default=0.01, help='Chance of reloading the card page after each poll')
+    parser.add_argument('--card-load', action='store_true',
+                        help='Load cards one at a time with /card_load and poll /win_claims, like older engines')
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds before a request counts as failed')
+    parser.add_argument('--seed', type=int, default=None, help='Seeds the random choices so runs can be repeated')
+    parser.add_argument('--report', default=None, help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+    if args.cards is None:
+        args.cards = args.players
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    summary = asyncio.run(LoadGenerator(args).run())
+    if args.report:
+        with open(args.report, 'w') as fp:
+            json.dump(summary, fp, indent=2)
+        print_summary(summary)
+        print(f'\nThe report was written to {args.report}')
+    else:
+        print(json.dumps(summary, indent=2))
@@ -0,0 +1,180 @@
+"""
+Concurrency stress test for the web controller's game state stores.
+
+Many threads add win claims and votes to skip at once, while another thread
+keeps draining the claims the way /engine_poll does. Every card is claimed
+by several threads at the same moment, and every player votes more than once.
+At the end each claim that was accepted must have been drained exactly once,
+and each player's vote must have been counted exactly once.
+
+The in-memory store is tested with threads. The SQLite store is tested with
+several processes, each with its own threads, the way gunicorn workers share
+it. Example:
+    python mingo_store_stress.py --cards 2000 --players 2000 --threads 16 --processes 4
+
+The script exits with status 1 if anything was lost or counted twice.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import mingo_web
+
+
+def add_in_threads(store, card_nbrs, player_ids, n_threads):
+    # Adds every claim and vote from n_threads threads. Returns how many times
+    # each claim and each vote was accepted.
+    added_claims = Counter()
+    added_votes = Counter()
+    lock = threading.Lock()
+
+    def add_claim(card_nbr):
+        if store.add_win_claim(card_nbr):
+            with lock:
+                added_claims[card_nbr] += 1
+
+    def add_vote(player_id):
+        if store.add_stop_request(player_id):
+            with lock:
+                added_votes[player_id] += 1
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        # Interleave the claims and votes so that both kinds of lock are busy at once
+        for card_nbr, player_id in zip(card_nbrs, player_ids):
+            executor.submit(add_claim, card_nbr)
+            executor.submit(add_vote, player_id)
+    return added_claims, added_votes
+
+def add_in_sqlite_process(pathname, card_nbrs, player_ids, n_threads):
+    # Runs in a worker process, with its own connection to the shared database
+    return add_in_threads(mingo_web.SQLiteGameStateStore(pathname), card_nbrs, player_ids, n_threads)
+
+
+# Seconds between drains. /engine_poll drains about once a second, so this is
+# far more often than a real game, but leaves room for the other writers to get
+# into the SQLite database.
+drain_interval_sec = 0.001
+
+class Drainer():
+    # Drains the claims over and over on its own thread, until stopped
+    def __init__(self, store):
+        self.store = store
+        self.drained = Counter()
+        self.n_drains = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            self.drained.update(self.store.drain_win_claims())
+            self.n_drains += 1
+            time.sleep(drain_interval_sec)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        # Anything added after the last drain
+        self.drained.update(self.store.drain_win_claims())
+
+
+def work_lists(args):
+    # Every card and player appears args.repeats times, spread through the lists.
+    # Card numbers are strings, as the player pages send them.
+    card_nbrs = [str(card_nbr) for card_nbr in range(args.cards)] * args.repeats
+    player_ids = list(range(args.players)) * args.repeats
+    n_calls = max(len(card_nbrs), len(player_ids))
+    card_nbrs = (card_nbrs * (n_calls // len(card_nbrs) + 1))[:n_calls]
+    player_ids = (player_ids * (n_calls // len(player_ids) + 1))[:n_calls]
+    return card_nbrs, player_ids
+
+def compare(name, store, drainer, added_claims, added_votes, args):
+    # Prints what was lost or counted twice. Returns the number of problems.
+    problems = []
+    for card_nbr in set(added_claims) | set(drainer.drained):
+        if drainer.drained[card_nbr] != added_claims[card_nbr]:
+            problems.append(f'card {card_nbr} was accepted {added_claims[card_nbr]} times '
+                            f'but drained {drainer.drained[card_nbr]} times')
+    if len(added_claims) != args.cards:
+        problems.append(f'only {len(added_claims)} of {args.cards} cards had a claim accepted')
+
+    voters = set(store.stop_requests())
+    if store.stop_count() != args.players or voters != set(range(args.players)):
+        problems.append(f'{store.stop_count()} votes were counted for {args.players} players')
+    repeated = [player_id for player_id, count in added_votes.items() if count != 1]
+    if len(repeated) > 0:
+        problems.append(f'{len(repeated)} players had a vote accepted more than once')
+
+    print(f'{name}: {sum(added_claims.values())} claims accepted, {sum(drainer.drained.values())} drained '
+          f'in {drainer.n_drains} drains, {store.stop_count()} votes counted')
+    for problem in problems[:20]:
+        print(f'    {problem}')
+    print(f'{name}: {"FAILED" if problems else "passed"}')
+    return len(problems)
+
+def stress_memory_store(args):
+    store = mingo_web.GameStateStore()
+    card_nbrs, player_ids = work_lists(args)
+    start = time.perf_counter()
+    drainer = Drainer(store)
+    try:
+        added_claims, added_votes = add_in_threads(store, card_nbrs, player_ids, args.threads)
+    finally:
+        drainer.stop()
+    print(f'memory store: {len(card_nbrs) + len(player_ids)} calls in {time.perf_counter() - start:.1f} s')
+    return compare('memory store', store, drainer, added_claims, added_votes, args)
+
+def stress_sqlite_store(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        pathname = os.path.join(work_dir, 'stress_state.db')
+        store = mingo_web.SQLiteGameStateStore(pathname)
+        card_nbrs, player_ids = work_lists(args)
+        start = time.perf_counter()
+        drainer = Drainer(store)
+        try:
+            # Each process gets every args.processes'th call, so the same card is
+            # claimed by several processes at once
+            # The workers are spawned, not forked, so none of them can inherit a
+            # SQLite lock held by the drainer thread at the moment of the fork
+            with ProcessPoolExecutor(max_workers=args.processes,
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(add_in_sqlite_process, pathname, card_nbrs[worker::args.processes],
+                                           player_ids[worker::args.processes], args.threads)
+                            for worker in range(args.processes)]
+                added_claims = Counter()
+                added_votes = Counter()
+                for future in futures:
+                    claims, votes = future.result()
+                    added_claims.update(claims)
+                    added_votes.update(votes)
+        finally:
+            drainer.stop()
+        print(f'sqlite store: {len(card_nbrs) + len(player_ids)} calls in {time.perf_counter() - start:.1f} s')
+        return compare('sqlite store', store, drainer, added_claims, added_votes, args)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Checks that the game state stores lose no claims or votes under load.')
+    parser.add_argument('--cards', type=int, default=2000, help='Number of cards claiming a win')
+    parser.add_argument('--players', type=int, default=2000, help='Number of players voting to skip')
+    parser.add_argument('--repeats', type=int, default=3, help='Times each card claims and each player votes')
+    parser.add_argument('--threads', type=int, default=16, help='Threads adding claims and votes, per process')
+    parser.add_argument('--processes', type=int, default=4, help='Processes sharing the SQLite store')
+    parser.add_argument('--store', choices=['memory', 'sqlite', 'both'], default='both', help='The store to test')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    problems = 0
+    if args.store in ('memory', 'both'):
+        problems += stress_memory_store(args)
+    if args.store in ('sqlite', 'both'):
+        problems += stress_sqlite_store(args)
+    sys.exit(1 if problems else 0)
@@ -1,8 +1,17 @@
 # on branch web-view-2
 
-from flask import Flask, render_template, render_template_string, request, jsonify, session, redirect, url_for, make_response
+from flask import Flask, Response, render_template, render_template_string, request, jsonify, session, redirect, url_for, make_response, g
 import os, json
+import gzip
 import time
+import threading
+import sqlite3
+import heapq
+import hashlib
+import math
+import logging
+import urllib.request
+from contextlib import contextmanager
 
 
 
@@ -13,45 +22,897 @@ app = Flask(__name__)
 #       the session data.
 app.secret_key = 'MINGO_SECRET_KEY'
 
-stop_requests = []
-
 run_on_host = os.environ.get('RUN_ON_HOST') 
 using_port = os.environ.get('USING_PORT')
 update_interval = os.environ.get('MINGO_UPDATE_INTERVAL')
 debug_mode = os.environ.get('MINGO_DEBUG_MODE')
 
-print(f"run_on_host: {run_on_host}, Using Port: {using_port}, Update interval: {update_interval}, Debug: {debug_mode}")
-
-songs = []
-cards = {}
-votes_required = None
-number_of_players = 0
-refresh_screen = []
-
-# List of card numbers that have claimed a win. Kept as a list
-# to provide for the case where more than one card is claimed to be a winner.
-win_claims = []
-playlist_name = None
-
+# Diagnostic messages go through logging. MINGO_LOG_LEVEL=DEBUG shows every request's
+# details, which is too much to write to the Pi's SD card during a game.
+log = logging.getLogger('mingo_web')
+logging.basicConfig(level=os.environ.get('MINGO_LOG_LEVEL', 'INFO'), format='%(levelname)s %(message)s')
+
+log.info(f"run_on_host: {run_on_host}, Using Port: {using_port}, Update interval: {update_interval}, Debug: {debug_mode}")
+
+# Seconds between keep-alive comments on an idle stream. Writing something now and
+# then lets the server notice browsers that have gone away.
+stream_keepalive_sec = 15
+
+# Where the game state is kept. 'memory' keeps it in this process, which only works
+# with a single server process. 'sqlite' keeps it in a shared SQLite database so that
+# several server processes can run the same game. Every phone's open /stream holds a
+# worker thread for as long as it stays connected, so a gthread worker needs a thread
+# for each of its share of the players plus some for ordinary requests. For 200 
+# players on 4 workers:
+#     MINGO_STATE_BACKEND=sqlite gunicorn -w 4 -k gthread --threads 80 -b 0.0.0.0:8080 mingo_web:app
+# or use an async worker class, where an open stream costs a greenlet, not a thread:
+#     MINGO_STATE_BACKEND=sqlite gunicorn -w 4 -k gevent --worker-connections 1000 -b 0.0.0.0:8080 mingo_web:app
+# The database keeps the game state across restarts. Delete it to start over.
+state_backend = os.environ.get('MINGO_STATE_BACKEND', 'memory')
+state_db_pathname = os.environ.get('MINGO_STATE_DB', './.mingo_web_state.db')
+
+# Seconds between checks of the shared state version. Other server processes can't
+# wake a stream directly, so one thread in each process watches the version for all
+# of that process's open streams.
+state_poll_sec = 0.25
+
+# Where to tell the game engine that a win claim or enough votes to skip are waiting,
+# for example http://127.0.0.1:8090/notify. The engine then polls for them at once
+# instead of at its next regular poll. If this is not set, or the engine can't be
+# reached, the engine still finds them by polling.
+engine_notify_url = os.environ.get('MINGO_ENGINE_NOTIFY_URL')
+engine_notify_timeout_sec = 2
+
+
+#-------------------------------------------------------------------
+# PlayerSlots class - Hands out player ids. A heap holds the free ids so 
+# the lowest one is found in O(log n), and bytearrays indexed by player 
+# id hold each slot's flags. A login is valid exactly while its slot is
+# active, so that flag is not kept separately. Not thread safe, the
+# owner holds a lock.
+#-------------------------------------------------------------------
+class PlayerSlots():
+    def __init__(self, n_slots):
+        self.active = bytearray(n_slots)
+        self.reset_storage = bytearray(n_slots)
+        self.n_active = 0
+        # Free ids. An id taken directly by take() stays in the heap and is 
+        # skipped when it reaches the top, so the heap may hold stale entries.
+        self._free = list(range(n_slots))
+
+    def __len__(self):
+        return len(self.active)
+
+    def grow(self):
+        # Adds a new free slot after all of the existing ones and returns its id
+        slot = len(self.active)
+        self.active.append(0)
+        self.reset_storage.append(0)
+        heapq.heappush(self._free, slot)
+        return slot
+
+    def lowest_free(self):
+        # Returns the lowest free id, growing if every slot is active
+        while len(self._free) > 0:
+            if not self.active[self._free[0]]:
+                return self._free[0]
+            heapq.heappop(self._free)
+        return self.grow()
+
+    def take(self, slot):
+        # Makes a free slot active. Returns False if it is already active or doesn't exist.
+        if slot < 0 or slot >= len(self.active) or self.active[slot]:
+            return False
+        self.active[slot] = 1
+        self.reset_storage[slot] = 1
+        self.n_active += 1
+        if len(self._free) > 0 and self._free[0] == slot:
+            heapq.heappop(self._free)
+        elif len(self._free) > 2 * (len(self.active) - self.n_active) + 64:
+            # Too many stale entries, rebuild from the free slots
+            self._free = [free_slot for free_slot in range(len(self.active)) if not self.active[free_slot]]
+        return True
+
+    def release(self, slot):
+        if slot < 0 or slot >= len(self.active):
+            return
+        if self.active[slot]:
+            self.active[slot] = 0
+            self.n_active -= 1
+            heapq.heappush(self._free, slot)
+        self.reset_storage[slot] = 1
+
+    def release_all(self):
+        # Every slot goes free. This is O(n) but done with bytearray fills, and 
+        # a sorted list is already a heap.
+        n_slots = len(self.active)
+        self.active = bytearray(n_slots)
+        self.reset_storage = bytearray(b'\x01' * n_slots)
+        self.n_active = 0
+        self._free = list(range(n_slots))
+
+    def reset_all_storage(self):
+        self.reset_storage = bytearray(b'\x01' * len(self.reset_storage))
+
+    def take_reset_storage(self, slot):
+        # Returns and clears the slot's reset flag
+        reset_storage = bool(self.reset_storage[slot])
+        self.reset_storage[slot] = 0
+        return reset_storage
+
+    def is_active(self, slot):
+        return 0 <= slot < len(self.active) and self.active[slot] == 1
+
+    def active_ids(self):
+        return {slot for slot, active in enumerate(self.active) if active}
+
+    def inactive_ids(self):
+        return {slot for slot, active in enumerate(self.active) if not active}
+
+
+#-------------------------------------------------------------------
+# GameStateStore class - All of the game state that the web controller
+# keeps: players, cards, votes and win claims. Requests are handled on
+# many threads at once, so each part of the state has its own lock and
+# every change is made by a method of this class while holding it.
+# Methods that hand state over to the engine, like drain_win_claims,
+# take it and clear it in one step so nothing arriving in between is
+# lost.
+#-------------------------------------------------------------------
+class GameStateStore():
+    def __init__(self, n_player_ids=6):
+        self._players_lock = threading.Lock()
+        self._votes_lock = threading.Lock()
+        self._claims_lock = threading.Lock()
+        self._cards_lock = threading.Lock()
+
+        # The tapped/untapped state of a player's game is kept in JavaScript persistent storage
+        # on the browser. This allows state to persist between screen refreshes in the case where
+        # a twitchy user refreshes the screen during game play. Without saved state, the state 
+        # of the game is lost when the page refresh occurs. 
+        # In JavaScript the localStorage feature is uses to store the state.
+        #
+        # Each player slot has a reset_storage flag that tells for each player/card number whether
+        # a GET request needs to reset the browser-side state for the user. This state is initially all
+        # untapped except for the center square. When a GET is issued for the card page, the flag 
+        # determines whether to use saved state or to wipe the board (and the state) to its starting
+        # untapped status.
+        self._players = PlayerSlots(n_player_ids)
+        self._lock_flag = False
+
+        self._stop_requests = []
+        self._votes_required = None
+
+        # List of card numbers that have claimed a win. Kept as a list
+        # to provide for the case where more than one card is claimed to be a winner.
+        self._win_claims = []
+
+        # Results of checking win claims, keyed by card number. The game engine verifies each
+        # claim and posts the result to /claim_result. A claim that has not been checked yet
+        # has a verified value of None. Results are pushed to the players with the game state.
+        self._claim_results = {}
+
+        self._cards = {}
+        # Bumped whenever the cards or the game they belong to change, so rendered
+        # card pages can tell when they are out of date
+        self._cards_version = 0
+        self._playlist_name = None
+        self._number_of_players = 0
+        self._refresh_screen = []
+
+        # The cards closest to winning, as last posted by the game engine after a track was
+        # played. The engine maintains the leaderboard, this just holds on to it.
+        self._leaders = {'leaders': [], 'need_counts': []}
+
+        # Player browsers hold open an event stream (/stream), and the server pushes the
+        # game state only when it changes. The version is bumped by publish() whenever
+        # the votes, votes required, refresh flags or claim results change, and the
+        # condition wakes up every open stream so it can send the change.
+        self._version_condition = threading.Condition()
+        self._version = 0
+
+    #--- Game state pushed to player browsers ---
+
+    def publish(self):
+        with self._version_condition:
+            self._version += 1
+            self._version_condition.notify_all()
+
+    def wait_for_change(self, seen_version, timeout):
+        # Waits until the version differs from seen_version, or the timeout passes,
+        # and returns the current version
+        with self._version_condition:
+            if self._version == seen_version:
+                self._version_condition.wait(timeout=timeout)
+            return self._version
+
+    def current_game_state(self):
+        with self._votes_lock:
+            state = {'stoprequests': list(self._stop_requests), 
+                     'votes_required': self._votes_required}
+        with self._cards_lock:
+            state['refresh_screen'] = list(self._refresh_screen)
+        with self._claims_lock:
+            state['claim_results'] = dict(self._claim_results)
+        return state
+
+    #--- Players ---
+
+    def assign_player(self, player_id):
+        # Activates a specific player id, if it is free. Returns True if it was.
+        with self._players_lock:
+            return self._players.take(player_id)
+
+    def join(self, current_player_id=None):
+        '''
+        Gives a joining player the lowest free player id.
+
+            parameters:
+                current_player_id: The id the player already has, if any. It is released.
+
+            returns:
+                The new player id, or None if the game is locked
+        '''
+        with self._players_lock:
+            if self._lock_flag:
+                return None
+            # If we use up all the pre-allocated player ids, this grows by one and carries on.
+            new_player_id = self._players.lowest_free()
+            self._players.take(new_player_id)
+            if current_player_id is not None and current_player_id != new_player_id:
+                self._players.release(current_player_id)
+            return new_player_id
+
+    def release_player(self, player_id):
+        with self._players_lock:
+            self._players.release(player_id)
+
+    def add_inactive_player(self):
+        with self._players_lock:
+            return self._players.grow()
+
+    def toggle_lock(self):
+        with self._players_lock:
+            self._lock_flag = not self._lock_flag
+            return self._lock_flag
+
+    def sign_off_all(self):
+        with self._players_lock:
+            self._players.release_all()
+
+    def open_card(self, player_id):
+        '''
+        Checks a player's login when their card page is requested.
+
+            returns:
+                None if the player's login is no longer valid. Otherwise whether the
+                browser should reset its saved card state, and the flag is cleared.
+        '''
+        with self._players_lock:
+            if not self._players.is_active(player_id):
+                return None
+            return self._players.take_reset_storage(player_id)
+
+    def reset_all_storage(self):
+        with self._players_lock:
+            self._players.reset_all_storage()
+
+    def player_count(self):
+        with self._players_lock:
+            return self._players.n_active
+
+    def admin_view(self):
+        with self._players_lock:
+            return {'lock_flag': self._lock_flag,
+                    'active_player_ids': self._players.active_ids(),
+                    'inactive_player_ids': self._players.inactive_ids(),
+                    'invalid_login': [not active for active in self._players.active]}
+
+    #--- Votes to skip the current track ---
+
+    def add_stop_request(self, player_id):
+        # Returns True if the vote was recorded, False if the player had already voted
+        with self._votes_lock:
+            if player_id in self._stop_requests:
+                return False
+            self._stop_requests.append(player_id)
+        self.publish()
+        return True
+
+    def stop_requests(self):
+        with self._votes_lock:
+            return list(self._stop_requests)
+
+    def stop_count(self):
+        with self._votes_lock:
+            return len(self._stop_requests)
+
+    def clear_stop_requests(self):
+        with self._votes_lock:
+            self._stop_requests.clear()
+        self.publish()
+
+    def set_votes_required(self, votes_required):
+        with self._votes_lock:
+            self._votes_required = votes_required
+        self.publish()
+
+    def votes_required(self):
+        with self._votes_lock:
+            return self._votes_required
+
+    #--- Win claims ---
+
+    def add_win_claim(self, card_nbr):
+        # Duplicates are not allowed. Returns True if the claim was added.
+        # Card numbers are kept as strings, the same as the SQLite store returns them.
+        card_nbr = str(card_nbr)
+        with self._claims_lock:
+            if card_nbr in self._win_claims:
+                return False
+            self._win_claims.append(card_nbr)
+            self._claim_results[str(card_nbr)] = {'verified': None, 'lines': []}
+        self.publish()
+        return True
+
+    def drain_win_claims(self):
+        # Returns the waiting claims and clears them in one step
+        with self._claims_lock:
+            claims = self._win_claims
+            self._win_claims = []
+            return claims
+
+    def set_claim_result(self, card_nbr, verified, lines):
+        with self._claims_lock:
+            self._claim_results[str(card_nbr)] = {'verified': verified, 'lines': lines}
+        self.publish()
+
+    def set_leaders(self, leaders):
+        with self._claims_lock:
+            self._leaders = leaders
+
+    def leaders(self, n_leaders):
+        with self._claims_lock:
+            return {'leaders': self._leaders['leaders'][:n_leaders],
+                    'need_counts': self._leaders['need_counts']}
+
+    #--- Cards ---
+
+    def load_card(self, card_nbr, titles):
+        with self._cards_lock:
+            self._cards[str(card_nbr)] = list(titles)
+            self._cards_version += 1
+
+    def load_cards(self, cards):
+        # Replaces all cards. cards is a dict of card number to its titles.
+        new_cards = {str(card_nbr): list(titles) for card_nbr, titles in cards.items()}
+        with self._cards_lock:
+            self._cards = new_cards
+            self._cards_version += 1
+
+    def has_cards(self):
+        with self._cards_lock:
+            return len(self._cards) > 0
+
+    def cards_version(self):
+        with self._cards_lock:
+            return self._cards_version
+
+    def card_titles(self, card_nbr):
+        # Returns None if there is no such card
+        with self._cards_lock:
+            return self._cards.get(str(card_nbr))
+
+    def playlist_name(self):
+        with self._cards_lock:
+            return self._playlist_name
+
+    def set_game_misc_data(self, playlist_name, number_of_players, refresh_flag):
+        with self._cards_lock:
+            self._playlist_name = playlist_name
+            self._number_of_players = number_of_players
+            self._refresh_screen = [refresh_flag for _ in range(number_of_players)]
+            self._cards_version += 1
+        with self._claims_lock:
+            self._claim_results.clear()
+        self.publish()
+
+    def clear_refresh(self, player_nbr):
+        with self._cards_lock:
+            if 0 <= player_nbr < len(self._refresh_screen):
+                self._refresh_screen[player_nbr] = False
+        self.publish()
+
+
+#-------------------------------------------------------------------
+# SQLiteGameStateStore class - The same game state and methods as 
+# GameStateStore, kept in a SQLite database so that several server 
+# processes can share one game. The database is in WAL mode, so reads
+# don't wait for writes. Changes that read and then write take the
+# database write lock first (BEGIN IMMEDIATE), which makes them atomic
+# across processes as well as threads.
+#-------------------------------------------------------------------
+class SQLiteGameStateStore():
+    def __init__(self, pathname=state_db_pathname, n_player_ids=6):
+        self.pathname = pathname
+        # Each thread gets its own connection
+        self._local = threading.local()
+
+        # Open streams wait on this condition for the version to change. One watcher
+        # thread per process reads the version for all of them, and a publish in this
+        # process wakes them at once.
+        self._version_condition = threading.Condition()
+        self._version = None
+        self._n_waiting = 0
+        self._watcher_pid = None
+
+        with self._transaction() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+                                key TEXT PRIMARY KEY,
+                                value TEXT NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS players (
+                                player_id INTEGER PRIMARY KEY,
+                                active INTEGER NOT NULL,
+                                invalid_login INTEGER NOT NULL,
+                                reset_storage INTEGER NOT NULL)""")
+            # Finds the lowest free player id without scanning the table
+            conn.execute('CREATE INDEX IF NOT EXISTS players_by_active ON players (active, player_id)')
+            conn.execute("""CREATE TABLE IF NOT EXISTS stop_requests (
+                                seq INTEGER PRIMARY KEY,
+                                player_id INTEGER NOT NULL UNIQUE)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS win_claims (
+                                seq INTEGER PRIMARY KEY,
+                                card_nbr INTEGER NOT NULL UNIQUE)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS claim_results (
+                                card_nbr TEXT PRIMARY KEY,
+                                result TEXT NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS cards (
+                                card_nbr TEXT PRIMARY KEY,
+                                titles TEXT NOT NULL)""")
+            # Only fills in what isn't there, so a process starting up doesn't
+            # wipe out a game that other processes are already running
+            defaults = {'version': 0, 'cards_version': 0, 'lock_flag': False, 'votes_required': None,
+                        'playlist_name': None, 'refresh_screen': [],
+                        'leaders': {'leaders': [], 'need_counts': []}}
+            conn.executemany('INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                                [(key, json.dumps(value)) for key, value in defaults.items()])
+            conn.executemany('INSERT OR IGNORE INTO players VALUES (?, 0, 1, 0)',
+                                [(player_id,) for player_id in range(n_player_ids)])
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.pathname, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _get(self, conn, key):
+        return json.loads(conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()[0])
+
+    def _set(self, conn, key, value):
+        conn.execute('UPDATE meta SET value = ? WHERE key = ?', (json.dumps(value), key))
+
+    #--- Game state pushed to player browsers ---
+
+    def publish(self):
+        with self._transaction() as conn:
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            version = self._get(conn, 'version')
+        self._version_seen(version)
+
+    def wait_for_change(self, seen_version, timeout):
+        # Each call reads the version once, since the cached one is only kept up to
+        # date while a stream waits. While waiting, streams rely on the watcher, so
+        # the database is polled by one thread however many are open. The version
+        # returned is never older than seen_version.
+        version = self._get(self._connection(), 'version')
+        if seen_version is None:
+            return version
+        self._version_seen(version)
+        deadline = time.monotonic() + timeout
+        with self._version_condition:
+            self._start_watcher()
+            self._n_waiting += 1
+            self._version_condition.notify_all()
+            try:
+                while self._version <= seen_version:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._version_condition.wait(remaining)
+                return max(seen_version, self._version)
+            finally:
+                self._n_waiting -= 1
+
+    def _version_seen(self, version):
+        # Versions only go up, so an older read never replaces a newer one
+        with self._version_condition:
+            if self._version is None or version > self._version:
+                self._version = version
+                self._version_condition.notify_all()
+
+    def _start_watcher(self):
+        # Called holding the condition. The thread is started on first use, and again
+        # in a process forked from this one, since threads don't survive a fork.
+        if self._watcher_pid != os.getpid():
+            self._watcher_pid = os.getpid()
+            threading.Thread(target=self._watch_version, daemon=True).start()
+
+    def _watch_version(self):
+        # Reads the version every state_poll_sec while any stream is waiting
+        while True:
+            with self._version_condition:
+                while self._n_waiting == 0:
+                    self._version_condition.wait()
+            self._version_seen(self._get(self._connection(), 'version'))
+            time.sleep(state_poll_sec)
+
+    def current_game_state(self):
+        # Read in one transaction so the values are consistent with each other
+        conn = self._connection()
+        conn.execute('BEGIN')
+        try:
+            return {'stoprequests': [row[0] for row in conn.execute(
+                                        'SELECT player_id FROM stop_requests ORDER BY seq')],
+                    'votes_required': self._get(conn, 'votes_required'),
+                    'refresh_screen': self._get(conn, 'refresh_screen'),
+                    'claim_results': {card_nbr: json.loads(result) for card_nbr, result in 
+                                        conn.execute('SELECT card_nbr, result FROM claim_results')}}
+        finally:
+            conn.execute('COMMIT')
+
+    #--- Players ---
+
+    def _activate_player(self, conn, player_id):
+        conn.execute('UPDATE players SET active = 1, invalid_login = 0, reset_storage = 1 WHERE player_id = ?',
+                        (player_id,))
+
+    def _grow_player_ids(self, conn):
+        # Adds a new inactive player id after all of the existing ones
+        cursor = conn.execute('INSERT INTO players VALUES ((SELECT MAX(player_id) + 1 FROM players), 0, 1, 0)')
+        return cursor.lastrowid
+
+    def assign_player(self, player_id):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT active FROM players WHERE player_id = ?', (player_id,)).fetchone()
+            if row is None or row[0]:
+                return False
+            self._activate_player(conn, player_id)
+            return True
+
+    def join(self, current_player_id=None):
+        with self._transaction() as conn:
+            if self._get(conn, 'lock_flag'):
+                return None
+            new_player_id = conn.execute('SELECT MIN(player_id) FROM players WHERE active = 0').fetchone()[0]
+            if new_player_id is None:
+                new_player_id = self._grow_player_ids(conn)
+            if current_player_id is not None:
+                conn.execute('UPDATE players SET active = 0, invalid_login = 1, reset_storage = 1 WHERE player_id = ?',
+                                (current_player_id,))
+            self._activate_player(conn, new_player_id)
+            return new_player_id
+
+    def release_player(self, player_id):
+        with self._transaction() as conn:
+            conn.execute('UPDATE players SET active = 0, invalid_login = 1, reset_storage = 1 WHERE player_id = ?',
+                            (player_id,))
+
+    def add_inactive_player(self):
+        with self._transaction() as conn:
+            return self._grow_player_ids(conn)
+
+    def toggle_lock(self):
+        with self._transaction() as conn:
+            lock_flag = not self._get(conn, 'lock_flag')
+            self._set(conn, 'lock_flag', lock_flag)
+            return lock_flag
+
+    def sign_off_all(self):
+        with self._transaction() as conn:
+            conn.execute('UPDATE players SET active = 0, invalid_login = 1, reset_storage = 1')
+
+    def open_card(self, player_id):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT invalid_login, reset_storage FROM players WHERE player_id = ?',
+                                (player_id,)).fetchone()
+            if row is None or row[0]:
+                return None
+            conn.execute('UPDATE players SET reset_storage = 0 WHERE player_id = ?', (player_id,))
+            return bool(row[1])
+
+    def reset_all_storage(self):
+        with self._transaction() as conn:
+            conn.execute('UPDATE players SET reset_storage = 1')
+
+    def player_count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM players WHERE active = 1').fetchone()[0]
+
+    def admin_view(self):
+        conn = self._connection()
+        rows = conn.execute('SELECT player_id, active, invalid_login FROM players ORDER BY player_id').fetchall()
+        return {'lock_flag': self._get(conn, 'lock_flag'),
+                'active_player_ids': {player_id for player_id, active, _ in rows if active},
+                'inactive_player_ids': {player_id for player_id, active, _ in rows if not active},
+                'invalid_login': [bool(invalid) for _, _, invalid in rows]}
+
+    #--- Votes to skip the current track ---
+
+    def add_stop_request(self, player_id):
+        with self._transaction() as conn:
+            added = conn.execute('INSERT OR IGNORE INTO stop_requests (player_id) VALUES (?)', 
+                                    (player_id,)).rowcount > 0
+        if added:
+            self.publish()
+        return added
+
+    def stop_requests(self):
+        return [row[0] for row in self._connection().execute('SELECT player_id FROM stop_requests ORDER BY seq')]
+
+    def stop_count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM stop_requests').fetchone()[0]
+
+    def clear_stop_requests(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM stop_requests')
+        self.publish()
+
+    def set_votes_required(self, votes_required):
+        with self._transaction() as conn:
+            self._set(conn, 'votes_required', votes_required)
+        self.publish()
+
+    def votes_required(self):
+        return self._get(self._connection(), 'votes_required')
+
+    #--- Win claims ---
+
+    def add_win_claim(self, card_nbr):
+        with self._transaction() as conn:
+            added = conn.execute('INSERT OR IGNORE INTO win_claims (card_nbr) VALUES (?)', 
+                                    (card_nbr,)).rowcount > 0
+            if added:
+                conn.execute('INSERT OR REPLACE INTO claim_results VALUES (?, ?)', 
+                                (str(card_nbr), json.dumps({'verified': None, 'lines': []})))
+        if added:
+            self.publish()
+        return added
+
+    def drain_win_claims(self):
+        with self._transaction() as conn:
+            # The column is an integer, but the engine gets strings from both stores
+            claims = [str(row[0]) for row in conn.execute('SELECT card_nbr FROM win_claims ORDER BY seq')]
+            conn.execute('DELETE FROM win_claims')
+            return claims
+
+    def set_claim_result(self, card_nbr, verified, lines):
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO claim_results VALUES (?, ?)', 
+                            (str(card_nbr), json.dumps({'verified': verified, 'lines': lines})))
+        self.publish()
+
+    def set_leaders(self, leaders):
+        with self._transaction() as conn:
+            self._set(conn, 'leaders', leaders)
+
+    def leaders(self, n_leaders):
+        leaders = self._get(self._connection(), 'leaders')
+        return {'leaders': leaders['leaders'][:n_leaders],
+                'need_counts': leaders['need_counts']}
+
+    #--- Cards ---
+
+    def load_card(self, card_nbr, titles):
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO cards VALUES (?, ?)', (str(card_nbr), json.dumps(list(titles))))
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'cards_version'")
+
+    def load_cards(self, cards):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM cards')
+            conn.executemany('INSERT INTO cards VALUES (?, ?)',
+                                [(str(card_nbr), json.dumps(list(titles))) for card_nbr, titles in cards.items()])
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'cards_version'")
+
+    def has_cards(self):
+        return self._connection().execute('SELECT EXISTS (SELECT 1 FROM cards)').fetchone()[0] == 1
+
+    def cards_version(self):
+        return self._get(self._connection(), 'cards_version')
+
+    def card_titles(self, card_nbr):
+        row = self._connection().execute('SELECT titles FROM cards WHERE card_nbr = ?', (str(card_nbr),)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def playlist_name(self):
+        return self._get(self._connection(), 'playlist_name')
+
+    def set_game_misc_data(self, playlist_name, number_of_players, refresh_flag):
+        with self._transaction() as conn:
+            self._set(conn, 'playlist_name', playlist_name)
+            self._set(conn, 'refresh_screen', [refresh_flag for _ in range(number_of_players)])
+            conn.execute('DELETE FROM claim_results')
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'cards_version'")
+        self.publish()
+
+    def clear_refresh(self, player_nbr):
+        with self._transaction() as conn:
+            refresh_screen = self._get(conn, 'refresh_screen')
+            if 0 <= player_nbr < len(refresh_screen):
+                refresh_screen[player_nbr] = False
+                self._set(conn, 'refresh_screen', refresh_screen)
+        self.publish()
+
+
+if state_backend == 'sqlite':
+    log.info(f'Keeping game state in {state_db_pathname}')
+    game_state = SQLiteGameStateStore()
+else:
+    game_state = GameStateStore()
+
+
+#-------------------------------------------------------------------
+# CardPageCache class - Rendered card pages. A card's titles don't 
+# change during a game, so each page is rendered once and kept, along 
+# with a gzip copy and an ETag, until the store's cards version 
+# changes. Each server process has its own cache.
+#-------------------------------------------------------------------
+class CardPageCache():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cards_version = None
+        self._pages = {}
+
+    def get(self, cards_version, card_number, reset_storage, render):
+        '''
+        Looks up a rendered card page, rendering it if it isn't cached.
+
+            parameters:
+                cards_version: The store's current cards version
+                card_number: The player's card number
+                reset_storage: The reset_storage value the page is rendered with
+                render: Function that renders the page, or returns None if there is no such card
+
+            returns:
+                An (etag, body, gzip body) tuple, or None if there is no such card
+        '''
+        key = (card_number, reset_storage)
+        with self._lock:
+            if cards_version != self._cards_version:
+                self._pages = {}
+                self._cards_version = cards_version
+            page = self._pages.get(key)
+        if page is not None:
+            return page
+
+        html = render()
+        if html is None:
+            return None
+        body = html.encode('utf-8')
+        page = (hashlib.sha1(body).hexdigest(), body, gzip.compress(body))
+        with self._lock:
+            if cards_version == self._cards_version:
+                self._pages[key] = page
+        return page
+
+card_pages = CardPageCache()
+
+
+#-------------------------------------------------------------------
+# RouteMetrics class - Request counts and latency histograms for each
+# route. Latencies are counted in fixed millisecond buckets from which
+# percentiles are estimated, so recording a request is a dictionary 
+# lookup and a few additions. Each server process keeps its own.
+#-------------------------------------------------------------------
+metrics_buckets_ms = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, math.inf)
+
+class RouteMetrics():
+    def __init__(self):
+        self._lock = threading.Lock()
+        # route -> [count, total seconds, max seconds, bucket counts, status counts]
+        self._routes = {}
+
+    def record(self, route, status_code, elapsed_sec):
+        elapsed_ms = elapsed_sec * 1000
+        bucket = 0
+        while elapsed_ms > metrics_buckets_ms[bucket]:
+            bucket += 1
+        status = f'{status_code // 100}xx'
+        with self._lock:
+            timing = self._routes.get(route)
+            if timing is None:
+                timing = self._routes[route] = [0, 0.0, 0.0, [0] * len(metrics_buckets_ms), {}]
+            timing[0] += 1
+            timing[1] += elapsed_sec
+            timing[2] = max(timing[2], elapsed_sec)
+            timing[3][bucket] += 1
+            timing[4][status] = timing[4].get(status, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            routes = {route: (count, total, maximum, list(buckets), dict(statuses)) 
+                        for route, (count, total, maximum, buckets, statuses) in self._routes.items()}
+        summary = {}
+        for route, (count, total, maximum, buckets, statuses) in sorted(routes.items()):
+            summary[route] = {'count': count,
+                              'statuses': statuses,
+                              'mean_ms': total * 1000 / count,
+                              'max_ms': maximum * 1000,
+                              'p50_ms': min(bucket_percentile(buckets, count, 0.5), maximum * 1000),
+                              'p99_ms': min(bucket_percentile(buckets, count, 0.99), maximum * 1000),
+                              'buckets_ms': {str(bound): bucket_count 
+                                                for bound, bucket_count in zip(metrics_buckets_ms, buckets)}}
+        return summary
+
+def bucket_percentile(buckets, count, fraction):
+    # Upper bound of the bucket holding the given fraction of the recorded times
+    seen = 0
+    for bucket, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen >= fraction * count:
+            return metrics_buckets_ms[bucket]
+    return metrics_buckets_ms[-1]
+
+route_metrics = RouteMetrics()
+
+
+#-------------------------------------------------------------------
+# EngineNotifier class - Tells the game engine that it has something to
+# pick up. The call is made from a thread of its own so that a player's
+# request never waits for the engine. Notices that arrive while one is
+# being sent are merged into the next one. Each server process has its
+# own thread, started on first use so that it is made after gunicorn 
+# forks the process.
+#-------------------------------------------------------------------
+class EngineNotifier():
+    def __init__(self, url):
+        self._url = url
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def notify(self):
+        if not self._url:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            start = time.perf_counter()
+            try:
+                request = urllib.request.Request(self._url, data=b'', method='POST')
+                with urllib.request.urlopen(request, timeout=engine_notify_timeout_sec) as response:
+                    status = response.status
+            except OSError as e:
+                log.debug(f'Could not notify the game engine: {e}')
+                status = 0
+            route_metrics.record('notify engine', status, time.perf_counter() - start)
 
-# The tapped/untapped state of a player's game is kept in JavaScript persistent storage
-# on the browser. This allows state to persist between screen refreshes in the case where
-# a twitchy user refreshes the screen during game play. Without saved state, the state 
-# of the game is lost when the page refresh occurs. 
-# In JavaScript the localStorage feature is uses to store the state.
-#
-# reset_player_storage is an array of boolean that tells for each player/card number whether
-# a GET request needs to reset the browser-side state for the user. This state is initially all
-# untapped except for the center square. When a GET is issued for the card page, the flag 
-# determines whether to use saved state or to wipe the board (and the state) to its starting
-# untapped status.
-active_player_ids = set()
-inactive_player_ids = set([0,1,2,3,4,5])
-reset_player_storage = [False for _ in range(len(inactive_player_ids))]
-invalid_login = [True for _ in range(len(inactive_player_ids))]
+engine_notifier = EngineNotifier(engine_notify_url)
 
-lock_flag = False
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
 @app.after_request
 def add_cors_headers(response):
@@ -60,19 +921,27 @@ def add_cors_headers(response):
     response.headers['Access-Control-Allow-Headers']='Content-Type'
     return response
 
+@app.after_request
+def record_request_metrics(response):
+    # Routes are recorded by their rule, so /3 and /4 both count as /<int:player_id>.
+    # A stream is timed until its response starts, not for as long as it stays open.
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        route_metrics.record(f'{request.method} {route}', response.status_code, 
+                             time.perf_counter() - g.request_start)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Counts and latencies of this server process's requests, by route
+    return jsonify({'pid': os.getpid(), 'routes': route_metrics.summary()})
+
 @app.route('/<int:player_id>', methods=['GET'])
 def assign_player_id(player_id):
-    global active_player_ids
-    global inactive_player_ids
-
     # session.permanent = True
 
-    if not player_id in active_player_ids and player_id in inactive_player_ids:
-        print('Assigning player id', player_id)
-        active_player_ids.add(player_id)
-        inactive_player_ids.remove(player_id)
-        update_validity_flags()
-
+    if game_state.assign_player(player_id):
+        log.debug(f'Assigning player id {player_id}')
         return activate_player(player_id)
 
     else:
@@ -81,43 +950,17 @@ def assign_player_id(player_id):
                               run_on_host=run_on_host, 
                               using_port=using_port)
 
-def update_validity_flags():
-    global active_player_ids
-    global inactive_player_ids
-    global invalid_login
-
-    for _ in active_player_ids:
-        invalid_login[_] = False
-    for _ in inactive_player_ids:
-        invalid_login[_] = True
-
-
 
 @app.route('/rel', methods=['GET'])
 def release_player_id():
-    global active_player_ids
-    global inactive_player_ids
-    global reset_player_storage
-    
     release_id = 'Unknown Id'
-    print ('Active player_ids: ', active_player_ids)
     if 'player_id' in session:
         release_id = session['player_id']
-        if release_id in active_player_ids:
-            active_player_ids.remove(release_id)
-            inactive_player_ids.add(release_id)
+        game_state.release_player(release_id)
             
         session.pop('player_id', None)
 
-        if 'player_id' in session:
-            print('I thought player_id was removed from session, but NO!')
-        else:
-            print('Player id is not in session anymore')
-
-        reset_player_storage[release_id] = True
-        update_validity_flags()
-
-        print(f'Released {release_id} for reuse and removed player_id from session')
+        log.debug(f'Released {release_id} for reuse and removed player_id from session')
 
     return render_template('released.html',
                             player_id=release_id,
@@ -126,72 +969,65 @@ def release_player_id():
     
 @app.route('/addInactivePlayer', methods=['GET'])
 def add_inactive_player():
-    global inactive_player_ids
-    global reset_player_storage  
-    global invalid_login
-
-    try:
-        new_player_id = max(inactive_player_ids)+1
-    except ValueError:
-        # If there are no more inactive player ids, 
-        # base the new id on the largest active player id
-        new_player_id = max(active_player_ids)+1
-
-        # Also need to grow the invalid_login and reset_player_storage lists
-        invalid_login.append(True)
-        reset_player_storage.append(False)
-
-    inactive_player_ids.add(new_player_id)
-
-    # Make sure validity flags stay in sync
-    update_validity_flags()    
-
+    game_state.add_inactive_player()
     return redirect(url_for('admin'))
 
 @app.route('/lockGame', methods=['GET'])
 def lock_game():
-    global lock_flag
-
-    lock_flag = not lock_flag
-
+    game_state.toggle_lock()
     return redirect(url_for('admin'))
   
 @app.route('/card', methods=['GET'])
 def card():
-    global cards
-    global playlist_name
-    global invalid_login
-
-    if len(cards) == 0:
+    if not game_state.has_cards():
         return redirect(url_for('not_ready'))
 
     try:
         card_number = session['player_id']
-        if invalid_login[card_number]:
+        reset_storage = game_state.open_card(card_number)
+        if reset_storage is None:
             session.pop('player_id', None)
             return key_error(card_number)
 
-        reset_storage = reset_player_storage[card_number]
-        reset_player_storage[card_number] = False
-
-        try:
-            titles = cards[str(card_number)]
-        except KeyError:
+        def render():
+            titles = game_state.card_titles(card_number)
+            if titles is None:
+                return None
+            return render_template('card_view.html', 
+                                    card_number=card_number, 
+                                    titles=titles,
+                                    run_on_host=run_on_host, 
+                                    using_port=using_port,
+                                    update_interval=update_interval,
+                                    playlist_name=game_state.playlist_name(),
+                                    reset_storage=reset_storage)
+
+        page = card_pages.get(game_state.cards_version(), card_number, reset_storage, render)
+        if page is None:
             return key_error(999) 
-
-        print('========> ', playlist_name)
-        return render_template('card_view.html', 
-                                card_number=card_number, 
-                                titles=titles,
-                                stop_requests=stop_requests, 
-                                run_on_host=run_on_host, 
-                                using_port=using_port,
-                                update_interval=update_interval,
-                                playlist_name=playlist_name,
-                                reset_storage=reset_storage)
+        return card_page_response(*page)
     except KeyError:
         return key_error(999)
 
+def card_page_response(etag, body, gzip_body):
+    # Phones refreshing a page they already have get a 304 with no body. The gzip
+    # copy gets its own ETag since it is a different representation of the page.
+    use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    if use_gzip:
+        etag = etag + '-gz'
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(gzip_body if use_gzip else body)
+        response.headers['Content-Type'] = 'text/html; charset=utf-8'
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding, Cookie'
+    # The browser must check back every time, since the page changes with the game
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/not_ready', methods=['GET'])
 def not_ready():
     player_id = session['player_id']
@@ -210,75 +1046,89 @@ def key_error(player_id):
 
 @app.route('/claimWinner', methods=['POST'])
 def claimWinner():
-    global win_claims
     data = request.get_json()
     card_claiming_win = data["card_claiming_win"]
-    print("winner claim received from card number: ", card_claiming_win)
-    # Add card claiming win to win_claims, the list of cards that need to be checked 
+    log.debug(f'winner claim received from card number: {card_claiming_win}')
+    # Add card claiming win to the list of cards that need to be checked 
     # by the game engine.
     # The game engine polls this list to see if a check should be made
-    # Duplicates are not allowed...
-    if card_claiming_win not in win_claims:
-        win_claims.append(card_claiming_win)
-        print('win_claims: ', win_claims)
+    if game_state.add_win_claim(card_claiming_win):
+        log.info(f'win claim added for card: {card_claiming_win}')
+        engine_notifier.notify()
     return jsonify({"status": "success", "received": card_claiming_win})
 
 @app.route('/win_claims', methods=['GET', 'POST'])
 def get_win_claims():
-    global win_claims
-    ret_json = jsonify({'win_claims': win_claims})
-    # time.sleep(1)
-    print ("Returning win_claims: ", win_claims)
+    # The claims are taken and cleared in one step, so a claim that arrives
+    # while this response is being built waits for the next call.
+    claims = game_state.drain_win_claims()
+    log.debug(f'Returning win_claims: {claims}')
+    return jsonify({'win_claims': claims})
+
+@app.route('/engine_poll', methods=['GET', 'POST'])
+def engine_poll():
+    # The game engine's single status call: the number of votes to skip the current
+    # track, and every win claim received since the last call. Each claim is handed 
+    # to the engine exactly once.
+    claims = game_state.drain_win_claims()
+    if len(claims) > 0:
+        log.debug(f'Handing win claims to the engine: {claims}')
+    return jsonify({'stop_count': game_state.stop_count(), 
+                    'win_claims': claims})
+
+@app.route('/claim_result', methods=['POST'])
+def claim_result():
+    json_string = request.get_json()
+    data = json.loads(json_string)
+    card_nbr = str(data["card_nbr"])
+    log.info(f'Claim result for card {card_nbr}: {data["verified"]} {data["lines"]}')
+    game_state.set_claim_result(card_nbr, data["verified"], data["lines"])
+    return jsonify({"status": "success", "received": data})
 
-    # Clear the claims list
-    win_claims.clear()
-    return ret_json
+@app.route('/leaders', methods=['GET', 'POST'])
+def get_leaders():
+    if request.method == 'POST':
+        json_string = request.get_json()
+        game_state.set_leaders(json.loads(json_string))
+        return jsonify({"status": "success"})
+    else:
+        n_leaders = request.args.get('n', default=10, type=int)
+        return jsonify(game_state.leaders(n_leaders))
 
 @app.route('/game_misc_data', methods=['POST'])
 def game_misc_data():
-    global playlist_name
-    global number_of_players
-    global refresh_screen
     json_string = request.get_json()
     data = json.loads(json_string)
-    playlist_name = data["playlist_name"]
-    print(f'Loaded cards for {playlist_name}')
-    number_of_players = int(data["number_of_players"])
-    refresh_flag = data["refresh_flag"]
-    refresh_screen.clear()
-    for _ in range(number_of_players):
-        refresh_screen.append(refresh_flag)
-
-    print(f'Number of players is {str(number_of_players)}')
+    update_game_misc_data(data)
 
     # Respond to the client
     return jsonify({"status": "success", "received": data})
 
+def update_game_misc_data(data):
+    playlist_name = data["playlist_name"]
+    log.info(f'Loaded cards for {playlist_name}')
+    number_of_players = int(data["number_of_players"])
+    game_state.set_game_misc_data(playlist_name, number_of_players, data["refresh_flag"])
+
+    log.info(f'Number of players is {str(number_of_players)}')
+
 @app.route('/clear_refresh', methods=['POST'])
 def clear_refresh():
-    global refresh_screen
     json_str = request.get_json()
-    print('==================================>>>> ', json_str)
-    # data = json.loads(json_str)
-    print('==================================>>>> ', json_str["player_nbr"])
-    # print("clear_refresh: ", json_string)
     player_nbr = json_str["player_nbr"]
-    refresh_screen[int(player_nbr)] = False
-    # print(f'Cleared refresh flag for: ', player_nbr)
+    game_state.clear_refresh(int(player_nbr))
+    log.debug(f'Cleared refresh flag for: {player_nbr}')
     return jsonify({"status": "success", "received": "OK"})
 
 
 @app.route('/admin', methods=['GET'])
 def admin():
-    global active_player_ids
-    global inactive_player_ids
-    global invalid_login
-    
+    players = game_state.admin_view()
     response = make_response( render_template('admin.html',
-                            lock_flag=lock_flag,
-                            active_player_ids=active_player_ids,
-                            inactive_player_ids=inactive_player_ids,
-                            invalid_login=invalid_login,
+                            lock_flag=players['lock_flag'],
+                            active_player_ids=players['active_player_ids'],
+                            inactive_player_ids=players['inactive_player_ids'],
+                            invalid_login=players['invalid_login'],
                             run_on_host=run_on_host, 
                             using_port=using_port))
 
@@ -290,20 +1140,7 @@ def admin():
 
 @app.route('/signOffAll', methods=['GET','POST'])
 def sign_off_all():
-    global active_player_ids
-    global inactive_player_ids
-    global reset_player_storage
-    global invalid_login
-
-    reset_player_storage = [True for _ in range(len(reset_player_storage))]
-    invalid_login = [True for _ in range(len(invalid_login))]
-    
-
-    for _ in range (len(active_player_ids)):
-        player_id = active_player_ids.pop()
-        inactive_player_ids.add(player_id)
-
-
+    game_state.sign_off_all()
     return redirect(url_for('admin'))
 
 
@@ -312,67 +1149,21 @@ def sign_off_all():
 #     permit rejoin with another id. First id must be released! Then join again.
 @app.route('/join', methods=['GET'])
 def join_game():
-    global active_player_ids
-    global inactive_player_ids
-    global invalid_login
-
-    if not lock_flag:
-        if 'player_id' in session:
-            # This user already has a player id. Handle an attempt to join again
-            # by starting the player over with a new id. Return the current id to
-            # the pool of available ids.
-            player_id = session['player_id']
-
-            try:
-                new_player_id = min(inactive_player_ids)
-            except ValueError:
-                # If we use up all the pre-allocated player ids, grow by one and carry on.
-                new_player_id = max(active_player_ids)+1
-                inactive_player_ids.add(new_player_id)
-                # Also need to grow the invalid_login and reset_player_storage lists
-                invalid_login.append(True)
-                reset_player_storage.append(False)
-
-            inactive_player_ids.remove(new_player_id)
-            inactive_player_ids.add(player_id)
-            if player_id in active_player_ids:
-                active_player_ids.remove(player_id)
-                inactive_player_ids.add(player_id)
-                update_validity_flags()
-        
-            return activate_player(new_player_id)
-        
-        elif len(inactive_player_ids) > 0:
-            # player_id = inactive_player_ids.pop()
-            player_id = min(inactive_player_ids)
-            inactive_player_ids.remove(player_id)
-            update_validity_flags()
-            return activate_player(player_id)
+    # A user that already has a player id is started over with a new id, and 
+    # the current id is returned to the pool of available ids.
+    player_id = game_state.join(session.get('player_id'))
+    if player_id is not None:
+        return activate_player(player_id)
     else:
         return render_template('game_is_locked.html', 
                             run_on_host=run_on_host, 
                             using_port=using_port)
        
-    
-
-
 
 def activate_player(player_id):        
-    global active_player_ids
-    global inactive_player_ids
-    global invalid_login
-    global reset_player_storage
-
     session['player_id'] = player_id
-    reset_player_storage[player_id] = True
-    invalid_login[player_id] = False
-
-    active_player_ids.add(player_id)
-    if player_id in inactive_player_ids:
-        inactive_player_ids.remove(player_id)
-
 
-    if len(cards) != 0:
+    if game_state.has_cards():
         return redirect(url_for('card'))
     else:
         return render_template('game_not_ready.html', 
@@ -385,33 +1176,22 @@ def activate_player(player_id):
 
 @app.route('/card_load', methods=['POST'])
 def card_load():
-    global cards
-    global reset_player_storage
-
-    reset_player_storage = [True for _ in range(len(reset_player_storage))]
+    game_state.reset_all_storage()
 
     # Get the JSON data from the request
     json_string = request.get_json()
-    # print("Received data:", data)
-    # print (json_to_songs(data))
     # Parse the JSON string into a Python dictionary
     data = json.loads(json_string)
 
     # Get the card number
     card_nbr = data["card_nbr"]
-    print("Loading card number", card_nbr)
+    log.debug(f'Loading card number {card_nbr}')
 
     # Extract the list of song titles
-    # Start with an empty list
-    songs.append([])
-    songs_temp = [song["title"] for song in data["songs"]]
-    for song in songs_temp:
-        print('adding ', song, ' ', card_nbr)
-        songs[len(songs)-1].append(song)
-    
-    cards.update({str(card_nbr): songs[len(songs)-1]})
+    titles = [song["title"] for song in data["songs"]]
+    game_state.load_card(card_nbr, titles)
 
-    print('\n\n\n========= Loaded: ',str(card_nbr),'\n',cards[str(card_nbr)])
+    log.debug(f'Loaded card {card_nbr}: {titles}')
 
     if card_nbr == 1:
         card_debug()
@@ -419,14 +1199,31 @@ def card_load():
     # Respond to the client
     return jsonify({"status": "success", "received": data})
 
+@app.route('/cards_bulk', methods=['POST'])
+def cards_bulk():
+    # Loads every card of a game in one request, replacing any cards loaded before.
+    # The body is JSON, optionally gzip compressed, holding a list of cards (each with
+    # a card_nbr and its 25 titles) plus the same fields that /game_misc_data takes.
+    body = request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    data = json.loads(body)
+
+    game_state.reset_all_storage()
+    game_state.load_cards({card["card_nbr"]: card["titles"] for card in data["cards"]})
+    log.info(f'Loaded {len(data["cards"])} cards')
+
+    update_game_misc_data(data)
+
+    return jsonify({"status": "success", "cards_loaded": len(data["cards"])})
+
 @app.route('/set_votes_required', methods=['POST'])
 def set_votes_required():
-    global votes_required
     if request.method == 'POST':
         json_string = request.get_json()
         data = json.loads(json_string)
-        print("Received votes_required data:", data)
-        votes_required = data["votes_required"]
+        log.debug(f'Received votes_required data: {data}')
+        game_state.set_votes_required(data["votes_required"])
         return jsonify({'votes_required': 'OK'})    
 
 
@@ -434,7 +1231,7 @@ def set_votes_required():
 @app.route('/clear', methods=['GET'])
 def clear_stop_requests():
     if request.method == 'GET':
-        stop_requests.clear()
+        game_state.clear_stop_requests()
         return render_template_string("""
             <h1>Stop requests have been cleared</h1>
         """)
@@ -443,7 +1240,7 @@ def clear_stop_requests():
 def check_status():
     if request.method == 'GET':
         player_id = session['player_id']
-        print('player id: ', player_id)
+        log.debug(f'player id: {player_id}')
         return render_template_string("""
             <h1>Player id: {{player_id}}</h1>
         """, player_id=player_id)        
@@ -452,17 +1249,54 @@ def check_status():
 def add_stop_request():
     if request.method == 'POST':
         # Record the player's request to stop playing
-        if (session['player_id'] not in stop_requests):
-            stop_requests.append(session['player_id'])
-        else:
-            print('not recording a repeated request')
-        return jsonify({'stoprequests': stop_requests})
+        if not game_state.add_stop_request(session['player_id']):
+            log.debug('not recording a repeated request')
+        elif enough_votes(game_state.stop_count(), game_state.votes_required()):
+            engine_notifier.notify()
+        return jsonify({'stoprequests': game_state.stop_requests()})
+
+def enough_votes(stop_count, votes_required):
+    # votes_required is sent by the engine as typed, so it may be a string. Zero 
+    # or less means voting is off.
+    try:
+        votes_required = int(votes_required)
+    except (TypeError, ValueError):
+        return False
+    return votes_required > 0 and stop_count >= votes_required
 
 @app.route('/stopdata', methods=['GET', 'POST'])
 def get_stop_data():
-    return jsonify({'stoprequests': stop_requests, 
-                    'votes_required': votes_required, 
-                    'refresh_screen': refresh_screen})
+    return jsonify(game_state.current_game_state())
+
+@app.route('/stream', methods=['GET'])
+def stream_game_state():
+    # Server-Sent Events stream of the same data that /stopdata returns. Each event
+    # carries the state version plus only those values that changed since the
+    # previous event on this connection; the first event carries everything.
+    # Browsers fall back to polling /stopdata if the stream drops.
+    def event_stream():
+        sent_version = None
+        sent_state = {}
+        while True:
+            version = game_state.wait_for_change(sent_version, stream_keepalive_sec)
+
+            if version == sent_version:
+                yield ': keepalive\n\n'
+                continue
+
+            state = game_state.current_game_state()
+            delta = {key: value for key, value in state.items() 
+                        if key not in sent_state or sent_state[key] != value}
+            sent_version = version
+            sent_state = state
+            if len(delta) > 0:
+                delta['version'] = version
+                yield f'id: {version}\ndata: {json.dumps(delta)}\n\n'
+
+    return Response(event_stream(), 
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 @app.route('/submit', methods=['POST'])
 def submit():
@@ -475,11 +1309,11 @@ def submit():
 
 @app.route('/get_stop_count', methods=['GET'])
 def get_stop_count():
-    return str(len(stop_requests))
+    return str(game_state.stop_count())
 
 @app.route('/get_player_count', methods=['GET'])
 def get_player_count():
-    return str(len(active_player_ids))
+    return str(game_state.player_count())
 
 
 @app.route('/debug', methods=['GET'])
@@ -15,9 +15,27 @@ export MINGO_UPDATE_INTERVAL="500"
 
 export MINGO_DEBUG_MODE="False"
 
+# Where to tell the game engine about win claims and votes as they happen. The
+# engine must be run with MINGO_ENGINE_PORT set, and with MINGO_ENGINE_HOST="0.0.0.0"
+# when it runs on another machine.
+# Without this the engine finds them by polling.
+# export MINGO_ENGINE_NOTIFY_URL="http://192.168.1.162:8090/notify"
+
 
 # Program execution using nohup (no hang up) to permit running even after the
 # command shell closes. It keeps running in the background because of trailing &.
 # Stdout and stderr streams are redirected to file web_ctl.log
 # I have configured this for invocation from rc.local at boot time.
 nohup python /home/stephenharding/my_code/python/mingowebcontrol/mingo_web.py > web_ctl.log 2>&1  &
+
+# To use more than one core, keep the game state in SQLite and run several
+# server processes under gunicorn instead. Each player's phone keeps a stream
+# open, which holds one gthread thread, so size --threads to the number of
+# players divided by the number of workers, plus about 30 for other requests.
+# This is enough for 200 players:
+# export MINGO_STATE_BACKEND="sqlite"
+# export MINGO_STATE_DB="/home/stephenharding/my_code/python/mingowebcontrol/.mingo_web_state.db"
+# cd /home/stephenharding/my_code/python/mingowebcontrol
+# nohup gunicorn -w 4 -k gthread --threads 80 -b 0.0.0.0:$USING_PORT mingo_web:app > web_ctl.log 2>&1  &
+# With gevent installed (pip install gevent), streams don't hold threads at all:
+# nohup gunicorn -w 4 -k gevent --worker-connections 1000 -b 0.0.0.0:$USING_PORT mingo_web:app > web_ctl.log 2>&1  &
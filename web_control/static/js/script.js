@@ -4,10 +4,17 @@ const submitButton = document.getElementById('submitButton');
 const stopButton = document.getElementById('stopButton');
 const responseMessage = document.getElementById('responseMessage');
 const votesRequired = document.getElementById('votesRequired');
+const claimMessage = document.getElementById('claimMessage');
 
 const host_url = host_url_main; // 'http://localhost:8080';
 const update_interval_msec = update_interval;
 
+// Latest game state received from the server's event stream. Each stream event
+// only carries the values that changed, so they are merged in here.
+let gameState = {};
+// Interval timer used to poll /stopdata when the event stream is unavailable
+let pollTimer = null;
+
 // Prevent players from using the back-arrow as it fouls things up during game play.
  history.pushState(null, null, location.href);
  window.onpopstate = function(event)
@@ -125,7 +132,11 @@ async function updateStops()
                                 });
 
   result = await response.json();
+  showStopData(result);
+}
 
+function showStopData(result)
+{
   // Note that the enabled state of the buttons is controlled by 0 votes required
   if (result.votes_required > 0)
   {
@@ -170,6 +181,25 @@ async function updateStops()
     }
   }
 
+  // Show the result of checking this card's win claim, if it made one
+  const claim = result.claim_results ? result.claim_results[cardNumber] : undefined;
+  if (claim === undefined)
+  {
+    claimMessage.textContent = '';
+  }
+  else if (claim.verified == null)
+  {
+    claimMessage.textContent = 'Your win claim is being checked...';
+  }
+  else if (claim.verified)
+  {
+    claimMessage.textContent = `Winner! Your card has ${claim.lines.join(', ')}`;
+  }
+  else
+  {
+    claimMessage.textContent = 'Your card is not a winner yet. Keep playing!';
+  }
+
   console.log('Refresh flags: ',result.refresh_screen[cardNumber])
 
   if (result.refresh_screen[cardNumber]==true)
@@ -239,6 +269,52 @@ stopButton.addEventListener('click', postStopRequest);
 
 
 
-// update every 500 msec
-setInterval(updateStops, update_interval_msec);
+function startPolling()
+{
+  if (pollTimer == null)
+  {
+    console.log('Polling for game state every ', update_interval_msec, ' msec');
+    pollTimer = setInterval(updateStops, update_interval_msec);
+  }
+}
+
+function stopPolling()
+{
+  if (pollTimer != null)
+  {
+    clearInterval(pollTimer);
+    pollTimer = null;
+  }
+}
+
+// The server pushes the game state over an event stream whenever it changes. If the
+// stream is not supported or it drops, poll for the state until the browser manages
+// to reconnect the stream.
+function openStateStream()
+{
+  if (!window.EventSource)
+  {
+    startPolling();
+    return;
+  }
+
+  const stream = new EventSource(host_url+'/stream');
+  stream.onopen = () => 
+  {
+    console.log('Game state stream is open');
+    stopPolling();
+  };
+  stream.onmessage = (event) => 
+  {
+    Object.assign(gameState, JSON.parse(event.data));
+    showStopData(gameState);
+  };
+  stream.onerror = () => 
+  {
+    console.log('Game state stream dropped, falling back to polling');
+    startPolling();
+  };
+}
+
+openStateStream();
 